@@ -0,0 +1,346 @@
+"""
+🎚️ Luna Villa — 音声の前処理
+STTに送る前に、デコード → モノラル化・16kHzへリサンプル → 前後の無音カット → 再エンコード をする。
+デコード/エンコードは ffmpeg（別プロセス）、無音判定などCPUを食う処理はプロセスプールで動かす。
+ffmpeg が無い環境では WAV だけ自前で処理し、それ以外はそのまま送るわ。
+"""
+
+import array
+import asyncio
+import io
+import logging
+import shutil
+import sys
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from typing import BinaryIO, Optional, Union
+from config import settings
+
+# VAD（無音判定）のパラメータ
+VAD_FRAME_MS = 30
+VAD_PADDING_MS = 200  # 声の前後に残す余白
+VAD_MIN_RMS = 300  # これ未満は常に無音扱い（16bit PCM）
+VAD_NOISE_FACTOR = 3.0  # ノイズフロアの何倍から声とみなすか
+VAD_PEAK_RATIO = 0.25  # ただしピークのこの割合を超えたら声とみなす
+
+# ffmpeg にファイルを流し込む時の1回ぶん
+STREAM_CHUNK_SIZE = 256 * 1024
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass
+class PreparedAudio:
+    data: Optional[bytes]  # None なら前処理しなかった（元の音声をそのまま送る）
+    mime_type: str
+    metrics: dict = field(default_factory=dict)
+    pcm: Optional[bytes] = None  # 無音カット後のPCM（分割文字起こし用）
+
+
+# ─── 集計メトリクス ─────────────────────────
+_totals = {
+    "processed": 0,
+    "skipped": 0,
+    "failed": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "audio_ms_in": 0,
+    "audio_ms_out": 0,
+    "stage_ms": {"decode": 0.0, "trim": 0.0, "encode": 0.0},
+}
+
+
+def get_metrics() -> dict:
+    """前処理の累計メトリクス"""
+    totals = dict(_totals, stage_ms={k: round(v, 1) for k, v in _totals["stage_ms"].items()})
+    if totals["bytes_in"]:
+        totals["size_ratio"] = round(totals["bytes_out"] / totals["bytes_in"], 3)
+    return totals
+
+
+def _record(metrics: dict):
+    status = metrics.get("status")
+    if status != "ok":
+        _totals["failed" if status == "failed" else "skipped"] += 1
+        return
+    _totals["processed"] += 1
+    _totals["bytes_in"] += metrics["bytes_in"]
+    _totals["bytes_out"] += metrics["bytes_out"]
+    _totals["audio_ms_in"] += metrics["audio_ms_in"]
+    _totals["audio_ms_out"] += metrics["audio_ms_out"]
+    for stage, ms in metrics["stage_ms"].items():
+        _totals["stage_ms"][stage] += ms
+
+
+# ─── プロセスプールで動く純Python処理 ───────────
+def decode_wav(data: bytes, target_rate: int) -> bytes:
+    """WAV を 16bit モノラル PCM (target_rate) にする（ffmpeg が無い時用）"""
+    with wave.open(io.BytesIO(data)) as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if width != 2:
+        raise ValueError(f"16bit PCM の WAV しか扱えないわ (sampwidth={width})")
+
+    samples = array.array("h", frames)
+    if sys.byteorder == "big":
+        samples.byteswap()
+
+    # ダウンミックス
+    if channels > 1:
+        samples = array.array(
+            "h",
+            (sum(samples[i:i + channels]) // channels for i in range(0, len(samples), channels)),
+        )
+
+    # 線形補間でリサンプル
+    if rate != target_rate and samples:
+        step = rate / target_rate
+        count = int(len(samples) / step)
+        last = len(samples) - 1
+        out = array.array("h", bytes(2 * count))
+        for i in range(count):
+            pos = i * step
+            j = int(pos)
+            frac = pos - j
+            nxt = samples[j + 1] if j < last else samples[j]
+            out[i] = int(samples[j] + (nxt - samples[j]) * frac)
+        samples = out
+
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def trim_silence(pcm: bytes, rate: int) -> bytes:
+    """エネルギーベースのVADで前後の無音を切り落とす"""
+    samples = array.array("h", pcm)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    frame_len = max(1, rate * VAD_FRAME_MS // 1000)
+    n_frames = len(samples) // frame_len
+    if n_frames == 0:
+        return pcm
+
+    rms = []
+    for f in range(n_frames):
+        frame = samples[f * frame_len:(f + 1) * frame_len]
+        rms.append((sum(s * s for s in frame) / frame_len) ** 0.5)
+
+    # 静かな方から1割のフレームをノイズフロアとみなす。
+    # ほぼ喋りっぱなしだとフロアが声の大きさになるので、ピークの一定割合で頭打ちにする
+    floor = sorted(rms)[max(0, n_frames // 10 - 1)]
+    threshold = max(VAD_MIN_RMS, min(floor * VAD_NOISE_FACTOR, max(rms) * VAD_PEAK_RATIO))
+    voiced = [f for f, v in enumerate(rms) if v >= threshold]
+    if not voiced:
+        return b""  # 全部無音
+
+    pad = VAD_PADDING_MS // VAD_FRAME_MS
+    start = max(0, voiced[0] - pad) * frame_len
+    end = min(n_frames, voiced[-1] + 1 + pad) * frame_len
+    if end >= n_frames * frame_len:
+        end = len(samples)  # 末尾の端数フレームも残す
+    return pcm[start * 2:end * 2]
+
+
+def plan_segments(pcm: bytes, rate: int, target_ms: int, search_ms: int, overlap_ms: int) -> list[tuple[int, int]]:
+    """
+    長い音声を無音の所で区切る。
+    だいたい target_ms ごとに、その前後 search_ms の中で一番静かなフレームを切れ目にする。
+    各セグメントは前のセグメントに overlap_ms だけ食い込ませる（境目の単語が欠けないように）。
+    戻り値はバイト単位の (start, end) のリスト。
+    """
+    samples = array.array("h", pcm)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    frame_len = max(1, rate * VAD_FRAME_MS // 1000)
+    n_frames = len(samples) // frame_len
+    target = target_ms // VAD_FRAME_MS
+    if n_frames <= target * 1.5:
+        return [(0, len(pcm))]
+
+    rms = []
+    for f in range(n_frames):
+        frame = samples[f * frame_len:(f + 1) * frame_len]
+        rms.append(sum(s * s for s in frame) / frame_len)
+
+    search = search_ms // VAD_FRAME_MS
+    cuts = [0]
+    while n_frames - cuts[-1] > target * 1.5:
+        ideal = cuts[-1] + target
+        lo, hi = max(cuts[-1] + 1, ideal - search), min(n_frames - 1, ideal + search)
+        cuts.append(min(range(lo, hi + 1), key=lambda f: rms[f]))
+    cuts.append(n_frames)
+
+    overlap = overlap_ms // VAD_FRAME_MS
+    bytes_per_frame = frame_len * 2
+    segments = []
+    for i in range(len(cuts) - 1):
+        start = max(0, cuts[i] - overlap) * bytes_per_frame if i else 0
+        end = cuts[i + 1] * bytes_per_frame if i + 2 < len(cuts) else len(pcm)  # 最後は端数まで
+        segments.append((start, end))
+    return segments
+
+
+def find_quiet_cut(pcm: bytes, rate: int, search_ms: int) -> int:
+    """PCMの末尾 search_ms の中で一番静かなフレームの終わり（バイト位置）を返す"""
+    frame_bytes = max(1, rate * VAD_FRAME_MS // 1000) * 2
+    n_frames = len(pcm) // frame_bytes
+    first = max(1, n_frames - search_ms // VAD_FRAME_MS)
+    if first >= n_frames:
+        return len(pcm)
+
+    def energy(f: int) -> int:
+        frame = array.array("h", pcm[f * frame_bytes:(f + 1) * frame_bytes])
+        if sys.byteorder == "big":
+            frame.byteswap()
+        return sum(s * s for s in frame)
+
+    quietest = min(range(first, n_frames), key=energy)
+    return (quietest + 1) * frame_bytes
+
+
+def encode_wav(pcm: bytes, rate: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+# ─── 非同期ラッパー ─────────────────────────
+async def run_cpu(fn, *args):
+    """CPUを食う処理をプロセスプールで実行する"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=settings.AUDIO_PREP_WORKERS)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_process_pool, partial(fn, *args))
+
+
+def shutdown():
+    """プロセスプールを畳む（lifespan 終了時）"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+
+def ffmpeg_path() -> Optional[str]:
+    return shutil.which(settings.FFMPEG_PATH)
+
+
+async def _ffmpeg(args: list[str], source: Union[bytes, BinaryIO]) -> bytes:
+    """source は bytes か file-like。file-like なら先頭から少しずつ stdin に流す（全部メモリに載せない）"""
+    proc = await asyncio.create_subprocess_exec(
+        ffmpeg_path(), "-hide_banner", "-loglevel", "error", *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def feed():
+        try:
+            if isinstance(source, bytes):
+                proc.stdin.write(source)
+                await proc.stdin.drain()
+                return
+            source.seek(0)
+            while chunk := await asyncio.to_thread(source.read, STREAM_CHUNK_SIZE):
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg が先に終わった（エラーは stderr と returncode で分かる）
+        finally:
+            proc.stdin.close()
+
+    out, err, _ = await asyncio.gather(proc.stdout.read(), proc.stderr.read(), feed())
+    await proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {err.decode(errors='replace').strip()}")
+    return out
+
+
+async def decode_to_pcm(audio: BinaryIO, mime_type: str) -> Optional[bytes]:
+    """どんな形式でも 16bit モノラル PCM にする。扱えなければ None。"""
+    rate = settings.AUDIO_SAMPLE_RATE
+    if ffmpeg_path():
+        return await _ffmpeg(
+            ["-i", "pipe:0", "-ac", "1", "-ar", str(rate), "-f", "s16le", "pipe:1"], audio
+        )
+    audio.seek(0)
+    if mime_type in ("audio/wav", "audio/x-wav", "audio/wave") or audio.read(4) == b"RIFF":
+        # ffmpeg 無しの WAV だけはプロセスプールに丸ごと渡す（AUDIO_PREP_MAX_BYTES 以下に限る）
+        audio.seek(0)
+        return await run_cpu(decode_wav, await asyncio.to_thread(audio.read), rate)
+    return None
+
+
+async def encode_pcm(pcm: bytes) -> tuple[bytes, str]:
+    """PCMをコンパクトに再エンコードする（ffmpegがあれば Opus、無ければ WAV）"""
+    rate = settings.AUDIO_SAMPLE_RATE
+    if ffmpeg_path():
+        encoded = await _ffmpeg(
+            ["-f", "s16le", "-ar", str(rate), "-ac", "1", "-i", "pipe:0",
+             "-c:a", "libopus", "-b:a", settings.AUDIO_OPUS_BITRATE, "-f", "ogg", "pipe:1"],
+            pcm,
+        )
+        return encoded, "audio/ogg"
+    return encode_wav(pcm, rate), "audio/wav"
+
+
+def pcm_ms(pcm: bytes) -> int:
+    return len(pcm) * 1000 // (2 * settings.AUDIO_SAMPLE_RATE)
+
+
+async def preprocess(audio: BinaryIO, size: int, mime_type: str) -> PreparedAudio:
+    """
+    STT向けに音声を整える。audio は size バイトの file-like（スプールしたアップロード等）。
+    失敗したり扱えない形式だったりしたら data=None を返すので、元の audio をそのまま送って（metrics.status で分かる）。
+    """
+    metrics: dict = {"bytes_in": size}
+    if not settings.AUDIO_PREP_ENABLED or size > settings.AUDIO_PREP_MAX_BYTES:
+        metrics["status"] = "disabled" if not settings.AUDIO_PREP_ENABLED else "too_large"
+        _record(metrics)
+        return PreparedAudio(None, mime_type, metrics)
+
+    stage_ms: dict = {}
+    try:
+        t0 = time.perf_counter()
+        pcm = await decode_to_pcm(audio, mime_type)
+        stage_ms["decode"] = (time.perf_counter() - t0) * 1000
+        if pcm is None:
+            metrics["status"] = "unsupported"
+            _record(metrics)
+            return PreparedAudio(None, mime_type, metrics)
+
+        t0 = time.perf_counter()
+        trimmed = await run_cpu(trim_silence, pcm, settings.AUDIO_SAMPLE_RATE)
+        stage_ms["trim"] = (time.perf_counter() - t0) * 1000
+
+        t0 = time.perf_counter()
+        encoded, encoded_mime = await encode_pcm(trimmed)
+        stage_ms["encode"] = (time.perf_counter() - t0) * 1000
+    except Exception as e:
+        logging.warning(f"Audio prep failed, sending original: {e}")
+        metrics["status"] = "failed"
+        _record(metrics)
+        return PreparedAudio(None, mime_type, metrics)
+    finally:
+        metrics["stage_ms"] = {k: round(v, 1) for k, v in stage_ms.items()}
+
+    metrics.update(
+        status="ok",
+        bytes_out=len(encoded),
+        size_ratio=round(len(encoded) / max(1, size), 3),
+        audio_ms_in=pcm_ms(pcm),
+        audio_ms_out=pcm_ms(trimmed),
+    )
+    _record(metrics)
+    return PreparedAudio(encoded, encoded_mime, metrics, pcm=trimmed)
@@ -0,0 +1,146 @@
+"""
+🔮 Luna Villa — タイトルの入力補完
+これまでに使ったタスク・予定のタイトルを、メモリ上のソート済み配列に入れておき、
+bisect で前方一致を引く（LIKE '%...%' で全件なめない）。
+
+- キーは NFKC + casefold したタイトル。空白で区切った単語の頭からも引けるように、単語ごとにもキーを入れる
+- 重みは「使った回数を半減期つきで減衰させたもの」。よく使う・最近使ったものほど上に来るわ
+- 起動時にバックグラウンドで組み立て、書き込みのたびに1件ずつ足す（消しても候補には残す）
+"""
+
+import asyncio
+import bisect
+import time
+import unicodedata
+from typing import Optional
+from config import settings
+from database import get_db
+
+# 1回の検索で見る候補の上限（これ以上は重みで並べる前に打ち切る）
+MAX_SCAN = 500
+# 1つのタイトルから入れる単語キーの上限
+MAX_WORD_KEYS = 8
+
+
+class Entry:
+    """(種類, タイトル) ごとの使用実績"""
+
+    __slots__ = ("kind", "title", "count", "weight", "last_used")
+
+    def __init__(self, kind: str, title: str):
+        self.kind = kind
+        self.title = title
+        self.count = 0
+        self.weight = 0.0
+        self.last_used = 0.0
+
+    def decayed(self, now: float) -> float:
+        half_life = settings.SUGGEST_HALF_LIFE_DAYS * 86400
+        return self.weight * 0.5 ** (max(now - self.last_used, 0) / half_life)
+
+    def use(self, at: float):
+        self.weight = self.decayed(at) + 1 if self.count else 1.0
+        self.last_used = max(self.last_used, at)
+        self.count += 1
+
+
+_entries: dict[tuple[str, str], Entry] = {}
+_index: list[tuple[str, str, str]] = []  # (キー, 種類, 正規化タイトル) の昇順
+_loaded = False
+_load_lock = asyncio.Lock()
+_backlog: list[tuple[str, str, float]] = []  # 組み立て中に来た書き込み
+
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).casefold().strip()
+
+
+def _keys_of(normalized: str) -> list[str]:
+    keys = [normalized]
+    words = normalized.split()
+    for i in range(1, min(len(words), MAX_WORD_KEYS)):
+        keys.append(" ".join(words[i:]))
+    return keys
+
+
+def _add(kind: str, title: str, at: float):
+    title = title.strip()
+    normalized = normalize(title)
+    if not normalized:
+        return
+    entry = _entries.get((kind, normalized))
+    if entry is None:
+        entry = _entries[(kind, normalized)] = Entry(kind, title)
+        for key in _keys_of(normalized):
+            bisect.insort(_index, (key, kind, normalized))
+    entry.title = title  # 表記は最後に使ったものにそろえる
+    entry.use(at)
+
+
+def record(kind: str, title: Optional[str], at: Optional[float] = None):
+    """タスク・予定を書いた時に呼ぶ。組み立て前なら終わってから足す。"""
+    if not title:
+        return
+    at = at or time.time()
+    if _loaded:
+        _add(kind, title, at)
+    else:
+        _backlog.append((kind, title, at))
+
+
+async def ensure_loaded():
+    """まだなら tasks / events のタイトルから組み立てる（起動時にバックグラウンドで呼ぶ）"""
+    global _loaded
+    if _loaded:
+        return
+    async with _load_lock:
+        if _loaded:
+            return
+        db = await get_db()
+        try:
+            cursor = await db.execute(
+                """
+                SELECT 'task', title, CAST(strftime('%s', created_at) AS INTEGER) FROM tasks
+                UNION ALL
+                SELECT 'event', title, CAST(strftime('%s', created_at) AS INTEGER) FROM events
+                """
+            )
+            rows = await cursor.fetchall()
+        finally:
+            await db.close()
+        # 重みの減衰は古い順に足していかないと合わないので、時刻で並べてから入れる
+        for kind, title, at in sorted(rows, key=lambda r: r[2] or 0):
+            if title:
+                _add(kind, title, float(at or 0))
+        for kind, title, at in _backlog:
+            _add(kind, title, at)
+        _backlog.clear()
+        _loaded = True
+        print(f"🔮 入力補完の候補を {len(_entries)} 件用意したわ")
+
+
+def lookup(prefix: str, kind: Optional[str] = None, limit: int = 10) -> list[dict]:
+    """前方一致する候補を重みの大きい順に"""
+    key = normalize(prefix)
+    if not key:
+        return []
+    now = time.time()
+    seen: set[tuple[str, str]] = set()
+    candidates = []
+    start = bisect.bisect_left(_index, (key,))
+    for indexed_key, entry_kind, normalized in _index[start:start + MAX_SCAN]:
+        if not indexed_key.startswith(key):
+            break
+        if kind and entry_kind != kind or (entry_kind, normalized) in seen:
+            continue
+        seen.add((entry_kind, normalized))
+        candidates.append(_entries[(entry_kind, normalized)])
+    candidates.sort(key=lambda e: (-e.decayed(now), len(e.title)))
+    return [
+        {"title": e.title, "kind": e.kind, "count": e.count, "score": round(e.decayed(now), 3)}
+        for e in candidates[:limit]
+    ]
+
+
+def get_metrics() -> dict:
+    return {"loaded": _loaded, "titles": len(_entries), "keys": len(_index)}
@@ -0,0 +1,135 @@
+"""
+📦 Luna Villa — まとめて書き込み
+タスクや予定の作成・更新・削除を配列で受け取って、1本の接続・1回のコミットで適用する。
+
+- まず全件をモデルで検証してから書き込みに入る
+- atomic: 1件でも失敗したら全部なかったことにする
+- partial: 1件ごとに SAVEPOINT を切って、失敗した分だけ巻き戻す
+"""
+
+from typing import Awaitable, Callable, Literal, Optional, Type
+from fastapi import HTTPException
+from pydantic import BaseModel, Field, ValidationError
+from database import get_db
+import versions
+
+# 1リクエストで受け付ける操作の上限
+MAX_BATCH_OPS = 500
+
+
+class BatchOp(BaseModel):
+    op: Literal["create", "update", "delete"]
+    id: Optional[int] = None  # update / delete の対象
+    data: dict = Field(default_factory=dict)  # create / update の中身
+
+
+class BatchRequest(BaseModel):
+    ops: list[BatchOp] = Field(..., min_length=1, max_length=MAX_BATCH_OPS)
+    mode: Literal["atomic", "partial"] = "atomic"
+
+
+class BatchItem:
+    """検証済みの1操作"""
+
+    def __init__(self, index: int, op: BatchOp, payload: Optional[BaseModel] = None,
+                 error: Optional[str] = None):
+        self.index = index
+        self.op = op.op
+        self.id = op.id
+        self.payload = payload
+        self.error = error
+
+
+def _format_validation_error(e: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(p) for p in err['loc']) or 'data'}: {err['msg']}" for err in e.errors()
+    )
+
+
+def prepare(req: BatchRequest, create_model: Type[BaseModel], update_model: Type[BaseModel],
+            check: Optional[Callable[[BaseModel], None]] = None) -> list[BatchItem]:
+    """全操作を先に検証する。check はモデル以外の検証（HTTPException を投げてよい）。"""
+    items = []
+    for index, op in enumerate(req.ops):
+        try:
+            if op.op in ("update", "delete") and op.id is None:
+                raise ValueError(f"{op.op} には id が要るわ")
+            payload = None
+            if op.op == "create":
+                payload = create_model.model_validate(op.data)
+            elif op.op == "update":
+                payload = update_model.model_validate(op.data)
+            if payload is not None and check:
+                check(payload)
+            items.append(BatchItem(index, op, payload))
+        except ValidationError as e:
+            items.append(BatchItem(index, op, error=_format_validation_error(e)))
+        except HTTPException as e:
+            items.append(BatchItem(index, op, error=str(e.detail)))
+        except ValueError as e:
+            items.append(BatchItem(index, op, error=str(e)))
+    return items
+
+
+def _failure(item: BatchItem, status: int, error: str) -> dict:
+    return {"index": item.index, "op": item.op, "id": item.id, "ok": False,
+            "status": status, "error": error}
+
+
+async def run(req: BatchRequest, items: list[BatchItem],
+              apply: Callable[..., Awaitable[dict]]) -> dict:
+    """
+    検証済みの操作を1トランザクションで適用する。
+    apply(db, item) は1件分を書き込んで結果の dict を返す（失敗は HTTPException）。
+    """
+    invalid = [_failure(item, 422, item.error) for item in items if item.error]
+    if invalid and req.mode == "atomic":
+        raise HTTPException(
+            status_code=422,
+            detail={"message": "中身が変な操作があるから、どれも実行してないわ", "results": invalid},
+        )
+
+    results = []
+    db = await get_db()
+    try:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            for item in items:
+                if item.error:
+                    results.append(_failure(item, 422, item.error))
+                    continue
+                if req.mode == "partial":
+                    await db.execute("SAVEPOINT batch_item")
+                try:
+                    result = await apply(db, item)
+                except HTTPException as e:
+                    failure = _failure(item, e.status_code, str(e.detail))
+                    if req.mode == "atomic":
+                        await db.rollback()
+                        raise HTTPException(
+                            status_code=409,
+                            detail={"message": "途中で失敗したから、全部取り消したわ", "results": [failure]},
+                        )
+                    await db.execute("ROLLBACK TO batch_item")
+                    await db.execute("RELEASE batch_item")
+                    results.append(failure)
+                    continue
+                if req.mode == "partial":
+                    await db.execute("RELEASE batch_item")
+                results.append({"index": item.index, "op": item.op, "ok": True, "status": 200, **result})
+            await versions.commit(db)
+        except HTTPException:
+            raise
+        except Exception:
+            await db.rollback()
+            raise
+    finally:
+        await db.close()
+
+    failed = sum(1 for r in results if not r["ok"])
+    return {
+        "mode": req.mode,
+        "applied": len(results) - failed,
+        "failed": failed,
+        "results": results,
+    }
@@ -0,0 +1,192 @@
+"""
+🏆 Luna Villa — タスク完了の集計
+完了したタスクを日ごとに数えたロールアップ表（task_completion_daily）を持つ。
+tasks を毎回なめずに、日別の件数・連続日数・期限内に終わらせた割合を返せるわ。
+
+- タスクを書き換える時は、変更前の行ぶんを引いて（sign=-1）、変更後の行ぶんを足す（sign=+1）
+- 期限のないタスクは completed にだけ数え、on_time / late には入れない
+- 表が空なのに完了済みタスクがある時は、起動時に tasks から作り直す
+
+完了の時刻は completed_ts（エポック秒）が正。期限（due_ts）と同じ時計で比べ、
+日ごとの区切りはタスクの tz の日付で行う。completed_at は表示用の settings.TIMEZONE の壁時計よ。
+"""
+
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+from database import get_db
+import epoch
+
+# 完了の行として読む列（この順で apply に渡す）
+ROW_COLUMNS = "is_done, completed_ts, due_ts, due_time, tz"
+# completed_ts の埋め戻しで1回のトランザクションに入れる行数
+BACKFILL_CHUNK = 500
+
+
+def stamp(ts: float) -> str:
+    """completed_at に入れる文字列（settings.TIMEZONE の壁時計）"""
+    return epoch.wall_clock(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def today() -> date:
+    return epoch.wall_clock(time.time()).date()
+
+
+def contribution(completed_ts: Optional[int], due_ts: Optional[int], due_time: Optional[str],
+                 tz: Optional[str] = None) -> Optional[tuple[str, Optional[bool]]]:
+    """(完了した日, 期限内か) を返す。期限がなければ期限内かは None。"""
+    if completed_ts is None:
+        return None
+    day = epoch.wall_clock(completed_ts, tz).date().isoformat()
+    if due_ts is None:
+        return day, None
+    # 時刻のないタスクは、その日のうちに終われば期限内
+    deadline = due_ts if due_time else due_ts + 86400
+    return day, completed_ts <= deadline
+
+
+async def apply(db, row, sign: int):
+    """tasks の1行（ROW_COLUMNS の順）ぶんを足す / 引く。コミットは呼び出し側。"""
+    if row is None:
+        return
+    is_done, completed_ts, due_ts, due_time, tz = row
+    if not is_done:
+        return
+    try:
+        counted = contribution(completed_ts, due_ts, due_time, tz)
+    except ValueError:
+        return
+    if counted is None:
+        return
+    day, on_time = counted
+    await db.execute(
+        """
+        INSERT INTO task_completion_daily (day, completed, on_time, late) VALUES (?, ?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET
+            completed = completed + excluded.completed,
+            on_time = on_time + excluded.on_time,
+            late = late + excluded.late
+        """,
+        (day, sign, sign if on_time is True else 0, sign if on_time is False else 0),
+    )
+    if sign < 0:
+        await db.execute("DELETE FROM task_completion_daily WHERE day = ? AND completed <= 0", (day,))
+
+
+async def rebuild() -> int:
+    """表が空なら tasks から作り直す。作った日数を返す。"""
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            "SELECT (SELECT COUNT(*) FROM task_completion_daily), "
+            "(SELECT COUNT(*) FROM tasks WHERE is_done = 1 AND completed_ts IS NOT NULL)"
+        )
+        days, done = await cursor.fetchone()
+        if days or not done:
+            return 0
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute(f"SELECT {ROW_COLUMNS} FROM tasks WHERE is_done = 1")
+        async for row in cursor:
+            await apply(db, row, +1)
+        cursor = await db.execute("SELECT COUNT(*) FROM task_completion_daily")
+        days = (await cursor.fetchone())[0]
+        await db.commit()
+        return days
+    finally:
+        await db.close()
+
+
+async def backfill() -> int:
+    """
+    completed_ts がない完了済みの行を埋めて、completed_at も settings.TIMEZONE の壁時計に書き直す。
+    前の completed_at は2種類の時計が混ざっている:
+    created_at から写したもの（UTC）と、完了時にサーバーのローカル時刻で打刻したもの。
+    埋めた行があれば集計表は捨てる（rebuild() が作り直す）。埋めた件数を返す。
+    """
+    filled = 0
+    db = await get_db()
+    try:
+        while True:
+            await db.execute("BEGIN IMMEDIATE")
+            cursor = await db.execute(
+                """
+                SELECT id, completed_at, created_at FROM tasks
+                WHERE is_done = 1 AND completed_ts IS NULL AND completed_at IS NOT NULL
+                ORDER BY id LIMIT ?
+                """,
+                (BACKFILL_CHUNK,),
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                await db.rollback()
+                return filled
+            if not filled:
+                await db.execute("DELETE FROM task_completion_daily")
+            updates = []
+            for task_id, completed_at, created_at in rows:
+                try:
+                    done = datetime.fromisoformat(str(completed_at))
+                except ValueError:
+                    updates.append((None, None, task_id))  # 読めない打刻は未打刻扱い
+                    continue
+                if done.tzinfo is None and completed_at == created_at:
+                    done = done.replace(tzinfo=timezone.utc)
+                # それ以外のナイーブな値は、打刻した時のサーバーのローカル時刻として読む
+                ts = int(done.timestamp())
+                updates.append((ts, stamp(ts), task_id))
+            await db.executemany("UPDATE tasks SET completed_ts = ?, completed_at = ? WHERE id = ?", updates)
+            await db.commit()
+            filled += len(rows)
+    finally:
+        await db.close()
+
+
+# ─── 集計 ─────────────────────────────────
+def streaks(days: list[str], today: date) -> tuple[int, int]:
+    """完了した日の一覧（昇順）から (今の連続日数, 最長の連続日数)。今日がまだなら昨日までで数える。"""
+    longest = run = 0
+    previous: Optional[date] = None
+    for value in days:
+        current = date.fromisoformat(value)
+        run = run + 1 if previous and current - previous == timedelta(days=1) else 1
+        longest = max(longest, run)
+        previous = current
+    if previous is None or today - previous > timedelta(days=1):
+        return 0, longest
+    return run, longest
+
+
+async def summary(db, first: date, last: date) -> dict:
+    """first〜last の日別件数と、全期間の連続日数・期限内率"""
+    cursor = await db.execute(
+        """
+        SELECT day, completed, on_time, late FROM task_completion_daily
+        WHERE day BETWEEN ? AND ? ORDER BY day
+        """,
+        (first.isoformat(), last.isoformat()),
+    )
+    daily = [
+        {"date": day, "completed": completed, "on_time": on_time, "late": late}
+        for day, completed, on_time, late in await cursor.fetchall()
+    ]
+    cursor = await db.execute("SELECT day FROM task_completion_daily WHERE completed > 0 ORDER BY day")
+    current, longest = streaks([row[0] for row in await cursor.fetchall()], today())
+    cursor = await db.execute(
+        "SELECT COALESCE(SUM(completed), 0), COALESCE(SUM(on_time), 0), COALESCE(SUM(late), 0) "
+        "FROM task_completion_daily"
+    )
+    total, on_time, late = await cursor.fetchone()
+    period = [sum(d[k] for d in daily) for k in ("completed", "on_time", "late")]
+    return {
+        "from": first.isoformat(),
+        "to": last.isoformat(),
+        "daily": daily,
+        "period": {
+            "completed": period[0],
+            "on_time_ratio": round(period[1] / (period[1] + period[2]), 3) if period[1] + period[2] else None,
+        },
+        "total_completed": total,
+        "on_time_ratio": round(on_time / (on_time + late), 3) if on_time + late else None,
+        "current_streak": current,
+        "longest_streak": longest,
+    }
@@ -37,5 +37,54 @@ class Settings(BaseSettings):
     # ─── モデル設定 ───
     GEMINI_MODEL: str = "gemini-flash-latest"
 
+    # ─── 音声認識 (STT) 設定 ───
+    STT_BACKEND: str = "gemini"  # "gemini" | "stub"（オフラインで試す時用）
+    STT_MODEL: str = "gemini-1.5-flash"  # STTには1.5 Flashが安定
+    STT_MAX_WORKERS: int = 4  # Gemini呼び出しを流すスレッド数の上限
+    STT_INLINE_MAX_BYTES: int = 8 * 1024 * 1024  # これ以下ならFile APIを使わずインラインで送る
+    STT_SPOOL_MAX_BYTES: int = 2 * 1024 * 1024  # これを超えたらアップロードをディスクに逃がす
+    STT_SEGMENT_THRESHOLD_SECONDS: int = 60  # これより長い録音は分割して並列に文字起こしする
+    STT_SEGMENT_SECONDS: int = 30  # 1セグメントの目安の長さ
+    STT_SEGMENT_SEARCH_SECONDS: int = 5  # 切れ目の無音を探す幅（目安の前後）
+    STT_SEGMENT_OVERLAP_MS: int = 1000  # セグメント同士の重なり
+    STT_MAX_PARALLEL_SEGMENTS: int = 4
+    STT_LIVE_WINDOW_MS: int = 4000  # ライブ文字起こしで1回に送る長さ
+    STT_CACHE_MEMORY_ENTRIES: int = 128  # 文字起こし結果をメモリに置いておく件数
+    STT_CACHE_TTL_HOURS: int = 24 * 7  # SQLite側のキャッシュの有効期限
+
+    # ─── 音声前処理設定 ───
+    AUDIO_PREP_ENABLED: bool = True
+    AUDIO_PREP_MAX_BYTES: int = 50 * 1024 * 1024  # これより大きい音声は前処理せずそのまま送る
+    AUDIO_PREP_WORKERS: int = 2  # 無音カット等を動かすプロセス数
+    AUDIO_SAMPLE_RATE: int = 16000  # 音声認識向けのサンプリングレート
+    AUDIO_OPUS_BITRATE: str = "24k"
+    FFMPEG_PATH: str = "ffmpeg"
+
+    # ─── WebSocket設定 ───
+    WS_HEARTBEAT_SECONDS: int = 20  # ping間隔。2回分応答がなければ切断する
+
+    # ─── 差分同期設定 ───
+    SYNC_TOMBSTONE_RETENTION_DAYS: int = 30  # 削除の記録を残す日数。これより古い端末は全件取り直し
+    SYNC_COMPACT_INTERVAL_HOURS: int = 6  # 古い削除記録を掃除する間隔
+    MEMO_OUTBOX_RETENTION_DAYS: int = 30  # PC側が受け取り済みのメモ送信箱を残す日数
+
+    # ─── 一括処理設定 ───
+    JOB_DELETE_BATCH: int = 500  # 一括削除で1トランザクションに消す行数
+    JOB_YIELD_SECONDS: float = 0.05  # バッチの間に他の処理へ譲る時間
+    VACUUM_INTERVAL_HOURS: int = 6  # 消した後の空きページをファイルから返す間隔
+    VACUUM_PAGES_PER_STEP: int = 1000  # incremental_vacuum 1回で返すページ数
+
+    # ─── カレンダー設定 ───
+    TIMEZONE: str = "Asia/Tokyo"  # タイムゾーンの書いていない日時をどこの時刻として読むか
+    CALENDAR_DEFAULT_EVENT_MINUTES: int = 60  # 終了時刻のない予定を、空き・重なりの判定で何分とみなすか
+
+    # ─── リマインダー設定 ───
+    REMINDER_LEAD_MINUTES: int = 10  # 予定・時刻つきタスクの何分前に鳴らすか
+    REMINDER_TASK_DEFAULT_TIME: str = "09:00"  # 時刻のないタスクを鳴らす時間
+    REMINDER_REPLAY_MINUTES: int = 30  # 誰も繋がっていない間に鳴った分を取っておく時間
+
+    # ─── 入力補完設定 ───
+    SUGGEST_HALF_LIFE_DAYS: float = 30  # 使った回数の重みが半分になるまでの日数
+
 
 settings = Settings()
@@ -8,10 +8,24 @@ from config import settings
 
 DB_PATH = str(settings.DB_PATH)
 
+# 変更バージョンを持たせるテーブル（書き込まれるたびに +1 される）
+VERSIONED_TABLES = (
+    "conversations", "memos", "events", "tasks", "greetings", "secret_diary", "stats", "sync_tombstones",
+)
+# 差分同期の対象テーブル（change_seq / updated_at を持ち、削除は墓石に残る）
+SYNCED_TABLES = ("conversations", "memos", "events", "tasks", "greetings", "secret_diary")
+# conversations から memos へ移す時に、1トランザクションで動かす行数
+MEMO_MIGRATION_CHUNK = 500
+
 
 async def init_db():
     """データベースとテーブルを初期化する"""
     async with aiosqlite.connect(DB_PATH) as db:
+        # 消した後の空きページを少しずつ返せるようにする（jobs.vacuum_loop が返す）
+        # まっさらなDBはテーブルを作る前に決めれば済む。既存DBの切り替えは起動後のジョブで
+        cursor = await db.execute("PRAGMA page_count")
+        if (await cursor.fetchone())[0] == 0:
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
         # 会話テーブル
         await db.execute("""
             CREATE TABLE IF NOT EXISTS conversations (
@@ -28,6 +42,25 @@ async def init_db():
             await db.execute("ALTER TABLE conversations ADD COLUMN title TEXT DEFAULT ''")
         except:
             pass
+        # 生成が途中で打ち切られた応答の印
+        try:
+            await db.execute("ALTER TABLE conversations ADD COLUMN truncated BOOLEAN DEFAULT 0")
+        except:
+            pass
+        # 履歴は新しい順、統計は role ごとの件数で読む
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_conversations_created_at ON conversations(created_at, id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_conversations_role ON conversations(role)")
+
+        # お土産メモテーブル（以前は conversations の is_memo = 1 の行だった。移し替えは migrate_memos()）
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS memos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT DEFAULT '',
+                content TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_memos_created_at ON memos(created_at, id)")
 
         # カレンダーイベントテーブル
         await db.execute("""
@@ -42,6 +75,14 @@ async def init_db():
             )
         """)
 
+        # 繰り返しルール (RRULE) と例外日（JSON配列）
+        try:
+            await db.execute("ALTER TABLE events ADD COLUMN rrule TEXT")
+        except: pass
+        try:
+            await db.execute("ALTER TABLE events ADD COLUMN exdates TEXT DEFAULT '[]'")
+        except: pass
+
         # タスクテーブル
         await db.execute("""
             CREATE TABLE IF NOT EXISTS tasks (
@@ -85,6 +126,9 @@ async def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # 挨拶・日記の一覧は新しい方から created_at|id でページ送りする
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_greetings_created_at ON greetings(created_at, id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_secret_diary_created_at ON secret_diary(created_at, id)")
 
         # 統計・ステータステーブル
         await db.execute("""
@@ -94,6 +138,182 @@ async def init_db():
                 value_text TEXT
             )
         """)
+        # 文字起こし結果キャッシュ（音声の内容ハッシュ → 結果JSON）
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS stt_cache (
+                hash TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_stt_cache_created_at ON stt_cache(created_at)")
+
+        # 期間検索用インデックス
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_events_start_at ON events(start_at)")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_recurring ON events(start_at) WHERE rrule IS NOT NULL AND rrule != ''"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_due ON tasks(due_date, due_time)")
+        # iCalendar の UID（取り込みの重複判定用）。既存の行には id から振っておく
+        for table, prefix in (("events", "event"), ("tasks", "task")):
+            try:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN uid TEXT")
+            except: pass
+            await db.execute(
+                f"UPDATE {table} SET uid = 'luna-{prefix}-' || id || '@luna-villa' WHERE uid IS NULL"
+            )
+            await db.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_uid ON {table}(uid)")
+
+        # 正規化した日時（UTC エポック秒）と元のタイムゾーン。既存行は epoch.backfill() が埋める
+        for table, columns in (("events", ("start_ts INTEGER", "end_ts INTEGER", "tz TEXT")),
+                               ("tasks", ("due_ts INTEGER", "tz TEXT"))):
+            for column in columns:
+                try:
+                    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+                except: pass
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_events_start_ts ON events(start_ts)")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_recurring_ts ON events(start_ts) WHERE rrule IS NOT NULL AND rrule != ''"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_due_ts ON tasks(due_ts)")
+
+        # 完了タスクの日別ロールアップ（completions.py が書き込みのたびに足し引きする）
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS task_completion_daily (
+                day TEXT PRIMARY KEY,
+                completed INTEGER NOT NULL DEFAULT 0,
+                on_time INTEGER NOT NULL DEFAULT 0,
+                late INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # 完了時刻のエポック秒（completions.backfill が既存の行を埋める）
+        try:
+            await db.execute("ALTER TABLE tasks ADD COLUMN completed_ts INTEGER")
+        except:
+            pass
+        # completed_at ができる前に完了した行は、作成日時で代用しておく
+        await db.execute("UPDATE tasks SET completed_at = created_at WHERE is_done = 1 AND completed_at IS NULL")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tasks_completed_at ON tasks(completed_at, id) WHERE is_done = 1"
+        )
+
+        # メモの送信箱（PC側へ配る連番つきの記録）と、受け取り手ごとの既読位置
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS memo_outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                memo_id INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                title TEXT,
+                content TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox_consumers (
+                name TEXT PRIMARY KEY,
+                acked_seq INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # 予定が掛かる期間の R*Tree（分単位）。中身は intervals.py が書き込みと一緒に保守する
+        await db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS event_spans USING rtree_i32(id, start_min, end_min)")
+        # 作り直しで済む索引の「中身の形式」の版。形式を変えたら起動時に作り直す
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS index_state (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            )
+        """)
+
+        # ─── 差分同期 ───
+        # 全テーブル共通の通し番号。書き込まれた行にはその時点の番号が change_seq として付く
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                seq INTEGER NOT NULL DEFAULT 0,
+                floor INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        await db.execute("INSERT OR IGNORE INTO sync_state (id) VALUES (1)")
+        # 削除された行の墓石。floor 以下のものは掃除済み
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS sync_tombstones (
+                seq INTEGER PRIMARY KEY,
+                table_name TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                is_memo BOOLEAN DEFAULT 0,
+                deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        for table in SYNCED_TABLES:
+            try:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0")
+            except: pass
+            try:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP")
+            except: pass
+            await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_change_seq ON {table}(change_seq)")
+
+            # 既存の行に番号を振る（初回だけ。id 順に seq の続きから）
+            cursor = await db.execute(f"SELECT COUNT(*), MAX(id) FROM {table} WHERE change_seq = 0")
+            pending, max_id = await cursor.fetchone()
+            if pending:
+                await db.execute(f"""
+                    UPDATE {table}
+                    SET change_seq = (SELECT seq FROM sync_state) + id, updated_at = created_at
+                    WHERE change_seq = 0
+                """)
+                await db.execute("UPDATE sync_state SET seq = seq + ?", (max_id,))
+
+            # 書き込まれた行に次の番号を付ける。
+            # トリガー自身の UPDATE は change_seq が変わるので WHEN で弾かれ、二重には進まない
+            bump = f"""
+                UPDATE sync_state SET seq = seq + 1;
+                UPDATE {table}
+                SET change_seq = (SELECT seq FROM sync_state), updated_at = CURRENT_TIMESTAMP
+                WHERE id = NEW.id;
+            """
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_insert_sync
+                AFTER INSERT ON {table}
+                BEGIN {bump} END
+            """)
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_update_sync
+                AFTER UPDATE ON {table}
+                WHEN NEW.change_seq = OLD.change_seq
+                BEGIN {bump} END
+            """)
+            is_memo = "OLD.is_memo" if table == "conversations" else "0"
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_delete_sync
+                AFTER DELETE ON {table}
+                BEGIN
+                    UPDATE sync_state SET seq = seq + 1;
+                    INSERT INTO sync_tombstones (seq, table_name, row_id, is_memo)
+                    VALUES ((SELECT seq FROM sync_state), '{table}', OLD.id, {is_memo});
+                END
+            """)
+
+        # テーブルごとの変更バージョン（ETag の元）。トリガーで書き込みのたびに +1 する
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS change_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        for table in VERSIONED_TABLES:
+            await db.execute("INSERT OR IGNORE INTO change_versions (name) VALUES (?)", (table,))
+            for action in ("INSERT", "UPDATE", "DELETE"):
+                await db.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_{action.lower()}_version
+                    AFTER {action} ON {table}
+                    BEGIN
+                        UPDATE change_versions SET version = version + 1 WHERE name = '{table}';
+                    END
+                """)
+
         # 初期値投入
         await db.execute("INSERT OR IGNORE INTO stats (key, value_int) VALUES ('affinity_level', 1)")
         await db.execute("INSERT OR IGNORE INTO stats (key, value_int) VALUES ('affinity_exp', 0)")
@@ -101,6 +321,32 @@ async def init_db():
         await db.commit()
 
 
+async def migrate_memos() -> int:
+    """
+    conversations に残っているメモを memos へ少しずつ移す。移した件数を返す。
+    id はそのまま引き継ぐので、メモの id を覚えている端末や送信箱もそのまま使えるわ。
+    同期の番号が「削除 → 追加」の順になるように、先に消してから入れる。
+    """
+    moved = 0
+    async with aiosqlite.connect(DB_PATH) as db:
+        while True:
+            await db.execute("BEGIN IMMEDIATE")
+            cursor = await db.execute(
+                "SELECT id, title, content, created_at FROM conversations WHERE is_memo = 1 ORDER BY id LIMIT ?",
+                (MEMO_MIGRATION_CHUNK,),
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                await db.rollback()
+                return moved
+            await db.executemany("DELETE FROM conversations WHERE id = ?", [(row[0],) for row in rows])
+            await db.executemany(
+                "INSERT OR REPLACE INTO memos (id, title, content, created_at) VALUES (?, ?, ?, ?)", rows
+            )
+            await db.commit()
+            moved += len(rows)
+
+
 async def get_db():
     """データベース接続を取得する"""
     db = await aiosqlite.connect(DB_PATH)
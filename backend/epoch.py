@@ -0,0 +1,223 @@
+"""
+🕰️ Luna Villa — 日時の正規化
+予定の開始・終了とタスクの期限を、UTC のエポック秒（整数）にそろえる。
+クライアントから来る文字列はタイムゾーン付きだったり無しだったりするので、
+無しの時は行の tz（省略時は settings.TIMEZONE）の時刻として読むわ。
+
+範囲検索・並び替え・リマインダーは、文字列ではなくこの整数カラムを使うこと。
+"""
+
+import re
+from datetime import date, datetime, time
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from config import settings
+from database import get_db
+
+# 埋め戻しで1回のトランザクションに入れる行数
+BACKFILL_CHUNK = 500
+# ISO 以外で入っている古い行の日時（2026/10/20 9:00、2026年10月20日 など）
+_LOOSE_DATETIME = re.compile(
+    r"^\s*(\d{4})[-/.年](\d{1,2})[-/.月](\d{1,2})日?(?:[\sT]*(\d{1,2})[:時](\d{1,2})分?(?::(\d{1,2}))?)?"
+)
+
+
+def zone(name: Optional[str] = None) -> ZoneInfo:
+    """タイムゾーン名 → ZoneInfo。知らない名前なら ValueError。"""
+    try:
+        return ZoneInfo(name or settings.TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"知らないタイムゾーンよ: {name}")
+
+
+def check_timezone(name: Optional[str]) -> Optional[str]:
+    if name is not None:
+        zone(name)
+    return name
+
+
+def check_datetime(value: Optional[str]) -> Optional[str]:
+    """ISO 形式の日時として読めるか（書き込み時の検証用）"""
+    if value is None:
+        return value
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"日時は ISO 形式 (YYYY-MM-DDTHH:MM) にしてね: {value}")
+    return value
+
+
+def check_date(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return value
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"日付は YYYY-MM-DD にしてね: {value}")
+    return value
+
+
+def check_time(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return value
+    try:
+        time.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"時刻は HH:MM にしてね: {value}")
+    return value
+
+
+def to_epoch(value: str, tz: Optional[str] = None) -> int:
+    """ISO 日時文字列 → エポック秒。タイムゾーンが書いてなければ tz の時刻とみなす。"""
+    return local_to_epoch(datetime.fromisoformat(value), tz)
+
+
+def local_to_epoch(dt: datetime, tz: Optional[str] = None) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=zone(tz))
+    return int(dt.timestamp())
+
+
+def wall_clock(ts: float, tz: Optional[str] = None) -> datetime:
+    """エポック秒 → tz での壁時計の時刻（ナイーブ）。繰り返しの展開はこの時刻で行う。"""
+    return datetime.fromtimestamp(ts, zone(tz)).replace(tzinfo=None)
+
+
+def reframe(dt: datetime, from_tz: Optional[str] = None, to_tz: Optional[str] = None) -> datetime:
+    """from_tz の壁時計の時刻（ナイーブ）を、to_tz の壁時計の時刻に直す"""
+    if (from_tz or settings.TIMEZONE) == (to_tz or settings.TIMEZONE):
+        return dt
+    return wall_clock(local_to_epoch(dt, from_tz), to_tz)
+
+
+def due_epoch(due_date: Optional[str], due_time: Optional[str], tz: Optional[str] = None) -> Optional[int]:
+    """タスクの期限。時刻がなければその日の 0:00。"""
+    if not due_date:
+        return None
+    return to_epoch(f"{due_date[:10]}T{due_time or '00:00'}", tz)
+
+
+def event_epochs(start_at: str, end_at: Optional[str], tz: Optional[str] = None) -> tuple[int, Optional[int]]:
+    return to_epoch(start_at, tz), to_epoch(end_at, tz) if end_at else None
+
+
+def day_offset(tz: Optional[str], at: datetime) -> int:
+    """エポック秒をその日の日付にまとめる時に足す秒数（at 時点の UTC オフセット）"""
+    return int(zone(tz).utcoffset(at).total_seconds())
+
+
+# ─── 既存行の埋め戻し ─────────────────────────
+def loose_datetime(value: Optional[str]) -> Optional[datetime]:
+    """ISO で読めなければ、日付（と時刻）の数字だけ拾って読む。それでも駄目なら None。"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.strip())
+    except ValueError:
+        pass
+    match = _LOOSE_DATETIME.match(value)
+    if not match:
+        return None
+    try:
+        return datetime(*(int(part or 0) for part in match.groups()))
+    except ValueError:
+        return None
+
+
+def _loose_event(start_at: str, end_at: Optional[str], tz: str) -> Optional[tuple]:
+    """読めない開始・終了を ISO に書き直した (start_at, end_at, start_ts, end_ts)。開始が読めなければ None。"""
+    start, end = loose_datetime(start_at), loose_datetime(end_at)
+    if start is None:
+        return None
+    start_at, end_at = start.isoformat(), end.isoformat() if end else None
+    return (start_at, end_at, *event_epochs(start_at, end_at, tz))
+
+
+async def backfill() -> dict:
+    """
+    エポックカラムが空の行を、id 順に少しずつ埋める。
+    チャンクごとにコミットするので、途中で止まっても次の起動で続きからやり直せるわ。
+    ISO で読めない古い行は loose_datetime で読めた形に書き直す（読めたものは他の画面と同じに扱える）。
+    それでも読めない行は id を出しておく（一覧には出ないので、直すか消すかして）。
+    """
+    counts = {"events": 0, "tasks": 0, "invalid": 0}
+    invalid_events, invalid_tasks = [], []
+    db = await get_db()
+    try:
+        last_id = 0
+        while True:
+            cursor = await db.execute(
+                "SELECT id, start_at, end_at, tz FROM events WHERE start_ts IS NULL AND id > ? ORDER BY id LIMIT ?",
+                (last_id, BACKFILL_CHUNK),
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            updates = []
+            for event_id, start_at, end_at, tz in rows:
+                tz = tz or settings.TIMEZONE
+                try:
+                    updates.append((start_at, end_at, *event_epochs(start_at, end_at, tz), tz, event_id))
+                    continue
+                except ValueError:
+                    pass
+                try:
+                    fixed = _loose_event(start_at, end_at, tz)
+                except ValueError:
+                    fixed = None
+                if fixed is None:
+                    invalid_events.append(event_id)
+                else:
+                    updates.append((*fixed, tz, event_id))
+            await db.executemany(
+                "UPDATE events SET start_at = ?, end_at = ?, start_ts = ?, end_ts = ?, tz = ? WHERE id = ?", updates
+            )
+            await db.commit()
+            counts["events"] += len(updates)
+            last_id = rows[-1][0]
+
+        last_id = 0
+        while True:
+            cursor = await db.execute(
+                """
+                SELECT id, due_date, due_time, tz FROM tasks
+                WHERE due_ts IS NULL AND due_date IS NOT NULL AND id > ?
+                ORDER BY id LIMIT ?
+                """,
+                (last_id, BACKFILL_CHUNK),
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            updates = []
+            for task_id, due_date, due_time, tz in rows:
+                tz = tz or settings.TIMEZONE
+                try:
+                    updates.append((due_date, due_time, due_epoch(due_date, due_time, tz), tz, task_id))
+                    continue
+                except ValueError:
+                    pass
+                due = loose_datetime(due_date)
+                if due is None:
+                    invalid_tasks.append(task_id)
+                    continue
+                try:
+                    due_time = check_time(due_time)
+                except ValueError:
+                    due_time = None  # 時刻だけ読めなければ、その日の期限にする
+                due_date = due.date().isoformat()
+                updates.append((due_date, due_time, due_epoch(due_date, due_time, tz), tz, task_id))
+            await db.executemany(
+                "UPDATE tasks SET due_date = ?, due_time = ?, due_ts = ?, tz = ? WHERE id = ?", updates
+            )
+            await db.commit()
+            counts["tasks"] += len(updates)
+            last_id = rows[-1][0]
+    finally:
+        await db.close()
+    counts["invalid"] = len(invalid_events) + len(invalid_tasks)
+    if invalid_events:
+        print(f"⚠️ 日時が読めない予定があるわ（一覧に出ないの）: id={invalid_events}")
+    if invalid_tasks:
+        print(f"⚠️ 期限が読めないタスクがあるわ（一覧に出ないの）: id={invalid_tasks}")
+    return counts
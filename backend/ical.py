@@ -0,0 +1,307 @@
+"""
+📆 Luna Villa — iCalendar (RFC 5545) の読み書き
+予定を VEVENT、タスクを VTODO として1件ずつ文字列にしたり、
+届いた .ics を少しずつ読みながら1件ずつ取り出したりする。ファイル全体は持たないわ。
+
+扱うのは普段使いのプロパティだけ（UID/SUMMARY/DESCRIPTION/DTSTART/DTEND/DURATION/DUE/RRULE/EXDATE/STATUS）。
+時刻は書き出しでは予定・タスクの tz を TZID に付けて出し、
+読み込みでは UTC（Z）や TZID 付きのものを settings.TIMEZONE の壁時計に直して扱う。
+"""
+
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional
+from config import settings
+import epoch
+
+PRODID = "-//Luna Villa//Luna Villa Calendar//JA"
+# 1行の上限（オクテット）。超えたら折り返す
+FOLD_OCTETS = 75
+# RRULE のうち、こちらで解釈しない（落としても意味が変わらない）項目
+IGNORED_RRULE_PARTS = ("WKST",)
+
+_DURATION = re.compile(
+    r"^(?P<sign>[+-])?P(?:(?P<weeks>\d+)W)?(?:(?P<days>\d+)D)?"
+    r"(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+)S)?)?$"
+)
+
+
+# ─── 書き出し ─────────────────────────────
+def escape_text(value: str) -> str:
+    return (value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def fold(line: str) -> str:
+    """75オクテットごとに CRLF + 空白で折り返す（UTF-8 の文字の途中では切らない）"""
+    encoded = line.encode("utf-8")
+    if len(encoded) <= FOLD_OCTETS:
+        return line + "\r\n"
+    parts = []
+    start = 0
+    limit = FOLD_OCTETS
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode("utf-8"))
+        start = end
+        limit = FOLD_OCTETS - 1  # 2行目以降は先頭の空白のぶん短く
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def format_datetime(value: str, tz: Optional[str] = None) -> str:
+    """保存している ISO 日時 → 20260203T100000（tz の壁時計）"""
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = epoch.wall_clock(dt.timestamp(), tz)
+    return dt.strftime("%Y%m%dT%H%M%S")
+
+
+def _zoned(name: str, value: str, tz: Optional[str]) -> str:
+    """DTSTART;TZID=Asia/Tokyo:20260203T100000 の形の1行"""
+    return f"{name};TZID={tz or settings.TIMEZONE}:{format_datetime(value, tz)}"
+
+
+def _stamp(value: Optional[str]) -> Optional[str]:
+    """SQLite の CURRENT_TIMESTAMP（UTC）→ 20260203T010000Z"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value).strftime("%Y%m%dT%H%M%SZ")
+
+
+def header() -> str:
+    return "".join(fold(line) for line in (
+        "BEGIN:VCALENDAR", "VERSION:2.0", f"PRODID:{PRODID}", "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:Luna Villa",
+    ))
+
+
+def footer() -> str:
+    return fold("END:VCALENDAR")
+
+
+def vevent(uid: str, title: str, description: str, start_at: str, end_at: Optional[str],
+           rrule: Optional[str], exdates: list[str], created_at: Optional[str], tz: Optional[str] = None) -> str:
+    now = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = ["BEGIN:VEVENT", f"UID:{uid}", f"DTSTAMP:{now}"]
+    if created_at:
+        lines.append(f"CREATED:{_stamp(created_at)}")
+    lines.append(_zoned("DTSTART", start_at, tz))
+    if end_at:
+        lines.append(_zoned("DTEND", end_at, tz))
+    lines.append(f"SUMMARY:{escape_text(title)}")
+    if description:
+        lines.append(f"DESCRIPTION:{escape_text(description)}")
+    if rrule:
+        lines.append(f"RRULE:{rrule.removeprefix('RRULE:')}")
+    for value in exdates:
+        if len(value) <= 10:
+            lines.append(f"EXDATE;VALUE=DATE:{value.replace('-', '')}")
+        else:
+            lines.append(_zoned("EXDATE", value, tz))
+    lines.append("END:VEVENT")
+    return "".join(fold(line) for line in lines)
+
+
+def vtodo(uid: str, title: str, due_date: Optional[str], due_time: Optional[str], is_done: bool,
+          completed_ts: Optional[int], created_at: Optional[str], tz: Optional[str] = None) -> str:
+    now = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = ["BEGIN:VTODO", f"UID:{uid}", f"DTSTAMP:{now}"]
+    if created_at:
+        lines.append(f"CREATED:{_stamp(created_at)}")
+    lines.append(f"SUMMARY:{escape_text(title)}")
+    if due_date and due_time:
+        lines.append(_zoned("DUE", f"{due_date[:10]}T{due_time}", tz))
+    elif due_date:
+        lines.append(f"DUE;VALUE=DATE:{due_date[:10].replace('-', '')}")
+    lines.append(f"STATUS:{'COMPLETED' if is_done else 'NEEDS-ACTION'}")
+    if is_done and completed_ts is not None:
+        lines.append(f"COMPLETED:{datetime.fromtimestamp(completed_ts, timezone.utc).strftime('%Y%m%dT%H%M%SZ')}")
+    lines.append("END:VTODO")
+    return "".join(fold(line) for line in lines)
+
+
+# ─── 読み込み ─────────────────────────────
+def unescape_text(value: str) -> str:
+    result = []
+    chars = iter(value)
+    for ch in chars:
+        if ch == "\\":
+            nxt = next(chars, "")
+            result.append("\n" if nxt in ("n", "N") else nxt)
+        else:
+            result.append(ch)
+    return "".join(result)
+
+
+def parse_content_line(line: str) -> tuple[str, dict, str]:
+    """'DTSTART;TZID=Asia/Tokyo:20260203T100000' → ('DTSTART', {'TZID': 'Asia/Tokyo'}, '20260203T100000')"""
+    # 値の中のコロンではなく、引用符の外で最初のコロンで分ける
+    in_quotes = False
+    for i, ch in enumerate(line):
+        if ch == '"':
+            in_quotes = not in_quotes
+        elif ch == ":" and not in_quotes:
+            head, value = line[:i], line[i + 1:]
+            break
+    else:
+        raise ValueError(f"コロンのない行よ: {line[:40]}")
+    name, *raw_params = head.split(";")
+    params = {}
+    for raw in raw_params:
+        key, _, val = raw.partition("=")
+        params[key.upper()] = val.strip('"')
+    return name.upper(), params, value
+
+
+def parse_datetime(value: str, params: dict, tz: Optional[str] = None) -> tuple[datetime, bool]:
+    """iCalendar の日時 → (tz の壁時計のナイーブ日時, 日付だけか)。知らない TZID はフローティング扱い。"""
+    value = value.strip()
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        return datetime.strptime(value[:8], "%Y%m%d"), True
+    if value.endswith("Z"):
+        dt = datetime.strptime(value[:-1], "%Y%m%dT%H%M%S").replace(tzinfo=timezone.utc)
+        return epoch.wall_clock(dt.timestamp(), tz), False
+    dt = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    if "TZID" in params:
+        try:
+            return epoch.reframe(dt, epoch.zone(params["TZID"]).key, tz), False
+        except ValueError:
+            pass
+    return dt, False
+
+
+def parse_duration(value: str) -> timedelta:
+    match = _DURATION.match(value.strip())
+    if not match:
+        raise ValueError(f"DURATION が読めないわ: {value}")
+    parts = {k: int(v) for k, v in match.groupdict().items() if v and k != "sign"}
+    delta = timedelta(weeks=parts.get("weeks", 0), days=parts.get("days", 0), hours=parts.get("hours", 0),
+                      minutes=parts.get("minutes", 0), seconds=parts.get("seconds", 0))
+    return -delta if match.group("sign") == "-" else delta
+
+
+def clean_rrule(value: str) -> str:
+    parts = [p for p in value.split(";") if p and p.split("=", 1)[0].upper() not in IGNORED_RRULE_PARTS]
+    return ";".join(parts)
+
+
+class Component:
+    """読み取った VEVENT / VTODO 1件。props は名前 → [(params, 値), ...]"""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.props: dict[str, list[tuple[dict, str]]] = {}
+
+    def first(self, name: str) -> Optional[tuple[dict, str]]:
+        values = self.props.get(name)
+        return values[0] if values else None
+
+    def text(self, name: str, default: str = "") -> str:
+        prop = self.first(name)
+        return unescape_text(prop[1]) if prop else default
+
+    def to_event(self) -> dict:
+        """events に入れる形に。DTSTART がなければ ValueError。"""
+        start_prop = self.first("DTSTART")
+        if not start_prop:
+            raise ValueError("DTSTART がない予定よ")
+        start, all_day = parse_datetime(start_prop[1], start_prop[0])
+        end = None
+        if end_prop := self.first("DTEND"):
+            end = parse_datetime(end_prop[1], end_prop[0])[0]
+        elif duration_prop := self.first("DURATION"):
+            end = start + parse_duration(duration_prop[1])
+        elif all_day:
+            end = start + timedelta(days=1)
+
+        exdates = []
+        for params, value in self.props.get("EXDATE", []):
+            for item in value.split(","):
+                dt, is_date = parse_datetime(item, params)
+                exdates.append(dt.date().isoformat() if is_date else dt.isoformat())
+
+        rrule = self.first("RRULE")
+        return {
+            "uid": self.text("UID") or None,
+            "title": self.text("SUMMARY", "(無題)"),
+            "description": self.text("DESCRIPTION"),
+            "start_at": start.isoformat(),
+            "end_at": end.isoformat() if end else None,
+            "rrule": clean_rrule(rrule[1]) if rrule else None,
+            "exdates": exdates,
+        }
+
+    def to_task(self) -> dict:
+        due_date = due_time = None
+        if due_prop := self.first("DUE"):
+            due, is_date = parse_datetime(due_prop[1], due_prop[0])
+            due_date = due.date().isoformat()
+            due_time = None if is_date else due.strftime("%H:%M")
+        return {
+            "uid": self.text("UID") or None,
+            "title": self.text("SUMMARY", "(無題)"),
+            "due_date": due_date,
+            "due_time": due_time,
+            "is_done": self.text("STATUS").upper() == "COMPLETED",
+        }
+
+
+class Parser:
+    """
+    .ics を少しずつ feed() して、閉じた VEVENT / VTODO を順に受け取る。
+    折り返し行は次の行が来るまで確定できないので、最後の1行はいつも持ち越す。
+    """
+
+    def __init__(self):
+        self._pending = ""  # 改行で終わっていない残り
+        self._line: Optional[str] = None  # 折り返しの続きを待っている論理行
+        self._stack: list[str] = []
+        self._current: Optional[Component] = None
+        self.errors = 0
+
+    def feed(self, text: str) -> Iterator[Component]:
+        text = self._pending + text
+        lines = text.split("\n")
+        self._pending = lines.pop()
+        for raw in lines:
+            yield from self._physical_line(raw.rstrip("\r"))
+
+    def close(self) -> Iterator[Component]:
+        if self._pending:
+            yield from self._physical_line(self._pending.rstrip("\r"))
+            self._pending = ""
+        if self._line is not None:
+            line, self._line = self._line, None
+            yield from self._logical_line(line)
+
+    def _physical_line(self, raw: str) -> Iterator[Component]:
+        if raw[:1] in (" ", "\t") and self._line is not None:
+            self._line += raw[1:]
+            return
+        if self._line is not None:
+            yield from self._logical_line(self._line)
+        self._line = raw or None
+
+    def _logical_line(self, line: str) -> Iterator[Component]:
+        try:
+            name, params, value = parse_content_line(line)
+        except ValueError:
+            self.errors += 1
+            return
+        if name == "BEGIN":
+            kind = value.upper()
+            self._stack.append(kind)
+            if kind in ("VEVENT", "VTODO") and self._current is None:
+                self._current = Component(kind)
+        elif name == "END":
+            kind = value.upper()
+            if self._stack and self._stack[-1] == kind:
+                self._stack.pop()
+            if self._current is not None and kind == self._current.kind and kind not in self._stack:
+                component, self._current = self._current, None
+                yield component
+        elif self._current is not None and self._stack[-1] == self._current.kind:
+            # VALARM など入れ子の中身は読み飛ばす
+            self._current.props.setdefault(name, []).append((params, value))
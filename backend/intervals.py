@@ -0,0 +1,255 @@
+"""
+📐 Luna Villa — 予定の期間インデックス
+events の各行が掛かる期間を SQLite の R*Tree（event_spans、エポック分の整数）に入れておき、
+「この時間帯に掛かる予定」を全件なめずに引けるようにする。
+
+- 単発の予定は [開始, 終了) をそのまま入れる
+- 繰り返し予定はシリーズ全体（最初の回〜UNTIL/COUNT の最後の回、無期限なら果てまで）を入れ、
+  引っかかったものだけを期間内に展開する
+- 終了時刻のない予定は CALENDAR_DEFAULT_EVENT_MINUTES 分の長さとみなす
+
+R*Tree で絞れるのは単発の予定と終わりのある繰り返しだけ。無期限の繰り返しは開始以降のどの期間にも
+引っかかるので、検索のたびにその全件を期間内に展開する（件数に比例するコスト。展開結果はメモ化される）。
+
+書き込みは calendar ルーターの insert/update/remove と同じトランザクションで行うこと。
+"""
+
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from config import settings
+from database import get_db
+import recurrence
+import epoch
+
+# event_spans の中身の形式。変えたら上げること（起動時に作り直される）
+# 2: 壁時計の分 → エポック分（予定ごとのタイムゾーンで換算）
+SPAN_VERSION = 2
+# 無期限の繰り返しの終わり（rtree_i32 の上限）
+FOREVER = 2**31 - 1
+# 繰り返し予定の重なりチェックで見る範囲
+CONFLICT_HORIZON = timedelta(days=90)
+# 重なりとして返す件数の上限
+MAX_CONFLICTS = 20
+
+
+def _floor_min(dt: datetime, tz: Optional[str] = None) -> int:
+    """tz の壁時計の時刻 → エポック分（切り捨て）"""
+    return epoch.local_to_epoch(dt, tz) // 60
+
+
+def _ceil_min(dt: datetime, tz: Optional[str] = None) -> int:
+    return -(-epoch.local_to_epoch(dt, tz) // 60)
+
+
+def default_duration() -> timedelta:
+    return timedelta(minutes=settings.CALENDAR_DEFAULT_EVENT_MINUTES)
+
+
+def _duration(start: datetime, end: Optional[datetime]) -> timedelta:
+    return end - start if end and end > start else default_duration()
+
+
+def span_of(start_at: str, end_at: Optional[str], rrule: Optional[str],
+            tz: Optional[str] = None) -> Optional[tuple[int, int]]:
+    """インデックスに入れる (開始分, 終了分)。日時は予定の tz の壁時計として読む。読めなければ None。"""
+    try:
+        start = recurrence.parse_datetime(start_at, tz)
+        end = recurrence.parse_datetime(end_at, tz) if end_at else None
+        duration = _duration(start, end)
+        if not rrule:
+            return _floor_min(start, tz), _ceil_min(start + duration, tz)
+        rule = recurrence.parse_rrule(rrule, tz)
+        if rule.until is not None:
+            last = rule.until
+        elif rule.count is not None:
+            last = start
+            for last in recurrence.iter_occurrences(start, rule, start, datetime.max):
+                pass
+        else:
+            return _floor_min(start, tz), FOREVER
+        first = _floor_min(start, tz)
+    except (ValueError, OverflowError):
+        return None
+    try:
+        return first, min(_ceil_min(last + duration, tz), FOREVER)
+    except (ValueError, OverflowError):
+        return first, FOREVER  # UNTIL が遠すぎる
+
+
+async def index_event(db, event_id: int, start_at: str, end_at: Optional[str], rrule: Optional[str],
+                      tz: Optional[str] = None):
+    span = span_of(start_at, end_at, rrule, tz)
+    if span is None:
+        await unindex_event(db, event_id)
+        return
+    await db.execute(
+        "INSERT OR REPLACE INTO event_spans (id, start_min, end_min) VALUES (?, ?, ?)",
+        (event_id, *span),
+    )
+
+
+async def unindex_event(db, event_id: int):
+    await db.execute("DELETE FROM event_spans WHERE id = ?", (event_id,))
+
+
+async def ensure_index():
+    """
+    起動時にインデックスを events に追いつかせる。
+    形式の版が違えば全部作り直し、同じなら入っていない予定だけ足して、消えた予定の分を外す。
+    （日時が読めない予定は入らないまま。毎回その行だけ読み直すことになるわ）
+    """
+    db = await get_db()
+    try:
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute("SELECT version FROM index_state WHERE name = 'event_spans'")
+        row = await cursor.fetchone()
+        if row is None or row[0] != SPAN_VERSION:
+            await db.execute("DELETE FROM event_spans")
+            cursor = await db.execute("SELECT id, start_at, end_at, rrule, tz FROM events")
+            rebuilt = True
+        else:
+            cursor = await db.execute(
+                """
+                SELECT e.id, e.start_at, e.end_at, e.rrule, e.tz
+                FROM events e LEFT JOIN event_spans s ON s.id = e.id
+                WHERE s.id IS NULL
+                """
+            )
+            rebuilt = False
+        rows = await cursor.fetchall()
+        for event_id, start_at, end_at, rrule, tz in rows:
+            await index_event(db, event_id, start_at, end_at, rrule, tz)
+        cursor = await db.execute("DELETE FROM event_spans WHERE id NOT IN (SELECT id FROM events)")
+        orphans = cursor.rowcount
+        await db.execute(
+            "INSERT OR REPLACE INTO index_state (name, version) VALUES ('event_spans', ?)", (SPAN_VERSION,)
+        )
+        await db.commit()
+        if rebuilt and rows:
+            print(f"📐 予定の期間インデックスを作り直したわ（{len(rows)}件）")
+        elif orphans:
+            print(f"📐 予定の期間インデックスから消えた予定を {orphans} 件外したわ")
+    finally:
+        await db.close()
+
+
+# ─── 検索 ─────────────────────────────────
+async def rows_in_window(db, columns: str, window_start: datetime, window_end: datetime) -> list:
+    """
+    期間（settings.TIMEZONE の壁時計）に掛かる events の行を R*Tree で引く。
+    単発は本当に重なるものだけ（終わりのない予定は開始が期間内のものだけ）、繰り返しはシリーズが掛かるもの。
+    繰り返しを回に展開するのは呼び出し側。
+    """
+    start_ts, end_ts = epoch.local_to_epoch(window_start), epoch.local_to_epoch(window_end)
+    cursor = await db.execute(
+        f"""
+        SELECT {columns}
+        FROM events
+        WHERE id IN (SELECT id FROM event_spans WHERE start_min < ? AND end_min > ?)
+          AND ((rrule IS NOT NULL AND rrule != '') OR (start_ts < ? AND (start_ts >= ? OR end_ts > ?)))
+        """,
+        (_ceil_min(window_end), _floor_min(window_start), end_ts, start_ts, start_ts),
+    )
+    return await cursor.fetchall()
+
+
+async def busy(db, window_start: datetime, window_end: datetime,
+               exclude_id: Optional[int] = None) -> list[dict]:
+    """
+    期間に掛かる予定の回を開始順に返す。期間も結果も settings.TIMEZONE の壁時計。
+    無期限の繰り返しは毎回ここで展開されるので、その件数ぶんの手間は必ずかかるわ。
+    """
+    cursor = await db.execute(
+        """
+        SELECT e.id, e.title, e.start_at, e.end_at, e.rrule, e.exdates, e.tz
+        FROM event_spans s
+        JOIN events e ON e.id = s.id
+        WHERE s.start_min < ? AND s.end_min > ?
+        """,
+        (_ceil_min(window_end), _floor_min(window_start)),
+    )
+    result = []
+    for event_id, title, start_at, end_at, rrule, exdates, tz in await cursor.fetchall():
+        if event_id == exclude_id:
+            continue
+        try:
+            start = recurrence.parse_datetime(start_at, tz)
+            end = recurrence.parse_datetime(end_at, tz) if end_at else None
+            duration = _duration(start, end)
+            if rrule:
+                raw = {"id": event_id, "start_at": start_at, "end_at": end_at, "rrule": rrule,
+                       "exdates": exdates, "tz": tz}
+                starts = [s for s, _ in recurrence.expand_event(raw, window_start - duration, window_end)]
+            else:
+                starts = [epoch.reframe(start, tz)]
+        except ValueError:
+            continue
+        for s in starts:
+            if s < window_end and s + duration > window_start:
+                result.append({"event_id": event_id, "title": title, "start": s, "end": s + duration})
+    result.sort(key=lambda b: b["start"])
+    return result
+
+
+def free_slots(busy_list: list[dict], window_start: datetime, window_end: datetime,
+               min_length: timedelta) -> list[tuple[datetime, datetime]]:
+    """埋まっている回の隙間のうち、min_length 以上あるもの"""
+    slots = []
+    cursor = window_start
+    for b in busy_list:
+        if b["start"] - cursor >= min_length:
+            slots.append((cursor, b["start"]))
+        cursor = max(cursor, b["end"])
+    if window_end - cursor >= min_length:
+        slots.append((cursor, window_end))
+    return slots
+
+
+async def find_conflicts(db, start_at: str, end_at: Optional[str], rrule: Optional[str],
+                         exdates: Optional[list[str]] = None,
+                         exclude_id: Optional[int] = None, tz: Optional[str] = None) -> list[dict]:
+    """
+    これから入れる予定（の各回）と重なる既存の予定の回。繰り返しは先の90日分だけ見る。
+    予定の日時は tz の壁時計で読み、比べるのは settings.TIMEZONE の壁時計にそろえてから。
+    """
+    try:
+        start = recurrence.parse_datetime(start_at, tz)
+        end = recurrence.parse_datetime(end_at, tz) if end_at else None
+        duration = _duration(start, end)
+        if rrule:
+            window_start = max(start, epoch.wall_clock(time.time(), tz))
+            occurrences = [epoch.reframe(occ, tz) for occ in recurrence.iter_occurrences(
+                start, recurrence.parse_rrule(rrule, tz), window_start, window_start + CONFLICT_HORIZON,
+                exdates=recurrence.parse_exdates(exdates, tz),
+            )]
+        else:
+            occurrences = [epoch.reframe(start, tz)]
+    except ValueError:
+        return []
+    if not occurrences:
+        return []
+    window_start, window_end = occurrences[0], occurrences[-1] + duration
+
+    others = await busy(db, window_start, window_end, exclude_id)
+    conflicts = []
+    first = 0
+    for occ in occurrences:
+        occ_end = occ + duration
+        # どちらも開始順なので、もう終わっている既存の回は次から見ない
+        while first < len(others) and others[first]["end"] <= occ:
+            first += 1
+        for other in others[first:]:
+            if other["start"] >= occ_end:
+                break
+            if other["end"] > occ:
+                conflicts.append({
+                    "event_id": other["event_id"],
+                    "title": other["title"],
+                    "start_at": other["start"].isoformat(),
+                    "end_at": other["end"].isoformat(),
+                    "at": occ.isoformat(),
+                })
+                if len(conflicts) >= MAX_CONFLICTS:
+                    return conflicts
+    return conflicts
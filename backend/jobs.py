@@ -0,0 +1,201 @@
+"""
+🧹 Luna Villa — 裏で動く一括処理（ジョブ）
+履歴の全消去みたいな大きな削除を、決まった件数ずつ小分けに消すジョブとして裏で回す。
+1回ぶんのトランザクションが短いので、その間もチャットやカレンダーの書き込みは待たされないわ。
+
+- 進み具合は /api/jobs で見られる（記録はメモリにだけ持つので、再起動したら消える）
+- 消した後の空きページは auto_vacuum=INCREMENTAL で少しずつファイルから返す
+  （既存DBの切り替えは書き込みを止めるので、POST /api/jobs/incremental-vacuum で頼まれた時だけ）
+"""
+
+import asyncio
+import itertools
+import time
+from typing import Awaitable, Callable, Optional
+from config import settings
+from database import get_db
+import versions
+
+# 覚えておく終わったジョブの数
+MAX_FINISHED_JOBS = 50
+
+
+class Job:
+    """1つの一括処理の進み具合"""
+
+    def __init__(self, job_id: int, kind: str):
+        self.id = job_id
+        self.kind = kind
+        self.status = "pending"  # pending | running | done | failed
+        self.total: Optional[int] = None
+        self.done = 0
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "progress": round(self.done / self.total, 3) if self.total else (1.0 if self.status == "done" else 0.0),
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+_jobs: dict[int, Job] = {}
+_ids = itertools.count(1)
+_running: dict[str, Job] = {}  # 種類ごとに同時に1つだけ
+
+
+def start(kind: str, work: Callable[[Job], Awaitable[None]], key: Optional[str] = None) -> Job:
+    """
+    ジョブを裏で始める。同じ key（省略時は kind）のジョブが動いていればそれを返す（二重に走らせない）。
+    """
+    key = key or kind
+    if key in _running:
+        return _running[key]
+    job = Job(next(_ids), kind)
+    _jobs[job.id] = job
+    _running[key] = job
+
+    async def run():
+        job.status = "running"
+        try:
+            await work(job)
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status, job.error = "failed", "キャンセルされたわ"
+            raise
+        except Exception as e:
+            job.status, job.error = "failed", str(e)
+            print(f"⚠️ ジョブ {job.kind}#{job.id} が失敗: {e}")
+        finally:
+            job.finished_at = time.time()
+            _running.pop(key, None)
+            _forget_old()
+
+    job.task = asyncio.create_task(run())
+    return job
+
+
+def _forget_old():
+    finished = [j for j in _jobs.values() if j.finished_at is not None]
+    for job in sorted(finished, key=lambda j: j.finished_at)[:-MAX_FINISHED_JOBS]:
+        del _jobs[job.id]
+
+
+def get(job_id: int) -> Optional[Job]:
+    return _jobs.get(job_id)
+
+
+def recent(limit: int = 20) -> list[dict]:
+    return [j.to_dict() for j in sorted(_jobs.values(), key=lambda j: -j.id)[:limit]]
+
+
+def shutdown():
+    for job in list(_running.values()):
+        if job.task:
+            job.task.cancel()
+
+
+# ─── 小分けの削除 ───────────────────────────
+async def delete_in_batches(table: str, where: str, params: tuple = (), job: Optional[Job] = None,
+                            key: str = "id") -> int:
+    """
+    WHERE に合う行を JOB_DELETE_BATCH 件ずつ、別々のトランザクションで消す。
+    バッチの間で他の処理に順番を譲る。消した件数を返す。
+    """
+    deleted = 0
+    db = await get_db()
+    try:
+        if job is not None:
+            cursor = await db.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}", params)
+            job.total = (await cursor.fetchone())[0]
+        while True:
+            await db.execute("BEGIN IMMEDIATE")
+            cursor = await db.execute(
+                f"DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM {table} WHERE {where} LIMIT ?)",
+                (*params, settings.JOB_DELETE_BATCH),
+            )
+            count = cursor.rowcount
+            await versions.commit(db)
+            deleted += count
+            if job is not None:
+                job.done = deleted
+            if count < settings.JOB_DELETE_BATCH:
+                return deleted
+            await asyncio.sleep(settings.JOB_YIELD_SECONDS)
+    finally:
+        await db.close()
+
+
+# ─── 空きページの返却 ───────────────────────
+async def auto_vacuum_mode() -> int:
+    """0=NONE, 1=FULL, 2=INCREMENTAL"""
+    db = await get_db()
+    try:
+        cursor = await db.execute("PRAGMA auto_vacuum")
+        return (await cursor.fetchone())[0]
+    finally:
+        await db.close()
+
+
+async def enable_incremental_vacuum(job: Optional[Job] = None):
+    """
+    既存DBを auto_vacuum=INCREMENTAL に切り替える（1回だけの VACUUM）。
+    VACUUM は作り直している間ずっと書き込みロックを持つので、その間はチャットの保存もタスクの更新も
+    待たされて、待ちきれなければ busy で失敗する。だから起動時には走らせず、
+    POST /api/jobs/incremental-vacuum で頼まれた時だけジョブとして回すわ。
+    """
+    db = await get_db()
+    try:
+        cursor = await db.execute("PRAGMA auto_vacuum")
+        if (await cursor.fetchone())[0] == 2:
+            return
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute("VACUUM")
+    finally:
+        await db.close()
+
+
+async def incremental_vacuum() -> int:
+    """空きページを少しずつファイルから返す。返したページ数。"""
+    released = 0
+    db = await get_db()
+    try:
+        cursor = await db.execute("PRAGMA auto_vacuum")
+        if (await cursor.fetchone())[0] != 2:
+            return 0
+        while True:
+            cursor = await db.execute("PRAGMA freelist_count")
+            free = (await cursor.fetchone())[0]
+            if not free:
+                return released
+            # execute だと1ステップ（1ページ）しか進まないので、executescript で最後まで回す
+            await db.executescript(f"PRAGMA incremental_vacuum({settings.VACUUM_PAGES_PER_STEP})")
+            cursor = await db.execute("PRAGMA freelist_count")
+            left = (await cursor.fetchone())[0]
+            if left >= free:
+                return released
+            released += free - left
+            await asyncio.sleep(settings.JOB_YIELD_SECONDS)
+    finally:
+        await db.close()
+
+
+async def vacuum_loop():
+    """起動中ずっと、一定間隔で空きページを返す"""
+    while True:
+        try:
+            released = await incremental_vacuum()
+            if released:
+                print(f"🧹 空きページを {released} ページ返したわ")
+        except Exception as e:
+            print(f"⚠️ incremental_vacuum に失敗: {e}")
+        await asyncio.sleep(settings.VACUUM_INTERVAL_HOURS * 3600)
@@ -3,19 +3,54 @@
 るなの別荘のバックエンド。
 """
 
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from database import init_db
-from routers import auth, chat, history, memos, calendar, tasks, stt, stats, diary
+from database import init_db, migrate_memos
+import audio_prep
+import versions
+import reminders
+import intervals
+import epoch
+import completions
+import autocomplete
+import jobs
+from routers import auth, chat, history, memos, calendar, tasks, stt, stats, diary, agenda, sync, ics, suggest
+from routers import jobs as jobs_router
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """起動時にDBを初期化する"""
     await init_db()
+    if moved := await migrate_memos():
+        print(f"📌 メモを専用のテーブルへ {moved} 件引っ越したわ")
+    await versions.load()
+    filled = await epoch.backfill()
+    if filled["events"] or filled["tasks"]:
+        print(f"🕰️ 日時の整数カラムを埋めたわ: {filled}")
+    if converted := await completions.backfill():
+        print(f"🏆 完了時刻を {converted} 件そろえ直したわ")
+    if rebuilt := await completions.rebuild():
+        print(f"🏆 タスク完了の集計を作り直したわ（{rebuilt}日分）")
+    await intervals.ensure_index()
+    compactor = asyncio.create_task(sync.compaction_loop())
+    scheduler = asyncio.create_task(reminders.run())
+    # 入力補完の候補は裏で組み立てる（間に合わなければ最初の検索が待つ）
+    warmup = asyncio.create_task(autocomplete.ensure_loaded())
+    if await jobs.auto_vacuum_mode() != 2:
+        # VACUUM の間は書き込みが全部止まるので、勝手には始めない
+        print("🧹 空きページを返すには一度 POST /api/jobs/incremental-vacuum を実行して（その間は書き込みが止まるわ）")
+    vacuum = asyncio.create_task(jobs.vacuum_loop())
     print("🌙 Luna Villa サーバー起動！ るなの別荘へようこそ♡")
     yield
+    compactor.cancel()
+    scheduler.cancel()
+    warmup.cancel()
+    vacuum.cancel()
+    jobs.shutdown()
+    audio_prep.shutdown()
     print("🌙 Luna Villa サーバー停止。おやすみなさい♡")
 
 
@@ -40,11 +75,16 @@ app.include_router(auth.router)
 app.include_router(chat.router)
 app.include_router(history.router)
 app.include_router(memos.router)
+app.include_router(ics.router)
 app.include_router(calendar.router)
 app.include_router(tasks.router)
 app.include_router(stt.router)
 app.include_router(stats.router)
 app.include_router(diary.router)
+app.include_router(agenda.router)
+app.include_router(sync.router)
+app.include_router(suggest.router)
+app.include_router(jobs_router.router)
 
 
 # ─── デバッグログ受信 ────────────────────────
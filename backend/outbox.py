@@ -0,0 +1,121 @@
+"""
+📮 Luna Villa — メモの送信箱（アウトボックス）
+メモの追加・更新・削除・「PCに送る」を、連番（seq）つきで memo_outbox に積んでおく。
+PC側はフィードから since= 以降を受け取り、処理し終えたところまで ack する。
+
+- 積むのはメモの書き込みと同じトランザクション。コミットされたものだけが配られるわ
+- 配達は「少なくとも1回」。ack する前に落ちたら、次はまた同じところから受け取る
+- 全員が ack し終わって、MEMO_OUTBOX_RETENTION_DAYS 日より古いものは掃除する
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+from config import settings
+from database import get_db
+import jobs
+
+# フィード1回で返す件数の上限
+MAX_BATCH = 500
+
+_changed = asyncio.Event()
+
+
+async def enqueue(db, memo_id: int, event: str, title: Optional[str] = None, content: Optional[str] = None) -> int:
+    """送信箱に1件積む。コミットは呼び出し側、コミットしたら notify() を呼ぶこと。"""
+    cursor = await db.execute(
+        "INSERT INTO memo_outbox (memo_id, event, title, content) VALUES (?, ?, ?, ?)",
+        (memo_id, event, title, content),
+    )
+    return cursor.lastrowid
+
+
+def notify():
+    """待っているフィードを起こす"""
+    global _changed
+    _changed.set()
+    _changed = asyncio.Event()
+
+
+async def acked_seq(db, consumer: str) -> int:
+    cursor = await db.execute("SELECT acked_seq FROM outbox_consumers WHERE name = ?", (consumer,))
+    row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def fetch(since: int, limit: int) -> tuple[list[dict], bool]:
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            """
+            SELECT seq, memo_id, event, title, content, created_at
+            FROM memo_outbox WHERE seq > ? ORDER BY seq LIMIT ?
+            """,
+            (since, limit + 1),
+        )
+        rows = await cursor.fetchall()
+    finally:
+        await db.close()
+    items = [
+        {"seq": r[0], "memo_id": r[1], "event": r[2], "title": r[3], "content": r[4], "created_at": r[5]}
+        for r in rows[:limit]
+    ]
+    return items, len(rows) > limit
+
+
+async def wait_for(since: int, limit: int, timeout: float) -> tuple[list[dict], bool]:
+    """since より後のものが来るまで最大 timeout 秒待つ（ロングポーリング）"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        changed = _changed
+        items, has_more = await fetch(since, limit)
+        remaining = deadline - asyncio.get_running_loop().time()
+        if items or remaining <= 0:
+            return items, has_more
+        try:
+            await asyncio.wait_for(changed.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def latest_seq(db) -> int:
+    """これまでに配った一番新しい seq（掃除で消えた分も含む）"""
+    cursor = await db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'memo_outbox'")
+    row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def ack(consumer: str, seq: int) -> int:
+    """
+    consumer がここまで処理した、と記録する（戻ることはない）。記録後の値を返す。
+    まだ配っていない seq は ValueError（先の分まで飛ばされて、掃除で消されてしまうので）。
+    """
+    db = await get_db()
+    try:
+        latest = await latest_seq(db)
+        if seq > latest:
+            raise ValueError(f"seq {seq} はまだ配ってないわ（いまは {latest} まで）")
+        await db.execute(
+            """
+            INSERT INTO outbox_consumers (name, acked_seq, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(name) DO UPDATE SET
+                acked_seq = MAX(acked_seq, excluded.acked_seq),
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            (consumer, seq),
+        )
+        await db.commit()
+        return await acked_seq(db, consumer)
+    finally:
+        await db.close()
+
+
+async def prune() -> int:
+    """全員が受け取り済みで、保持期間を過ぎたものを消す"""
+    cutoff = datetime.utcnow() - timedelta(days=settings.MEMO_OUTBOX_RETENTION_DAYS)
+    return await jobs.delete_in_batches(
+        "memo_outbox",
+        "seq <= (SELECT COALESCE(MIN(acked_seq), 0) FROM outbox_consumers) AND created_at < ?",
+        (cutoff.strftime("%Y-%m-%d %H:%M:%S"),),
+        key="seq",
+    )
@@ -0,0 +1,240 @@
+"""
+🔁 Luna Villa — 繰り返し予定の展開エンジン
+RRULE のサブセットを解釈して、頼まれた期間の分だけ発生日時を遅延生成する。
+
+対応: FREQ=DAILY|WEEKLY|MONTHLY|YEARLY, INTERVAL, COUNT, UNTIL, BYDAY(WEEKLY), BYMONTHDAY(MONTHLY)
+例外日（exdates）に当たる回は飛ばす。
+
+何年続くシリーズでも、期間の手前までは周期の計算で一気に読み飛ばすので、
+生成するのは期間内の回だけ。展開結果はイベント内容ごとにメモ化する。
+"""
+
+import calendar as _calendar
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional
+import epoch
+
+FREQS = ("DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+# 異常なルールで延々と回らないための安全弁
+MAX_PERIODS = 100_000
+EXPANSION_CACHE_SIZE = 512
+
+
+class RecurrenceRule:
+    """パース済みのRRULE"""
+
+    def __init__(self, freq: str, interval: int = 1, count: Optional[int] = None,
+                 until: Optional[datetime] = None, byday: Optional[list[int]] = None,
+                 bymonthday: Optional[list[int]] = None):
+        self.freq = freq
+        self.interval = interval
+        self.count = count
+        self.until = until
+        self.byday = byday
+        self.bymonthday = bymonthday
+
+
+def parse_datetime(value: str, tz: Optional[str] = None) -> datetime:
+    """ISO形式の日時をナイーブな日時にする（タイムゾーン付きなら tz の壁時計の時刻に直す）"""
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = epoch.wall_clock(dt.timestamp(), tz)
+    return dt
+
+
+def parse_rrule(text: str, tz: Optional[str] = None) -> RecurrenceRule:
+    """'FREQ=WEEKLY;BYDAY=MO,WE' のような文字列をパースする。扱えなければ ValueError。"""
+    parts = {}
+    for item in text.strip().removeprefix("RRULE:").split(";"):
+        if not item:
+            continue
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"RRULEの書式が変よ: {item}")
+        parts[key.strip().upper()] = value.strip()
+
+    freq = parts.pop("FREQ", "").upper()
+    if freq not in FREQS:
+        raise ValueError(f"FREQ は {'/'.join(FREQS)} のどれかにして: {freq or '(なし)'}")
+
+    rule = RecurrenceRule(freq)
+    if "INTERVAL" in parts:
+        rule.interval = int(parts.pop("INTERVAL"))
+        if rule.interval < 1:
+            raise ValueError("INTERVAL は1以上にして")
+    if "COUNT" in parts:
+        rule.count = int(parts.pop("COUNT"))
+        if rule.count < 1:
+            raise ValueError("COUNT は1以上にして")
+    if "UNTIL" in parts:
+        until = parts.pop("UNTIL")
+        if "T" in until and "-" not in until:
+            rule.until = datetime.strptime(until.rstrip("Z"), "%Y%m%dT%H%M%S")
+            if until.endswith("Z"):
+                # UTC で書かれた UNTIL は予定のタイムゾーンの壁時計に直す
+                rule.until = epoch.wall_clock(rule.until.replace(tzinfo=timezone.utc).timestamp(), tz)
+        elif len(until) == 8:
+            rule.until = datetime.strptime(until, "%Y%m%d").replace(hour=23, minute=59, second=59)
+        else:
+            rule.until = parse_datetime(until, tz)
+    if "BYDAY" in parts:
+        if freq != "WEEKLY":
+            raise ValueError("BYDAY は FREQ=WEEKLY の時だけ使えるわ")
+        try:
+            rule.byday = sorted({WEEKDAYS.index(d.strip().upper()) for d in parts.pop("BYDAY").split(",")})
+        except ValueError:
+            raise ValueError("BYDAY は MO,TU,WE,TH,FR,SA,SU で書いて")
+    if "BYMONTHDAY" in parts:
+        if freq != "MONTHLY":
+            raise ValueError("BYMONTHDAY は FREQ=MONTHLY の時だけ使えるわ")
+        days = [int(d) for d in parts.pop("BYMONTHDAY").split(",")]
+        if any(d == 0 or not -31 <= d <= 31 for d in days):
+            raise ValueError("BYMONTHDAY は 1〜31 か -1〜-31 にして")
+        rule.bymonthday = sorted(set(days))
+    if parts:
+        raise ValueError(f"対応していない項目よ: {', '.join(parts)}")
+    return rule
+
+
+# ─── 周期ごとの候補 ─────────────────────────
+def _add_months(year: int, month: int, n: int) -> tuple[int, int]:
+    total = year * 12 + (month - 1) + n
+    return total // 12, total % 12 + 1
+
+
+def _period_candidates(rule: RecurrenceRule, start: datetime, p: int) -> list[datetime]:
+    """p 番目の周期に含まれる候補日時（start より前のものも含む）"""
+    step = p * rule.interval
+    if rule.freq == "DAILY":
+        return [start + timedelta(days=step)]
+    if rule.freq == "WEEKLY":
+        monday = start - timedelta(days=start.weekday()) + timedelta(weeks=step)
+        days = rule.byday if rule.byday is not None else [start.weekday()]
+        return [monday + timedelta(days=d) for d in days]
+    if rule.freq == "MONTHLY":
+        year, month = _add_months(start.year, start.month, step)
+        last = _calendar.monthrange(year, month)[1]
+        result = []
+        for d in rule.bymonthday or [start.day]:
+            day = d if d > 0 else last + 1 + d
+            if 1 <= day <= last:  # 存在しない日（2/30 など）は飛ばす
+                result.append(start.replace(year=year, month=month, day=day))
+        return sorted(result)
+    # YEARLY
+    try:
+        return [start.replace(year=start.year + step)]
+    except ValueError:  # 2/29 は閏年だけ
+        return []
+
+
+def _per_period(rule: RecurrenceRule, start: datetime) -> Optional[int]:
+    """どの周期でも候補数が同じならその数。月末・閏年で変わるなら None。"""
+    if rule.freq == "DAILY":
+        return 1
+    if rule.freq == "WEEKLY":
+        return len(rule.byday) if rule.byday is not None else 1
+    if rule.freq == "MONTHLY":
+        days = rule.bymonthday or [start.day]
+        return len(days) if all(-28 <= d <= 28 for d in days) else None
+    return None if (start.month, start.day) == (2, 29) else 1
+
+
+def _first_period(rule: RecurrenceRule, start: datetime, at: datetime) -> int:
+    """at を含みうる最初の周期番号（少し手前を返すのは構わない）"""
+    if at <= start:
+        return 0
+    if rule.freq == "DAILY":
+        return max(0, (at - start).days // rule.interval - 1)
+    if rule.freq == "WEEKLY":
+        return max(0, (at - start).days // (7 * rule.interval) - 1)
+    months = (at.year - start.year) * 12 + (at.month - start.month)
+    if rule.freq == "MONTHLY":
+        return max(0, months // rule.interval - 1)
+    return max(0, months // 12 // rule.interval - 1)
+
+
+def iter_occurrences(start: datetime, rule: RecurrenceRule, window_start: datetime,
+                     window_end: datetime, duration: timedelta = timedelta(0),
+                     exdates: frozenset = frozenset()) -> Iterator[datetime]:
+    """期間 [window_start, window_end) に掛かる回の開始日時を順に返す"""
+    # 期間より前に始まって期間に食い込む回も拾う
+    seek = window_start - duration
+    per_period = _per_period(rule, start)
+
+    if rule.count is None or per_period is not None:
+        first = _first_period(rule, start, seek)
+        # 読み飛ばした周期で消費した回数（COUNT 用）
+        skipped = sum(1 for c in _period_candidates(rule, start, 0) if c < start)
+        index = first * per_period - skipped if first and per_period else 0
+    else:
+        first, index = 0, 0  # 周期ごとの回数が一定でないので、COUNT は頭から数える
+
+    for p in range(first, first + MAX_PERIODS):
+        for occurrence in _period_candidates(rule, start, p):
+            if occurrence < start:
+                continue
+            if rule.until is not None and occurrence > rule.until:
+                return
+            if rule.count is not None and index >= rule.count:
+                return
+            index += 1
+            if occurrence >= window_end:
+                return
+            if occurrence + duration <= window_start and not (duration == timedelta(0) and occurrence == window_start):
+                continue
+            if occurrence in exdates or occurrence.date() in exdates:
+                continue
+            yield occurrence
+
+
+# ─── 展開キャッシュ ─────────────────────────
+_expansions: "OrderedDict[tuple, list[tuple[datetime, Optional[datetime]]]]" = OrderedDict()
+
+
+def invalidate(event_id: int):
+    """イベントが編集・削除されたら、そのイベントの展開結果を捨てる"""
+    for key in [k for k in _expansions if k[0] == event_id]:
+        del _expansions[key]
+
+
+def parse_exdates(values, tz: Optional[str] = None) -> frozenset:
+    result = set()
+    for value in values or []:
+        dt = parse_datetime(value, tz)
+        # 日付だけなら「その日の回は全部休み」
+        result.add(dt.date() if len(value) <= 10 else dt)
+    return frozenset(result)
+
+
+def expand_event(event: dict, window_start: datetime, window_end: datetime) -> list[tuple[datetime, Optional[datetime]]]:
+    """
+    繰り返しイベント1件を期間内の (開始, 終了) に展開する。
+    event は events テーブルの行（exdates はJSON配列の文字列、tz は予定のタイムゾーン）。
+    期間と結果は settings.TIMEZONE の壁時計。回の計算は予定の tz の壁時計で行うわ。
+    キーにイベントの中身も含めるので、invalidate し忘れても古い結果は返らないわ。
+    """
+    tz = event.get("tz")
+    key = (event["id"], event["start_at"], event["end_at"], event["rrule"], event["exdates"], tz,
+           window_start, window_end)
+    if key in _expansions:
+        _expansions.move_to_end(key)
+        return _expansions[key]
+
+    start = parse_datetime(event["start_at"], tz)
+    end = parse_datetime(event["end_at"], tz) if event["end_at"] else None
+    duration = end - start if end and end > start else timedelta(0)
+    exdates = parse_exdates(json.loads(event["exdates"] or "[]"), tz)
+
+    result = [
+        (epoch.reframe(occurrence, tz), epoch.reframe(occurrence + duration, tz) if end else None)
+        for occurrence in iter_occurrences(start, parse_rrule(event["rrule"], tz),
+                                           epoch.reframe(window_start, None, tz),
+                                           epoch.reframe(window_end, None, tz), duration, exdates)
+    ]
+    _expansions[key] = result
+    if len(_expansions) > EXPANSION_CACHE_SIZE:
+        _expansions.popitem(last=False)
+    return result
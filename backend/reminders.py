@@ -0,0 +1,295 @@
+"""
+⏰ Luna Villa — リマインダー・スケジューラー
+これから来るタスクの期限と予定の開始を優先度つきキュー（heapq）に積んでおき、
+時間が来たら接続中の端末へ push する。
+
+- 起動時に一度だけ読み込んで、あとは CRUD のたびに該当の1件だけ積み直す（テーブルを定期的に舐めない）
+- 取り消しは辞書から外すだけ。キューに残った古い項目は取り出した時に捨てる
+- 繰り返し予定は「次の1回」だけを積み、鳴らしたら次の回を積む
+- 誰も繋がっていない間に鳴った分は少しの間取っておいて、繋がった端末に送り直す
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from config import settings
+from database import get_db
+import recurrence
+import epoch
+
+# 繰り返し予定の「次の回」を探す範囲
+RECURRENCE_HORIZON = timedelta(days=400)
+# 1端末ぶんの送信待ちの上限（溢れたら古い端末側の問題なので捨てる）
+SUBSCRIBER_QUEUE_SIZE = 100
+# 時計が飛んでも気づけるように、最低この間隔で起きる
+MAX_SLEEP_SECONDS = 60
+
+
+class Reminder:
+    """キューに積む1件"""
+
+    def __init__(self, kind: str, item_id: int, title: str, at: datetime, fire_at: datetime,
+                 source: Optional[dict] = None):
+        self.kind = kind  # "task" | "event"
+        self.item_id = item_id
+        self.title = title
+        self.at = at  # 期限・開始の時刻（予定・タスクのタイムゾーン付き）
+        self.fire_at = fire_at  # 鳴らす時刻（同上）
+        self.source = source  # 繰り返し予定の行（次の回の計算用）
+
+    @property
+    def key(self) -> tuple[str, int]:
+        return (self.kind, self.item_id)
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "id": self.item_id,
+            "title": self.title,
+            "at": self.at.isoformat(),
+            "fire_at": self.fire_at.isoformat(),
+        }
+
+
+_heap: list[tuple[float, int, Reminder]] = []
+_pending: dict[tuple[str, int], Reminder] = {}
+_counter = itertools.count()
+_wake: Optional[asyncio.Event] = None
+_subscribers: set[asyncio.Queue] = set()
+_recent: deque = deque(maxlen=SUBSCRIBER_QUEUE_SIZE)
+_fired_count = 0
+
+
+# ─── 行 → リマインダー ───────────────────────
+def _grace_start() -> datetime:
+    """これより前に鳴るはずだった分は諦める"""
+    return datetime.now(timezone.utc) - timedelta(minutes=settings.REMINDER_REPLAY_MINUTES)
+
+
+def reminder_for_task(row) -> Optional[Reminder]:
+    """tasks の (id, title, due_date, due_time, is_done, due_ts, tz) から。期限がない・完了済みなら None。"""
+    task_id, title, due_date, due_time, is_done, due_ts, tz = row
+    if is_done or due_ts is None:
+        return None
+    try:
+        at = datetime.fromtimestamp(due_ts, epoch.zone(tz))
+    except ValueError:
+        return None
+    if due_time:
+        fire_at = at - timedelta(minutes=settings.REMINDER_LEAD_MINUTES)
+    else:
+        # 時刻のないタスクは、その日の決まった時間にお知らせ
+        hour, minute = map(int, settings.REMINDER_TASK_DEFAULT_TIME.split(":"))
+        at = fire_at = at + timedelta(hours=hour, minutes=minute)
+    if fire_at < _grace_start():
+        return None
+    return Reminder("task", task_id, title, at, fire_at)
+
+
+def reminder_for_event(row, after: Optional[datetime] = None) -> Optional[Reminder]:
+    """events の (id, title, start_at, end_at, rrule, exdates, start_ts, tz) から。after より後の回を探す。"""
+    event_id, title, start_at, end_at, rrule, exdates, start_ts, tz = row
+    lead = timedelta(minutes=settings.REMINDER_LEAD_MINUTES)
+    try:
+        if not rrule:
+            if start_ts is None:
+                return None
+            at = datetime.fromtimestamp(start_ts, epoch.zone(tz))
+            source = None
+        else:
+            source = {"id": event_id, "start_at": start_at, "end_at": None, "rrule": rrule, "exdates": exdates,
+                      "start_ts": start_ts, "tz": tz}
+            # 鳴らした回のすぐ後から、初回は「今から鳴らしても間に合う回」から探す。
+            # 繰り返しの回は予定のタイムゾーンの壁時計で展開する
+            window_start = epoch.wall_clock((after or _grace_start() + lead).timestamp(), tz)
+            if after:
+                window_start += timedelta(microseconds=1)
+            occurrence = next(
+                iter(recurrence.iter_occurrences(
+                    recurrence.parse_datetime(start_at, tz), recurrence.parse_rrule(rrule, tz),
+                    window_start, window_start + RECURRENCE_HORIZON,
+                    exdates=recurrence.parse_exdates(json.loads(exdates or "[]"), tz),
+                )),
+                None,
+            )
+            if occurrence is None:
+                return None
+            at = datetime.fromtimestamp(epoch.local_to_epoch(occurrence, tz), epoch.zone(tz))
+    except ValueError:
+        return None
+    fire_at = at - lead
+    if fire_at < _grace_start() or (after and at <= after):
+        return None
+    return Reminder("event", event_id, title, at, fire_at, source and {**source, "title": title})
+
+
+# ─── キュー操作 ─────────────────────────────
+def schedule(reminder: Optional[Reminder]):
+    if reminder is None:
+        return
+    _pending[reminder.key] = reminder
+    heapq.heappush(_heap, (reminder.fire_at.timestamp(), next(_counter), reminder))
+    # 取り消し済みの残骸が増えすぎたら作り直す
+    if len(_heap) > 2 * len(_pending) + 64:
+        _heap[:] = [entry for entry in _heap if _pending.get(entry[2].key) is entry[2]]
+        heapq.heapify(_heap)
+    if _wake:
+        _wake.set()
+
+
+def unschedule(kind: str, item_id: int):
+    _pending.pop((kind, item_id), None)
+
+
+async def refresh(kind: str, item_id: int):
+    """1件読み直して積み直す（なくなっていれば外す）。CRUD のコミット後に呼ぶこと。"""
+    db = await get_db()
+    try:
+        if kind == "task":
+            cursor = await db.execute(
+                "SELECT id, title, due_date, due_time, is_done, due_ts, tz FROM tasks WHERE id = ?", (item_id,)
+            )
+            row = await cursor.fetchone()
+            reminder = reminder_for_task(row) if row else None
+        else:
+            cursor = await db.execute(
+                "SELECT id, title, start_at, end_at, rrule, exdates, start_ts, tz FROM events WHERE id = ?",
+                (item_id,),
+            )
+            row = await cursor.fetchone()
+            reminder = reminder_for_event(row) if row else None
+    finally:
+        await db.close()
+    unschedule(kind, item_id)
+    schedule(reminder)
+
+
+async def refresh_many(kind: str, item_ids: list[int]):
+    """まとめて書き込んだ後用。1本のクエリで読み直して積み直す。"""
+    if not item_ids:
+        return
+    placeholders = ",".join("?" * len(item_ids))
+    db = await get_db()
+    try:
+        if kind == "task":
+            cursor = await db.execute(
+                f"SELECT id, title, due_date, due_time, is_done, due_ts, tz FROM tasks WHERE id IN ({placeholders})",
+                item_ids,
+            )
+            make = reminder_for_task
+        else:
+            cursor = await db.execute(
+                f"SELECT id, title, start_at, end_at, rrule, exdates, start_ts, tz FROM events "
+                f"WHERE id IN ({placeholders})",
+                item_ids,
+            )
+            make = reminder_for_event
+        rows = await cursor.fetchall()
+    finally:
+        await db.close()
+    for item_id in item_ids:
+        unschedule(kind, item_id)
+    for row in rows:
+        schedule(make(row))
+
+
+async def load():
+    """起動時に、これから来る分を全部積む"""
+    # 時刻のないタスクは当日のうちに鳴るので、1日ぶん手前から拾う
+    since = int((_grace_start() - timedelta(days=1)).timestamp())
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            """
+            SELECT id, title, due_date, due_time, is_done, due_ts, tz FROM tasks
+            WHERE is_done = 0 AND due_ts >= ?
+            """,
+            (since,),
+        )
+        for row in await cursor.fetchall():
+            schedule(reminder_for_task(row))
+        cursor = await db.execute(
+            """
+            SELECT id, title, start_at, end_at, rrule, exdates, start_ts, tz FROM events
+            WHERE start_ts >= ? OR (rrule IS NOT NULL AND rrule != '')
+            """,
+            (since,),
+        )
+        for row in await cursor.fetchall():
+            schedule(reminder_for_event(row))
+    finally:
+        await db.close()
+
+
+# ─── 配信 ─────────────────────────────────
+def subscribe() -> asyncio.Queue:
+    """push を受け取るキューを登録する。取りこぼした直近の分も入れておくわ。"""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    since = _grace_start()
+    for reminder in _recent:
+        if reminder.fire_at >= since:
+            queue.put_nowait(reminder.to_dict())
+    _subscribers.add(queue)
+    return queue
+
+
+def unsubscribe(queue: asyncio.Queue):
+    _subscribers.discard(queue)
+
+
+def _fire(reminder: Reminder):
+    global _fired_count
+    _fired_count += 1
+    payload = reminder.to_dict()
+    if _subscribers:
+        for queue in _subscribers:
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                pass
+    else:
+        _recent.append(reminder)
+    # 繰り返し予定は次の回を積む
+    if reminder.source:
+        source = reminder.source
+        schedule(reminder_for_event(
+            (source["id"], source["title"], source["start_at"], None, source["rrule"], source["exdates"],
+             source["start_ts"], source["tz"]),
+            after=reminder.at,
+        ))
+
+
+async def run():
+    """lifespan で起動する本体。キューの先頭の時刻まで眠って、来たら鳴らす。"""
+    global _wake
+    _wake = asyncio.Event()
+    await load()
+    print(f"⏰ リマインダーを {len(_pending)} 件セットしたわ")
+    while True:
+        _wake.clear()
+        now = time.time()
+        while _heap and _heap[0][0] <= now:
+            _, _, reminder = heapq.heappop(_heap)
+            if _pending.get(reminder.key) is reminder:
+                del _pending[reminder.key]
+                _fire(reminder)
+        timeout = min(_heap[0][0] - now, MAX_SLEEP_SECONDS) if _heap else MAX_SLEEP_SECONDS
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+
+def upcoming(limit: int = 50) -> list[dict]:
+    """これから鳴るリマインダーを早い順に limit 件（/api/agenda/reminders 用）"""
+    return [r.to_dict() for r in heapq.nsmallest(limit, _pending.values(), key=lambda r: r.fire_at)]
+
+
+def get_metrics() -> dict:
+    """スケジューラーの状態。heap が pending よりずっと多いなら、取り消し済みの古い項目が溜まっているわ"""
+    return {"pending": len(_pending), "heap": len(_heap), "subscribers": len(_subscribers), "fired": _fired_count}
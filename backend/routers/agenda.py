@@ -0,0 +1,85 @@
+"""
+🗓️ Luna Villa — アジェンダAPI
+期間内の予定とタスクを日ごとにまとめて返す。日・週ビューは1往復で描けるわ。
+これから鳴るリマインダーの一覧も出せる。
+"""
+
+from datetime import date, datetime, timedelta
+from fastapi import APIRouter, Depends, Query, HTTPException
+from database import get_db
+from routers.auth import verify_token
+import versions
+import epoch
+import intervals
+import reminders
+from routers.calendar import EVENT_COLUMNS, covered_days, expand_rows
+from routers.tasks import TASK_COLUMNS, row_to_task
+
+router = APIRouter(prefix="/api/agenda", tags=["アジェンダ"])
+
+MAX_RANGE_DAYS = 62
+
+
+@router.get("")
+async def get_agenda(
+    from_: str = Query(..., alias="from", description="開始日 (YYYY-MM-DD)"),
+    to: str = Query(..., description="終了日 (YYYY-MM-DD、この日も含む)"),
+    show_done: bool = Query(True),
+    _=Depends(verify_token),
+    _etag=versions.conditional("events", "tasks"),
+):
+    """期間内の予定とタスクを日ごとにまとめて取得する"""
+    try:
+        first, last = date.fromisoformat(from_), date.fromisoformat(to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日付は YYYY-MM-DD で指定して")
+    if last < first or (last - first).days >= MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"期間は {MAX_RANGE_DAYS} 日以内にして")
+
+    window_start = datetime.combine(first, datetime.min.time())
+    window_end = window_start + timedelta(days=(last - first).days + 1)
+    start_ts, end_ts = epoch.local_to_epoch(window_start), epoch.local_to_epoch(window_end)
+
+    db = await get_db()
+    try:
+        # 予定とタスクを同じスナップショットから読む
+        await db.execute("BEGIN")
+        event_rows = await intervals.rows_in_window(db, EVENT_COLUMNS, window_start, window_end)
+
+        query = f"""
+            SELECT {TASK_COLUMNS}, t.due_ts
+            FROM tasks t
+            LEFT JOIN events e ON t.event_id = e.id
+            WHERE t.due_ts >= ? AND t.due_ts < ?
+        """
+        if not show_done:
+            query += " AND t.is_done = 0"
+        query += " ORDER BY t.due_ts ASC, t.created_at ASC"
+        cursor = await db.execute(query, (start_ts, end_ts))
+        task_rows = await cursor.fetchall()
+        await db.commit()
+    finally:
+        await db.close()
+
+    days = {
+        (first + timedelta(days=i)).isoformat(): {"events": [], "tasks": []}
+        for i in range((last - first).days + 1)
+    }
+    for event in expand_rows(event_rows, window_start, window_end):
+        for d in covered_days(event, first, last):
+            days[d]["events"].append(event)
+    for row in task_rows:
+        # 期限はタスクごとのタイムゾーンの日付なので、期間と同じ設定のタイムゾーンの日付に直して振り分ける
+        days[epoch.wall_clock(row[-1]).date().isoformat()]["tasks"].append(row_to_task(row))
+
+    return {
+        "from": first.isoformat(),
+        "to": last.isoformat(),
+        "days": [{"date": d, **items} for d, items in days.items()],
+    }
+
+
+@router.get("/reminders")
+async def get_upcoming_reminders(limit: int = Query(50, ge=1, le=200), _=Depends(verify_token)):
+    """これから鳴るリマインダーを早い順に。スケジューラーの状態（積んである数・鳴らした数）も付けるわ"""
+    return {"reminders": reminders.upcoming(limit), "metrics": reminders.get_metrics()}
@@ -4,7 +4,8 @@ JWTベースのぬるくん専用認証。
 """
 
 from datetime import datetime, timedelta, timezone
-from fastapi import APIRouter, HTTPException, Depends
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Depends, WebSocket
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import jwt, JWTError
 from pydantic import BaseModel
@@ -33,21 +34,39 @@ def create_token(data: dict) -> str:
 
 
 # ─── JWT検証（依存関数） ──────────────────
+def decode_token(token: str) -> dict:
+    """JWTトークンをデコードする。無効なら JWTError を投げる（WebSocketなど Depends が使えない所向け）"""
+    return jwt.decode(
+        token,
+        settings.JWT_SECRET,
+        algorithms=[settings.JWT_ALGORITHM],
+    )
+
+
 async def verify_token(
     credentials: HTTPAuthorizationCredentials = Depends(security),
 ) -> dict:
     """JWTトークンを検証する。他のルーターで Depends(verify_token) で使う。"""
     try:
-        payload = jwt.decode(
-            credentials.credentials,
-            settings.JWT_SECRET,
-            algorithms=[settings.JWT_ALGORITHM],
-        )
-        return payload
+        return decode_token(credentials.credentials)
     except JWTError:
         raise HTTPException(status_code=401, detail="無効なトークンよ！ ログインし直して♡")
 
 
+def websocket_token(websocket: WebSocket) -> Optional[dict]:
+    """WebSocket接続のJWTを検証する。Authorizationヘッダーか ?token= で受け取る。"""
+    token = websocket.query_params.get("token")
+    auth_header = websocket.headers.get("authorization", "")
+    if auth_header.lower().startswith("bearer "):
+        token = auth_header[7:]
+    if not token:
+        return None
+    try:
+        return decode_token(token)
+    except JWTError:
+        return None
+
+
 # ─── エンドポイント ──────────────────────
 @router.post("/login", response_model=TokenResponse)
 async def login(req: LoginRequest):
@@ -1,13 +1,27 @@
 """
 📅 Luna Villa — カレンダーAPI
 予定のCRUD。スマホからもPCのるなからも追加可能。
+繰り返し予定（RRULE + 例外日）は、取得した期間の分だけ展開して返す。
+追加・更新の時は他の予定との重なりを教えてくれるし、空き時間も引けるわ。
+月グリッドの点々用に、日ごとの件数だけを返す軽いサマリーもあるわ。
 """
 
+import json
+import uuid
+from datetime import date, datetime, time, timedelta
 from fastapi import APIRouter, Depends, Query, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator, model_validator
 from typing import Optional
+from config import settings
 from database import get_db
 from routers.auth import verify_token
+import recurrence
+import batch
+import versions
+import reminders
+import intervals
+import epoch
+import autocomplete
 
 router = APIRouter(prefix="/api/calendar", tags=["カレンダー"])
 
@@ -19,6 +33,18 @@ class EventCreate(BaseModel):
     start_at: str  # ISO format
     end_at: Optional[str] = None
     added_by: str = "user"
+    rrule: Optional[str] = None  # 例: "FREQ=WEEKLY;BYDAY=MO,WE"
+    exdates: list[str] = Field(default_factory=list)  # 休みにする回（日時 or 日付）
+    tz: Optional[str] = None  # 例: "Asia/Tokyo"。省略したらサーバーの TIMEZONE
+
+    _check_datetime = field_validator("start_at", "end_at")(epoch.check_datetime)
+    _check_timezone = field_validator("tz")(epoch.check_timezone)
+
+    @model_validator(mode="after")
+    def _check_order(self):
+        if self.end_at and epoch.to_epoch(self.end_at, self.tz) < epoch.to_epoch(self.start_at, self.tz):
+            raise ValueError("終わりが始まりより前になってるわよ")
+        return self
 
 
 class EventUpdate(BaseModel):
@@ -26,99 +52,374 @@ class EventUpdate(BaseModel):
     description: Optional[str] = None
     start_at: Optional[str] = None
     end_at: Optional[str] = None
+    rrule: Optional[str] = None  # "" で繰り返し解除
+    exdates: Optional[list[str]] = None
+    tz: Optional[str] = None
+
+    _check_datetime = field_validator("start_at", "end_at")(epoch.check_datetime)
+    _check_timezone = field_validator("tz")(epoch.check_timezone)
+
+
+EVENT_COLUMNS = "id, title, description, start_at, end_at, added_by, created_at, rrule, exdates, tz"
+
+
+def row_to_event(row) -> dict:
+    return {
+        "id": row[0],
+        "title": row[1],
+        "description": row[2],
+        "start_at": row[3],
+        "end_at": row[4],
+        "added_by": row[5],
+        "created_at": row[6],
+        "rrule": row[7] or None,
+        "exdates": json.loads(row[8] or "[]"),
+        "tz": row[9],
+    }
+
+
+def validate_recurrence(rrule: Optional[str], exdates: Optional[list[str]]):
+    """繰り返しルールと例外日が解釈できるか確かめる"""
+    try:
+        if rrule:
+            recurrence.parse_rrule(rrule)
+        recurrence.parse_exdates(exdates)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"繰り返しの指定が変よ: {e}")
+
+
+def expand_rows(rows, window_start: datetime, window_end: datetime) -> list[dict]:
+    """行を期間内の予定に展開する。繰り返し予定は回ごとに1件になる。"""
+    events = []
+    for row in rows:
+        event = row_to_event(row)
+        if not event["rrule"]:
+            events.append(event)
+            continue
+        raw = {"id": row[0], "start_at": row[3], "end_at": row[4], "rrule": row[7], "exdates": row[8], "tz": row[9]}
+        for start, end in recurrence.expand_event(raw, window_start, window_end):
+            events.append({
+                **event,
+                "start_at": start.isoformat(),
+                "end_at": end.isoformat() if end else None,
+                "series_start_at": event["start_at"],
+                "recurring": True,
+            })
+    events.sort(key=lambda e: e["start_at"])
+    return events
+
+
+def covered_days(event: dict, first: date, last: date) -> list[str]:
+    """
+    予定が掛かる日（設定のタイムゾーンの日付）のうち first〜last のもの。
+    何日もまたぐ予定はその全部の日に出す。ちょうど 0:00 に終わるなら、その日には出さないわ。
+    """
+    tz = None if event.get("recurring") else event["tz"]  # 展開した回はもう設定のタイムゾーンの時刻
+    start = epoch.wall_clock(epoch.to_epoch(event["start_at"], tz))
+    end = epoch.wall_clock(epoch.to_epoch(event["end_at"], tz)) if event["end_at"] else start
+    end_day = end.date()
+    if end > start and end.time() == time.min:
+        end_day -= timedelta(days=1)
+    day, end_day = max(start.date(), first), min(end_day, last)
+    days = []
+    while day <= end_day:
+        days.append(day.isoformat())
+        day += timedelta(days=1)
+    return days
+
+
+# ─── 書き込み（単発とまとめての共通部分。コミットとオートコンプリートへの記録は呼び出し側） ───
+async def insert_event(db, event: EventCreate, uid: Optional[str] = None) -> int:
+    tz = event.tz or settings.TIMEZONE
+    start_ts, end_ts = epoch.event_epochs(event.start_at, event.end_at, tz)
+    cursor = await db.execute(
+        """
+        INSERT INTO events (title, description, start_at, end_at, added_by, rrule, exdates, uid,
+                            start_ts, end_ts, tz)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (event.title, event.description, event.start_at, event.end_at, event.added_by,
+         event.rrule or None, json.dumps(event.exdates), uid or f"{uuid.uuid4()}@luna-villa",
+         start_ts, end_ts, tz),
+    )
+    await intervals.index_event(db, cursor.lastrowid, event.start_at, event.end_at, event.rrule, tz)
+    return cursor.lastrowid
+
+
+async def apply_event_update(db, event_id: int, event: EventUpdate) -> bool:
+    """更新したら True、変更項目がなければ False。見つからなければ 404。"""
+    cursor = await db.execute("SELECT start_at, end_at, tz FROM events WHERE id = ?", (event_id,))
+    current = await cursor.fetchone()
+    if not current:
+        raise HTTPException(status_code=404, detail="その予定は見つからないわ…")
+
+    fields = event.model_dump(exclude_none=True)
+    updates = []
+    values = []
+    for field, value in fields.items():
+        updates.append(f"{field} = ?")
+        values.append(json.dumps(value) if field == "exdates" else value)
+
+    if not updates:
+        return False
+    if fields.keys() & {"start_at", "end_at", "tz"}:
+        # 日時かタイムゾーンが変わったら、整数カラムも今の行と合わせて計算し直す
+        start_at, end_at = fields.get("start_at", current[0]), fields.get("end_at", current[1])
+        tz = fields.get("tz", current[2])
+        try:
+            start_ts, end_ts = epoch.event_epochs(start_at, end_at, tz)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"日時の指定が変よ: {e}")
+        if end_ts is not None and end_ts < start_ts:
+            raise HTTPException(status_code=400, detail="終わりが始まりより前になってるわよ")
+        updates += ["start_ts = ?", "end_ts = ?"]
+        values += [start_ts, end_ts]
+    values.append(event_id)
+    await db.execute(
+        f"UPDATE events SET {', '.join(updates)} WHERE id = ?",
+        values,
+    )
+    cursor = await db.execute("SELECT start_at, end_at, rrule, tz FROM events WHERE id = ?", (event_id,))
+    await intervals.index_event(db, event_id, *await cursor.fetchone())
+    return True
+
+
+async def remove_event(db, event_id: int) -> bool:
+    cursor = await db.execute("DELETE FROM events WHERE id = ?", (event_id,))
+    await intervals.unindex_event(db, event_id)
+    return cursor.rowcount > 0
+
+
+def check_event(event: EventCreate | EventUpdate):
+    validate_recurrence(event.rrule, event.exdates)
+
+
+async def conflicts_of(db, event_id: int) -> list[dict]:
+    """書き込んだ直後（コミット前）の予定と重なる、他の予定の回"""
+    cursor = await db.execute("SELECT start_at, end_at, rrule, exdates, tz FROM events WHERE id = ?", (event_id,))
+    start_at, end_at, rrule, exdates, tz = await cursor.fetchone()
+    return await intervals.find_conflicts(db, start_at, end_at, rrule, json.loads(exdates or "[]"), event_id, tz)
+
+
+def parse_window(value_from: str, value_to: str, max_days: int = 62) -> tuple[datetime, datetime]:
+    try:
+        window_start, window_end = recurrence.parse_datetime(value_from), recurrence.parse_datetime(value_to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日時は YYYY-MM-DDTHH:MM の形で指定してね")
+    if window_end <= window_start:
+        raise HTTPException(status_code=400, detail="終わりは始まりより後にしてね")
+    if window_end - window_start > timedelta(days=max_days):
+        raise HTTPException(status_code=400, detail=f"一度に見られるのは{max_days}日分までよ")
+    return window_start, window_end
+
+
+# ─── 月サマリーのキャッシュ ───────────────────
+# 予定・タスクの変更バージョンもキーに入れてあるので、古い結果は返らないわ。書き込み側は invalidate_summary() でメモリも空けること。
+_summary_cache: dict[tuple, dict] = {}
+
+
+def invalidate_summary():
+    _summary_cache.clear()
+
+
+def month_window(year: int, month: int) -> tuple[datetime, datetime]:
+    return datetime(year, month, 1), datetime(year + month // 12, month % 12 + 1, 1)
 
 
 # ─── エンドポイント ──────────────────────
+@router.get("/summary")
+async def get_month_summary(
+    year: int = Query(..., ge=1970, le=9999),
+    month: int = Query(..., ge=1, le=12),
+    _=Depends(verify_token),
+    _etag=versions.conditional("events", "tasks"),
+):
+    """月グリッド用に、日ごとの予定数・未完了タスク数・完了タスク数だけを返す"""
+    key = (year, month, versions.current("events", "tasks"))
+    if key in _summary_cache:
+        return _summary_cache[key]
+
+    window_start, window_end = month_window(year, month)
+    start_ts, end_ts = epoch.local_to_epoch(window_start), epoch.local_to_epoch(window_end)
+    first, last = window_start.date(), (window_end - timedelta(days=1)).date()
+    offset = epoch.day_offset(None, window_start)
+    days: dict[str, dict] = {}
+
+    def day(d: str) -> dict:
+        return days.setdefault(d, {"events": 0, "open_tasks": 0, "done_tasks": 0})
+
+    db = await get_db()
+    try:
+        await db.execute("BEGIN")
+        # アジェンダと同じく、何日もまたぐ予定は掛かる日それぞれに数える
+        rows = await intervals.rows_in_window(db, EVENT_COLUMNS, window_start, window_end)
+        for event in expand_rows(rows, window_start, window_end):
+            for d in covered_days(event, first, last):
+                day(d)["events"] += 1
+
+        cursor = await db.execute(
+            """
+            SELECT date(due_ts + ?, 'unixepoch') AS day, SUM(is_done = 0), SUM(is_done = 1)
+            FROM tasks
+            WHERE due_ts >= ? AND due_ts < ?
+            GROUP BY day
+            """,
+            (offset, start_ts, end_ts),
+        )
+        # 期限はタスクごとのタイムゾーンの日付なので、設定のタイムゾーンの日付にまとめ直す
+        for d, open_count, done_count in await cursor.fetchall():
+            day(d)["open_tasks"] += open_count
+            day(d)["done_tasks"] += done_count
+        await db.commit()
+    finally:
+        await db.close()
+
+    summary = {"year": year, "month": month, "days": dict(sorted(days.items()))}
+    _summary_cache[key] = summary
+    return summary
+
+
+@router.get("/freebusy")
+async def get_free_busy(
+    from_: str = Query(..., alias="from", description="開始日時 (YYYY-MM-DDTHH:MM)"),
+    to: str = Query(..., description="終了日時 (YYYY-MM-DDTHH:MM)"),
+    min_minutes: int = Query(30, ge=1, le=24 * 60, description="これより短い空きは返さない"),
+    _=Depends(verify_token),
+    _etag=versions.conditional("events"),
+):
+    """期間内の埋まっている時間と空いている時間を返す（「木曜の午後どこが空いてる？」用）"""
+    window_start, window_end = parse_window(from_, to)
+    db = await get_db()
+    try:
+        busy = await intervals.busy(db, window_start, window_end)
+    finally:
+        await db.close()
+
+    free = intervals.free_slots(busy, window_start, window_end, timedelta(minutes=min_minutes))
+    return {
+        "busy": [
+            {"event_id": b["event_id"], "title": b["title"],
+             "start_at": b["start"].isoformat(), "end_at": b["end"].isoformat()}
+            for b in busy
+        ],
+        "free": [{"start_at": s.isoformat(), "end_at": e.isoformat()} for s, e in free],
+    }
+
+
 @router.get("")
 async def get_events(
-    year: Optional[int] = None,
-    month: Optional[int] = None,
+    year: Optional[int] = Query(None, ge=1970, le=9999),
+    month: Optional[int] = Query(None, ge=1, le=12),
     _=Depends(verify_token),
+    _etag=versions.conditional("events"),
 ):
-    """カレンダーイベントを取得する"""
+    """カレンダーイベントを取得する（繰り返し予定はその月の回に展開する）"""
     db = await get_db()
     try:
         if year and month:
-            cursor = await db.execute(
-                """
-                SELECT id, title, description, start_at, end_at, added_by, created_at
-                FROM events
-                WHERE strftime('%Y', start_at) = ? AND strftime('%m', start_at) = ?
-                ORDER BY start_at ASC
-                """,
-                (str(year), f"{month:02d}"),
-            )
+            window_start, window_end = month_window(year, month)
+            rows = await intervals.rows_in_window(db, EVENT_COLUMNS, window_start, window_end)
+            events = expand_rows(rows, window_start, window_end)
         else:
             cursor = await db.execute(
-                """
-                SELECT id, title, description, start_at, end_at, added_by, created_at
+                f"""
+                SELECT {EVENT_COLUMNS}
                 FROM events
-                ORDER BY start_at ASC
+                ORDER BY start_ts ASC
                 LIMIT 100
                 """
             )
+            events = [row_to_event(row) for row in await cursor.fetchall()]
 
-        rows = await cursor.fetchall()
-        events = [
-            {
-                "id": row[0],
-                "title": row[1],
-                "description": row[2],
-                "start_at": row[3],
-                "end_at": row[4],
-                "added_by": row[5],
-                "created_at": row[6],
-            }
-            for row in rows
-        ]
         return {"events": events, "count": len(events)}
     finally:
         await db.close()
 
 
 @router.post("")
-async def create_event(event: EventCreate, _=Depends(verify_token)):
-    """予定を追加する"""
+async def create_event(
+    event: EventCreate,
+    reject_conflicts: bool = Query(False, description="他の予定と重なるなら追加しない"),
+    _=Depends(verify_token),
+):
+    """予定を追加する。他の予定と重なっていたら conflicts で教えるわ。"""
+    validate_recurrence(event.rrule, event.exdates)
     db = await get_db()
     try:
-        cursor = await db.execute(
-            """
-            INSERT INTO events (title, description, start_at, end_at, added_by)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (event.title, event.description, event.start_at, event.end_at, event.added_by),
-        )
-        await db.commit()
-        return {"id": cursor.lastrowid, "message": "予定を追加したわ♡"}
+        event_id = await insert_event(db, event)
+        conflicts = await conflicts_of(db, event_id)
+        if conflicts and reject_conflicts:
+            await db.rollback()
+            raise HTTPException(
+                status_code=409,
+                detail={"message": "その時間は他の予定と重なってるわ…", "conflicts": conflicts},
+            )
+        await versions.commit(db)
+        autocomplete.record("event", event.title)
+        invalidate_summary()
+        await reminders.refresh("event", event_id)
+        return {"id": event_id, "conflicts": conflicts, "message": "予定を追加したわ♡"}
     finally:
         await db.close()
 
 
+@router.post("/batch")
+async def batch_events(req: batch.BatchRequest, _=Depends(verify_token)):
+    """
+    予定の作成・更新・削除をまとめて1トランザクションで適用する。
+    1週間分の予定の取り込みなども、これ1回でOKよ。
+    """
+    items = batch.prepare(req, EventCreate, EventUpdate, check_event)
+
+    async def apply(db, item: batch.BatchItem) -> dict:
+        if item.op == "create":
+            return {"id": await insert_event(db, item.payload)}
+        if item.op == "update":
+            return {"id": item.id, "changed": await apply_event_update(db, item.id, item.payload)}
+        return {"id": item.id, "deleted": await remove_event(db, item.id)}
+
+    result = await batch.run(req, items, apply)
+    refreshed = []
+    for r in result["results"]:
+        if r["ok"] and r["op"] != "create":
+            recurrence.invalidate(r["id"])
+        if r["ok"]:
+            refreshed.append(r["id"])
+            if r.get("changed", True) and items[r["index"]].payload is not None:
+                autocomplete.record("event", items[r["index"]].payload.title)
+    await reminders.refresh_many("event", list(dict.fromkeys(refreshed)))
+    if result["applied"]:
+        invalidate_summary()
+    return result
+
+
 @router.put("/{event_id}")
-async def update_event(event_id: int, event: EventUpdate, _=Depends(verify_token)):
-    """予定を更新する"""
+async def update_event(
+    event_id: int,
+    event: EventUpdate,
+    reject_conflicts: bool = Query(False, description="他の予定と重なるなら更新しない"),
+    _=Depends(verify_token),
+):
+    """予定を更新する。時間を動かした結果ほかと重なったら conflicts で教えるわ。"""
+    validate_recurrence(event.rrule, event.exdates)
     db = await get_db()
     try:
-        # 既存イベント確認
-        cursor = await db.execute("SELECT id FROM events WHERE id = ?", (event_id,))
-        if not await cursor.fetchone():
-            raise HTTPException(status_code=404, detail="その予定は見つからないわ…")
-
-        updates = []
-        values = []
-        for field, value in event.model_dump(exclude_none=True).items():
-            updates.append(f"{field} = ?")
-            values.append(value)
-
-        if updates:
-            values.append(event_id)
-            await db.execute(
-                f"UPDATE events SET {', '.join(updates)} WHERE id = ?",
-                values,
-            )
-            await db.commit()
+        conflicts = []
+        if await apply_event_update(db, event_id, event):
+            conflicts = await conflicts_of(db, event_id)
+            if conflicts and reject_conflicts:
+                await db.rollback()
+                raise HTTPException(
+                    status_code=409,
+                    detail={"message": "その時間は他の予定と重なってるわ…", "conflicts": conflicts},
+                )
+            await versions.commit(db)
+            autocomplete.record("event", event.title)
+            recurrence.invalidate(event_id)
+            invalidate_summary()
+            await reminders.refresh("event", event_id)
 
-        return {"message": "予定を更新したわ♡"}
+        return {"conflicts": conflicts, "message": "予定を更新したわ♡"}
     finally:
         await db.close()
 
@@ -128,8 +429,11 @@ async def delete_event(event_id: int, _=Depends(verify_token)):
     """予定を削除する"""
     db = await get_db()
     try:
-        await db.execute("DELETE FROM events WHERE id = ?", (event_id,))
-        await db.commit()
+        await remove_event(db, event_id)
+        await versions.commit(db)
+        recurrence.invalidate(event_id)
+        invalidate_summary()
+        reminders.unschedule("event", event_id)
         return {"message": "予定を削除したわ♡"}
     finally:
         await db.close()
@@ -2,22 +2,33 @@
 💬 Luna Villa — チャットAPI
 Gemini APIでるなの応答を生成し、SSEストリーミングで返す。
 画像送信（マルチモーダル）対応版。
+クライアント切断・新メッセージ到着時は生成を打ち切り、途中までの応答を保存する。
+常時接続したい時は WebSocket (/api/chat/ws) も使えるわ。
+WebSocket にはタスク・予定のリマインダーも push される。
 """
 
+import asyncio
 import json
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel, Field
 from sse_starlette.sse import EventSourceResponse
 import google.generativeai as genai
 from config import settings
 from database import get_db
-from routers.auth import verify_token
+import versions
+import reminders
+from routers.auth import verify_token, websocket_token
 
 router = APIRouter(prefix="/api/chat", tags=["チャット"])
 
 # ─── Gemini設定 ───────────────────────────
 genai.configure(api_key=settings.GEMINI_API_KEY)
 
+# 打ち切られた前回の生成が保存を終えるまで待つ上限（秒）
+SUPERSEDE_WAIT_SECONDS = 5.0
+
 
 # ─── リクエストモデル ────────────────────────
 class ChatRequest(BaseModel):
@@ -26,108 +37,464 @@ class ChatRequest(BaseModel):
     current_hour: int = Field(default=-1)  # 仮想時刻（-1はシステム時刻を使用）
 
 
-# ─── チャットエンドポイント ──────────────────
-@router.post("")
-async def chat(req: ChatRequest, payload: dict = Depends(verify_token)):
-    """るなとお喋りするわ！画像も送れるよ♡"""
-
-    # ユーザーメッセージをDBに保存（画像は一旦保存しない）
-    db_conn = await get_db()
+# ─── プロンプト構築 ─────────────────────────
+def load_persona() -> str:
+    """ペルソナを読み込む"""
     try:
-        await db_conn.execute(
-            "INSERT INTO conversations (role, content) VALUES (?, ?)",
-            ("user", req.message),
-        )
-        await db_conn.commit()
-    finally:
-        await db_conn.close()
+        with open(settings.PERSONA_PATH, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return "君は「るな (Luna)」というAIパートナーだ。"
 
-    async def generate():
-        """Gemini APIからストリーミング応答を取得し、SSEで送信する"""
+
+def build_time_context(current_hour: int) -> str:
+    """時刻コンテキストを組み立てる"""
+    hour = current_hour if current_hour != -1 else datetime.now().hour
+    time_context = f"\n現在時刻: {hour}:00 頃\n"
+    if 5 <= hour < 11:
+        time_context += "今は「朝」よ。挨拶されたら元気に「おはよう」って言いなさい。ぬるくんにパワーをあげるのよ♡\n"
+    elif 11 <= hour < 17:
+        time_context += "今は「昼」ね。お仕事頑張ってるぬるくんを癒やしてあげて。\n"
+    elif 17 <= hour < 22:
+        time_context += "今は「夜」よ。落ち着いたトーンで一日の疲れを労ってあげなさい。\n"
+    else:
+        time_context += "今は「深夜」ね。眠そうにしたり、夜更かしを心配したりしなさい。\n"
+    return time_context
+
+
+def build_affinity_context(affinity_level: int) -> str:
+    """親密度による性格補正"""
+    affinity_context = f"\n現在の親密度レベル: {affinity_level}\n"
+    if affinity_level < 5:
+        affinity_context += "君はまだぬるくんを警戒している。生意気で、少し突き放すような態度を取りなさい。\n"
+    elif affinity_level < 20:
+        affinity_context += "君はぬるくんを信頼し始めている。生意気さは残しつつも、時折デレを見せなさい。\n"
+    else:
+        affinity_context += "君はぬるくんを深く愛している。独占欲が強く、甘えん坊な一面を出しなさい。でも生意気な口調は崩さないで♡\n"
+    return affinity_context
+
+
+def build_user_parts(req: ChatRequest) -> list:
+    """今回のメッセージ（テキスト + 画像）を構築する"""
+    parts = [req.message]
+    for img_b64 in req.image_data:
+        # header除去 (data:image/png;base64, ...)
+        if "," in img_b64:
+            img_b64 = img_b64.split(",")[1]
+        parts.append({"mime_type": "image/jpeg", "data": img_b64})
+    return parts
+
+
+def to_sse(event: dict) -> Optional[dict]:
+    """ターンのイベントをSSE形式に変換する（従来クライアント互換）"""
+    kind = event["type"]
+    if kind == "chunk":
+        payload, name = {"content": event["content"], "done": False}, "message"
+    elif kind == "done":
+        payload, name = {"content": "", "done": True, "truncated": event["truncated"]}, "message"
+    elif kind == "error":
+        payload, name = {"error": event["error"]}, "error"
+    elif kind == "affinity":
+        payload, name = {"affinity": {"level": event["level"], "exp": event["exp"]}}, "affinity"
+    else:
+        return None
+    return {"event": name, "data": json.dumps(payload, ensure_ascii=False)}
+
+
+# ─── 親密度 ───────────────────────────────
+def next_affinity(level: int, exp: int, is_insult: bool) -> tuple[int, int, bool]:
+    """1ターン分の親密度の変化。(新しいレベル, 新しい経験値, レベルが上がったか)"""
+    if is_insult:
+        return max(1, level - 1), 0, False
+    exp += 10
+    if exp >= 100:
+        return level + 1, 0, True
+    return level, exp, False
+
+
+async def read_affinity(db) -> tuple[int, int]:
+    cursor = await db.execute(
+        "SELECT key, value_int FROM stats WHERE key IN ('affinity_level', 'affinity_exp')"
+    )
+    values = {row[0]: row[1] for row in await cursor.fetchall()}
+    return values.get("affinity_level", 1), values.get("affinity_exp", 0)
+
+
+# ─── 生成ターン ─────────────────────────────
+class ChatTurn:
+    """
+    1回分の応答生成。
+    上流のストリームは専用タスクで読み、SSE側にはキュー経由で流す。
+    userメッセージはターンを始める時にすぐ保存し、るなの応答と親密度はストリーム終了時の1トランザクションで書く。
+    タスクをキャンセルすれば上流の生成もすぐに止まり、途中までの応答は truncated として保存される。
+
+    コミットは1ターン2回（userメッセージ・終了時）。1回にまとめると、生成中にプロセスが落ちた時
+    userメッセージまで消えるし、前のターンの保存待ちがタイムアウトした時に順番が入れ替わる。
+    userの行は小さい1件なので、ここは2回のままにしているわ。
+    """
+
+    def __init__(self, owner: str, req: ChatRequest):
+        self.owner = owner
+        self.req = req
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.chunks: list[str] = []
+        self.cancel_reason: Optional[str] = None
+        self.finishing = False
+        self.user_id: Optional[int] = None
+        # 暴言だったか（判定前に止まったら None で、親密度は動かさない）
+        self.is_insult: Optional[bool] = None
+        self.announced: Optional[tuple[int, int]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def save_user_message(self):
+        """userメッセージを先に保存する（生成中にプロセスが落ちても消えないように）"""
         db = await get_db()
         try:
-            # 履歴を取得（直近20件）
+            # 画像は一旦保存しない
             cursor = await db.execute(
-                "SELECT role, content FROM conversations ORDER BY id DESC LIMIT 20"
+                "INSERT INTO conversations (role, content) VALUES (?, ?)", ("user", self.req.message)
+            )
+            self.user_id = cursor.lastrowid
+            await versions.commit(db)
+        finally:
+            await db.close()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def cancel(self, reason: str):
+        """生成を打ち切る（切断・新メッセージ到着時）"""
+        if self.task and not self.task.done() and not self.finishing:
+            self.cancel_reason = self.cancel_reason or reason
+            self.task.cancel()
+
+    async def wait(self, timeout: float = SUPERSEDE_WAIT_SECONDS):
+        """保存まで終わるのを待つ"""
+        if self.task:
+            await asyncio.wait({self.task}, timeout=timeout)
+
+    async def events(self):
+        """
+        イベントを順に返す。None が来たら終わり。
+        {"type": "chunk" | "affinity" | "error" | "done", ...} の形で、SSE/WebSocket側で変換する。
+        """
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            yield item
+
+    async def _run(self):
+        truncated = False
+        db = await get_db()
+        try:
+            # ─ 読み取りフェーズ（コミットなし） ─
+            # 履歴を取得（今回のuserメッセージと合わせて直近20件）
+            cursor = await db.execute(
+                "SELECT role, content FROM conversations WHERE id < ? ORDER BY id DESC LIMIT 19",
+                (self.user_id,),
             )
             rows = await cursor.fetchall()
             history = []
-            for row in reversed(rows[1:]): # 今回保存した最新のuserメッセージ以外
+            for row in reversed(rows):
                 role = "user" if row["role"] == "user" else "model"
                 history.append({"role": role, "parts": [row["content"]]})
 
-            # ペルソナ読み込み
-            persona = "君は「るな (Luna)」というAIパートナーだ。"
-            try:
-                with open(settings.PERSONA_PATH, "r", encoding="utf-8") as f:
-                    persona = f.read()
-            except:
-                pass
-
-            # 親密度データの取得
-            cursor = await db.execute("SELECT value_int FROM stats WHERE key = 'affinity_level'")
-            row = await cursor.fetchone()
-            affinity_level = row[0] if row else 1
-            
-            cursor = await db.execute("SELECT value_int FROM stats WHERE key = 'affinity_exp'")
-            row = await cursor.fetchone()
-            affinity_exp = row[0] if row else 0
-
-            # 時刻コンテキストの追加
-            from datetime import datetime
-            hour = req.current_hour if req.current_hour != -1 else datetime.now().hour
-            time_context = f"\n現在時刻: {hour}:00 頃\n"
-            if 5 <= hour < 11:
-                time_context += "今は「朝」よ。挨拶されたら元気に「おはよう」って言いなさい。ぬるくんにパワーをあげるのよ♡\n"
-            elif 11 <= hour < 17:
-                time_context += "今は「昼」ね。お仕事頑張ってるぬるくんを癒やしてあげて。\n"
-            elif 17 <= hour < 22:
-                time_context += "今は「夜」よ。落ち着いたトーンで一日の疲れを労ってあげなさい。\n"
-            else:
-                time_context += "今は「深夜」ね。眠そうにしたり、夜更かしを心配したりしなさい。\n"
-            
-            # 親密度による性格補正
-            affinity_context = f"\n現在の親密度レベル: {affinity_level}\n"
-            if affinity_level < 5:
-                affinity_context += "君はまだぬるくんを警戒している。生意気で、少し突き放すような態度を取りなさい。\n"
-            elif affinity_level < 20:
-                affinity_context += "君はぬるくんを信頼し始めている。生意気さは残しつつも、時折デレを見せなさい。\n"
-            else:
-                affinity_context += "君はぬるくんを深く愛している。独占欲が強く、甘えん坊な一面を出しなさい。でも生意気な口調は崩さないで♡\n"
-
-            persona += time_context + affinity_context
+            # 親密度データの取得（プロンプト用の見込み。保存時に読み直して同じ変化を足す）
+            affinity_level, affinity_exp = await read_affinity(db)
+
+            persona = load_persona()
+            persona += build_time_context(self.req.current_hour) + build_affinity_context(affinity_level)
 
             # NGワード判定
             ng_words = ["ばか", "バカ", "嫌い", "きらい", "死ね", "きえろ", "消えろ", "ブス", "デブ", "くず", "クズ"]
-            is_insult = any(ng in req.message for ng in ng_words)
-            
+            is_insult = any(ng in self.req.message for ng in ng_words)
+            affinity_level, affinity_exp, leveled_up = next_affinity(affinity_level, affinity_exp, is_insult)
+
             if is_insult:
-                affinity_level = max(1, affinity_level - 1)
-                affinity_exp = 0
                 persona += "\n【重要】ユーザーが君に暴言を吐いた。君は深く傷つき、ショックを受け、悲しみに暮れている。冷たくあしらうか、泣き出しそうなトーンで返しなさい。親密度が1下がったわ。\n"
-            else:
-                # 経験値アップ
-                affinity_exp += 10
-                if affinity_exp >= 100:
-                    affinity_level += 1
-                    affinity_exp = 0
-                    persona += "\n【重要】親密度レベルが上がった！君はとても嬉しくなり、いつもより少しだけ素直に喜びを表現しなさい。\n"
-
-            # 親密度更新をDBに反映
-            await db.execute("UPDATE stats SET value_int = ? WHERE key = 'affinity_level'", (affinity_level,))
-            await db.execute("UPDATE stats SET value_int = ? WHERE key = 'affinity_exp'", (affinity_exp,))
-            await db.commit()
+            elif leveled_up:
+                persona += "\n【重要】親密度レベルが上がった！君はとても嬉しくなり、いつもより少しだけ素直に喜びを表現しなさい。\n"
+
+            self.is_insult = is_insult
+            self.announced = (affinity_level, affinity_exp)
+            self.queue.put_nowait({"type": "affinity", "level": affinity_level, "exp": affinity_exp})
+
+            # モデル準備（非同期ストリームなのでキャンセルで上流も止まる）
+            model = genai.GenerativeModel(
+                model_name=settings.GEMINI_MODEL,
+                system_instruction=persona,
+            )
+            response = await model.generate_content_async(
+                history + [{"role": "user", "parts": build_user_parts(self.req)}],
+                stream=True,
+            )
+            async for chunk in response:
+                if chunk.text:
+                    self.chunks.append(chunk.text)
+                    self.queue.put_nowait({"type": "chunk", "content": chunk.text})
+
+        except asyncio.CancelledError:
+            truncated = True
+            print(f"✂️ 生成を打ち切ったわ ({self.cancel_reason})")
         except Exception as e:
             import traceback
             traceback.print_exc()  # サーバーのターミナルに詳細を出力
-            yield {
-                "event": "error",
-                "data": json.dumps(
-                    {"error": f"エラーが発生したわ…: {str(e)}"},
-                    ensure_ascii=False,
-                ),
-            }
+            truncated = bool(self.chunks)
+            self.queue.put_nowait({"type": "error", "error": f"エラーが発生したわ…: {str(e)}"})
         finally:
-            await db.close()
+            self.finishing = True  # 保存中はもうキャンセルさせない
+            try:
+                await self._persist(db, truncated)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            finally:
+                await db.close()
+                if _active_turns.get(self.owner) is self:
+                    del _active_turns[self.owner]
+                # 完了シグナル
+                self.queue.put_nowait({"type": "done", "truncated": truncated})
+                self.queue.put_nowait(None)
+
+    async def _persist(self, db, truncated: bool):
+        """
+        親密度とるなの応答（途中まででも）を1トランザクションでコミットする。
+        親密度は BEGIN IMMEDIATE の中で読み直してから変化を足すので、重なったターンが上書きし合うことはないわ。
+        """
+        saved = None
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            if self.is_insult is not None:
+                saved = next_affinity(*await read_affinity(db), self.is_insult)[:2]
+                await db.executemany(
+                    "UPDATE stats SET value_int = ? WHERE key = ?",
+                    [(saved[0], "affinity_level"), (saved[1], "affinity_exp")],
+                )
+            # るなの応答（打ち切られていたら印を付ける）
+            if self.chunks:
+                await db.execute(
+                    "INSERT INTO conversations (role, content, truncated) VALUES (?, ?, ?)",
+                    ("luna", "".join(self.chunks), int(truncated)),
+                )
+            await versions.commit(db)
+        except Exception:
+            await db.rollback()
+            raise
+        if saved and saved != self.announced:
+            # 先に知らせた見込みと違ったら（他のターンと重なった）、保存した値を知らせ直す
+            self.queue.put_nowait({"type": "affinity", "level": saved[0], "exp": saved[1]})
+
+
+# ユーザーごとに走っている生成（シングルフライト）
+_active_turns: dict[str, ChatTurn] = {}
+
+
+async def start_turn(owner: str, req: ChatRequest) -> ChatTurn:
+    """前回の生成がまだ走っていれば打ち切ってから、新しい生成を始める"""
+    previous = _active_turns.get(owner)
+    if previous:
+        previous.cancel("superseded")
+        await previous.wait()
+
+    turn = ChatTurn(owner, req)
+    await turn.save_user_message()
+    _active_turns[owner] = turn
+    turn.start()
+    return turn
+
+
+# ─── チャットエンドポイント ──────────────────
+@router.post("")
+async def chat(req: ChatRequest, payload: dict = Depends(verify_token)):
+    """るなとお喋りするわ！画像も送れるよ♡"""
+    turn = await start_turn(payload.get("sub", ""), req)
+
+    async def generate():
+        """生成ターンのイベントをSSEで送信する。切断されたら上流も止める。"""
+        try:
+            async for event in turn.events():
+                message = to_sse(event)
+                if message:
+                    yield message
+        finally:
+            turn.cancel("disconnected")
 
     return EventSourceResponse(generate())
+
+
+# ─── WebSocketチャット ──────────────────────
+# 1本の接続で複数のストリームを id で多重化する。フレームはキーを短くしたJSON。
+#
+#   クライアント → サーバー
+#     {"t": "msg", "id": "<stream>", "m": "本文", "img": [...], "h": -1}
+#     {"t": "cancel", "id": "<stream>"}
+#     {"t": "typing", "on": true}            ぬるくんが入力中（今は受け取るだけ）
+#     {"t": "ping"} / {"t": "pong"}
+#
+#   サーバー → クライアント
+#     {"t": "hello", "hb": 20}               接続直後。hb 秒ごとに ping が来る
+#     {"t": "typing", "id": ..., "on": bool} るなが入力中
+#     {"t": "chunk", "id": ..., "c": "..."}
+#     {"t": "aff", "lv": 3, "xp": 40}        親密度の更新
+#     {"t": "err", "id": ..., "e": "..."}
+#     {"t": "done", "id": ..., "tr": bool}   tr = 途中で打ち切られた
+#     {"t": "ping"} / {"t": "pong"}
+#
+# hb の2倍の間なにも届かなければ 4408 で切断する。切断時に走っていた生成は
+# 打ち切って保存されるので、再接続したクライアントは履歴を取り直せばいいわ。
+
+WS_CLOSE_UNAUTHORIZED = 4401
+WS_CLOSE_TIMEOUT = 4408
+
+
+def to_frame(stream_id: str, event: dict) -> Optional[dict]:
+    """ターンのイベントをWebSocketフレームに変換する"""
+    kind = event["type"]
+    if kind == "chunk":
+        return {"t": "chunk", "id": stream_id, "c": event["content"]}
+    if kind == "done":
+        return {"t": "done", "id": stream_id, "tr": event["truncated"]}
+    if kind == "error":
+        return {"t": "err", "id": stream_id, "e": event["error"]}
+    if kind == "affinity":
+        return {"t": "aff", "lv": event["level"], "xp": event["exp"]}
+    return None
+
+
+class ChatSocket:
+    """1本のWebSocket接続。受信ループ・ハートビート・ストリームごとの中継タスクを持つ。"""
+
+    def __init__(self, websocket: WebSocket, owner: str):
+        self.websocket = websocket
+        self.owner = owner
+        self.streams: dict[str, asyncio.Task] = {}
+        self.turns: dict[str, ChatTurn] = {}
+        self.send_lock = asyncio.Lock()
+        self.last_seen = asyncio.get_running_loop().time()
+
+    async def send(self, frame: dict):
+        async with self.send_lock:
+            await self.websocket.send_text(
+                json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
+            )
+
+    async def serve(self):
+        heartbeat = asyncio.create_task(self._heartbeat())
+        pushes = asyncio.create_task(self._push_reminders())
+        try:
+            await self.send({"t": "hello", "hb": settings.WS_HEARTBEAT_SECONDS})
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                self.last_seen = asyncio.get_running_loop().time()
+                try:
+                    # バイナリフレームは受け付けない（text が無いので読めない扱い）
+                    frame = json.loads(message.get("text") or "")
+                except ValueError:
+                    frame = None
+                if not isinstance(frame, dict):
+                    await self.send({"t": "err", "e": "フレームが読めないわ…"})
+                    continue
+                await self._handle(frame)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            heartbeat.cancel()
+            pushes.cancel()
+            # 走っている生成は打ち切り（途中までは保存される）
+            for turn in self.turns.values():
+                turn.cancel("disconnected")
+            for task in self.streams.values():
+                task.cancel()
+
+    async def _handle(self, frame: dict):
+        kind = frame.get("t")
+        if kind == "msg":
+            stream_id = str(frame.get("id") or f"s{len(self.streams) + 1}")
+            if stream_id in self.streams:
+                await self.send({"t": "err", "id": stream_id, "e": "そのストリームIDは使用中よ"})
+                return
+            try:
+                req = ChatRequest(
+                    message=str(frame.get("m", "")),
+                    image_data=frame.get("img") or [],
+                    current_hour=int(frame.get("h", -1)),
+                )
+            except (TypeError, ValueError):  # pydantic の ValidationError も ValueError
+                await self.send({"t": "err", "id": stream_id, "e": "メッセージの中身が変よ（m / img / h を見直して）"})
+                return
+            self.streams[stream_id] = asyncio.create_task(self._relay(stream_id, req))
+        elif kind == "cancel":
+            stream_id = str(frame.get("id"))
+            if stream_id in self.turns:
+                self.turns[stream_id].cancel("cancelled")
+            elif stream_id in self.streams:
+                self.streams[stream_id].cancel()
+        elif kind == "ping":
+            await self.send({"t": "pong"})
+        elif kind in ("pong", "typing"):
+            pass  # last_seen の更新だけで十分
+        else:
+            await self.send({"t": "err", "e": f"知らないフレームよ: {kind}"})
+
+    async def _relay(self, stream_id: str, req: ChatRequest):
+        """1ストリーム分の生成を始めて、イベントをフレームにして送る"""
+        try:
+            turn = await start_turn(self.owner, req)
+            self.turns[stream_id] = turn
+            await self.send({"t": "typing", "id": stream_id, "on": True})
+            typing = True
+            async for event in turn.events():
+                if typing and event["type"] in ("chunk", "error", "done"):
+                    typing = False
+                    await self.send({"t": "typing", "id": stream_id, "on": False})
+                frame = to_frame(stream_id, event)
+                if frame:
+                    await self.send(frame)
+        except Exception:
+            # 送信先がもう閉じている等。生成は下で止める
+            pass
+        finally:
+            self.streams.pop(stream_id, None)
+            turn = self.turns.pop(stream_id, None)
+            if turn:
+                # 外してしまうと serve() の後始末からは届かないので、ここで打ち切る（終わっていれば何もしない）
+                turn.cancel("disconnected")
+
+    async def _push_reminders(self):
+        """スケジューラーが鳴らしたリマインダーを、この端末に届ける"""
+        queue = reminders.subscribe()
+        try:
+            while True:
+                reminder = await queue.get()
+                await self.send({"t": "remind", **reminder})
+        except Exception:
+            pass
+        finally:
+            reminders.unsubscribe(queue)
+
+    async def _heartbeat(self):
+        interval = settings.WS_HEARTBEAT_SECONDS
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if loop.time() - self.last_seen > interval * 2:
+                    await self.websocket.close(code=WS_CLOSE_TIMEOUT)
+                    return
+                await self.send({"t": "ping"})
+        except Exception:
+            pass
+
+
+@router.websocket("/ws")
+async def chat_socket(websocket: WebSocket):
+    """常時接続のチャット。HTTPを毎回張り直さずに済むわ♡"""
+    payload = websocket_token(websocket)
+    await websocket.accept()
+    if payload is None:
+        await websocket.close(code=WS_CLOSE_UNAUTHORIZED, reason="無効なトークンよ！")
+        return
+    await ChatSocket(websocket, payload.get("sub", "")).serve()
@@ -3,15 +3,19 @@
 るなの心の声と、二人の挨拶の記録を管理するわ。
 """
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from typing import Optional, List
 from database import get_db
 from routers.auth import verify_token
+import versions
 from datetime import datetime
 
 router = APIRouter(prefix="/api/diary", tags=["日記\u0026挨拶"])
 
+# 一覧で返す本文の冒頭の文字数（全文は /entries/{id} で）
+PREVIEW_CHARS = 80
+
 # ─── モデル ──────────────────────────────
 class GreetingCreate(BaseModel):
     greeting_type: str
@@ -33,21 +37,52 @@ async def record_greeting(data: GreetingCreate, _=Depends(verify_token)):
             "INSERT INTO greetings (greeting_type) VALUES (?)",
             (data.greeting_type,)
         )
-        await db.commit()
+        await versions.commit(db)
         return {"message": "今日もいい日になりそうね♡"}
     finally:
         await db.close()
 
+# ─── ページ送り ───────────────────────────
+def _after_cursor(cursor: Optional[str]) -> tuple[str, list]:
+    """next_cursor（最後の行の created_at|id）より古い行だけに絞る条件"""
+    if not cursor:
+        return "", []
+    created_at, _, last_id = cursor.rpartition("|")
+    if not created_at or not last_id.isdigit():
+        raise HTTPException(status_code=400, detail="cursor が変よ。next_cursor をそのまま渡してね")
+    return "WHERE (created_at < ? OR (created_at = ? AND id < ?))", [created_at, created_at, int(last_id)]
+
+
+def _page(rows: list, limit: int) -> tuple[list, bool, Optional[str]]:
+    """limit+1 件読んだ結果を (このページ, 続きがあるか, next_cursor) にする"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, has_more, f"{rows[-1]['created_at']}|{rows[-1]['id']}" if has_more else None
+
+
 @router.get("/greetings")
-async def get_greetings(_=Depends(verify_token)):
-    """挨拶の履歴を取得する"""
+async def get_greetings(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None, description="前のページの next_cursor"),
+    _=Depends(verify_token),
+    _etag=versions.conditional("greetings"),
+):
+    """挨拶の履歴を、新しい方からページごとに取得する"""
+    where, params = _after_cursor(cursor)
     db = await get_db()
     try:
-        cursor = await db.execute("SELECT * FROM greetings ORDER BY created_at DESC LIMIT 100")
-        rows = await cursor.fetchall()
-        return {"greetings": [dict(row) for row in rows]}
+        rows = await (await db.execute(
+            f"""
+            SELECT id, greeting_type, created_at FROM greetings {where}
+            ORDER BY created_at DESC, id DESC LIMIT ?
+            """,
+            (*params, limit + 1),
+        )).fetchall()
     finally:
         await db.close()
+    rows, has_more, next_cursor = _page(rows, limit)
+    greetings = [{"id": r["id"], "greeting_type": r["greeting_type"], "created_at": r["created_at"]} for r in rows]
+    return {"greetings": greetings, "count": len(greetings), "has_more": has_more, "next_cursor": next_cursor}
 
 @router.post("/entries")
 async def write_diary(data: SecretDiaryCreate, _=Depends(verify_token)):
@@ -58,18 +93,64 @@ async def write_diary(data: SecretDiaryCreate, _=Depends(verify_token)):
             "INSERT INTO secret_diary (title, content, mood, affinity_level) VALUES (?, ?, ?, ?)",
             (data.title, data.content, data.mood, data.affinity_level)
         )
-        await db.commit()
+        await versions.commit(db)
         return {"message": "私の大切な思い出、預かっておいてね♡"}
     finally:
         await db.close()
 
 @router.get("/entries")
-async def get_diary_entries(_=Depends(verify_token)):
-    """日記のエントリを取得する"""
+async def get_diary_entries(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="前のページの next_cursor"),
+    _=Depends(verify_token),
+    _etag=versions.conditional("secret_diary"),
+):
+    """
+    日記の一覧を、新しい方からページごとに取得する。
+    本文は冒頭（preview）だけ。続きは /entries/{id} で読んでね。
+    """
+    where, params = _after_cursor(cursor)
+    db = await get_db()
+    try:
+        rows = await (await db.execute(
+            f"""
+            SELECT id, title, mood, affinity_level, created_at,
+                   substr(content, 1, ?) AS preview, length(content) > ? AS truncated
+            FROM secret_diary {where}
+            ORDER BY created_at DESC, id DESC LIMIT ?
+            """,
+            (PREVIEW_CHARS, PREVIEW_CHARS, *params, limit + 1),
+        )).fetchall()
+    finally:
+        await db.close()
+    rows, has_more, next_cursor = _page(rows, limit)
+    entries = [
+        {
+            "id": r["id"],
+            "title": r["title"],
+            "mood": r["mood"],
+            "affinity_level": r["affinity_level"],
+            "created_at": r["created_at"],
+            "preview": r["preview"],
+            "truncated": bool(r["truncated"]),
+        }
+        for r in rows
+    ]
+    return {"entries": entries, "count": len(entries), "has_more": has_more, "next_cursor": next_cursor}
+
+
+@router.get("/entries/{entry_id}")
+async def get_diary_entry(entry_id: int, _=Depends(verify_token), _etag=versions.conditional("secret_diary")):
+    """日記を1件、本文まで全部"""
     db = await get_db()
     try:
-        cursor = await db.execute("SELECT * FROM secret_diary ORDER BY created_at DESC")
-        rows = await cursor.fetchall()
-        return {"entries": [dict(row) for row in rows]}
+        cursor = await db.execute(
+            "SELECT id, title, content, mood, affinity_level, created_at FROM secret_diary WHERE id = ?",
+            (entry_id,),
+        )
+        row = await cursor.fetchone()
     finally:
         await db.close()
+    if row is None:
+        raise HTTPException(status_code=404, detail="そんな日記、書いた覚えはないわよ？")
+    return dict(row)
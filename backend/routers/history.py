@@ -5,6 +5,8 @@
 from fastapi import APIRouter, Depends, Query
 from database import get_db
 from routers.auth import verify_token
+import jobs
+import versions
 
 router = APIRouter(prefix="/api/history", tags=["履歴"])
 
@@ -14,15 +16,16 @@ async def get_history(
     limit: int = Query(50, ge=1, le=1000),
     offset: int = Query(0, ge=0),
     _=Depends(verify_token),
+    _etag=versions.conditional("conversations"),
 ):
     """会話履歴を取得する"""
     db = await get_db()
     try:
         cursor = await db.execute(
             """
-            SELECT id, role, content, is_memo, created_at
+            SELECT id, role, content, is_memo, created_at, truncated
             FROM conversations
-            ORDER BY created_at DESC
+            ORDER BY created_at DESC, id DESC
             LIMIT ? OFFSET ?
             """,
             (limit, offset),
@@ -36,6 +39,7 @@ async def get_history(
                 "content": row[2],
                 "is_memo": bool(row[3]),
                 "created_at": row[4],
+                "truncated": bool(row[5]),
             }
             for row in rows
         ]
@@ -49,11 +53,20 @@ async def get_history(
 
 @router.delete("")
 async def clear_history(_=Depends(verify_token)):
-    """会話履歴をクリアする"""
+    """
+    会話履歴をクリアする。
+    何万件あっても待たせないように裏のジョブで少しずつ消す。進み具合は /api/jobs/{job_id} で。
+    消すのは頼まれた時点までの会話だけ。消している間に話した分は残るわ。
+    """
     db = await get_db()
     try:
-        await db.execute("DELETE FROM conversations WHERE is_memo = 0")
-        await db.commit()
-        return {"message": "履歴をクリアしたわ♡"}
+        cursor = await db.execute("SELECT COALESCE(MAX(id), 0) FROM conversations")
+        upto = (await cursor.fetchone())[0]
     finally:
         await db.close()
+
+    async def work(job):
+        await jobs.delete_in_batches("conversations", "is_memo = 0 AND id <= ?", (upto,), job=job)
+
+    job = jobs.start("clear_history", work, key=f"clear_history:{upto}")
+    return {"message": "履歴をクリアしてるわ♡ ちょっと待っててね", "job_id": job.id, "status": job.status}
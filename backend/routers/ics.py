@@ -0,0 +1,212 @@
+"""
+📆 Luna Villa — iCalendar 取り込み・書き出しAPI
+予定とタスクを .ics でまとめて出し入れする。
+書き出しはカーソルから1件ずつ作って流し、取り込みは少しずつ読みながら数百件ごとにコミットするわ。
+"""
+
+import codecs
+import json
+import time
+from fastapi import APIRouter, Depends, File, Query, UploadFile
+from fastapi.responses import StreamingResponse
+from database import get_db
+from routers.auth import verify_token
+from routers.calendar import (
+    EventCreate, EventUpdate, insert_event, apply_event_update, invalidate_summary,
+)
+from routers.tasks import TaskCreate, TaskUpdate, insert_task, apply_task_update
+import autocomplete
+import ical
+import recurrence
+import reminders
+import versions
+
+router = APIRouter(prefix="/api/calendar", tags=["カレンダー"])
+
+# 取り込み: 1回に読むバイト数と、1トランザクションで入れる件数
+IMPORT_CHUNK_SIZE = 64 * 1024
+IMPORT_BATCH_SIZE = 500
+# 書き出し: このくらい溜まったら送る
+EXPORT_FLUSH_BYTES = 64 * 1024
+
+
+# ─── 書き出し ─────────────────────────────
+@router.get("/export.ics")
+async def export_ics(
+    events: bool = Query(True, description="予定を VEVENT で含める"),
+    tasks: bool = Query(True, description="タスクを VTODO で含める"),
+    _=Depends(verify_token),
+):
+    """予定とタスクを .ics で書き出す（全件をメモリに載せずに流すわ）"""
+
+    async def generate():
+        db = await get_db()
+        try:
+            buffer = [ical.header()]
+            size = 0
+            queries = []
+            if events:
+                queries.append((
+                    "SELECT uid, title, description, start_at, end_at, rrule, exdates, created_at, tz "
+                    "FROM events ORDER BY id",
+                    lambda r: ical.vevent(r[0], r[1], r[2] or "", r[3], r[4], r[5], json.loads(r[6] or "[]"), r[7],
+                                          r[8]),
+                ))
+            if tasks:
+                queries.append((
+                    "SELECT uid, title, due_date, due_time, is_done, completed_ts, created_at, tz "
+                    "FROM tasks ORDER BY id",
+                    lambda r: ical.vtodo(r[0], r[1], r[2], r[3], bool(r[4]), r[5], r[6], r[7]),
+                ))
+            for query, render in queries:
+                cursor = await db.execute(query)
+                cursor.arraysize = 256
+                async for row in cursor:
+                    try:
+                        item = render(row)
+                    except ValueError:
+                        continue  # 日時が壊れている行は飛ばす
+                    buffer.append(item)
+                    size += len(item)
+                    if size >= EXPORT_FLUSH_BYTES:
+                        yield "".join(buffer)
+                        buffer, size = [], 0
+            buffer.append(ical.footer())
+            yield "".join(buffer)
+        finally:
+            await db.close()
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/calendar; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="luna-villa.ics"'},
+    )
+
+
+# ─── 取り込み ─────────────────────────────
+async def _upsert_event(db, data: dict) -> tuple[int, bool]:
+    """UID が同じ予定があれば上書き、なければ追加。(id, 新規か) を返す。"""
+    if data["rrule"]:
+        try:
+            recurrence.parse_rrule(data["rrule"])
+        except ValueError:
+            data["rrule"] = None  # 扱えない繰り返しは最初の回だけの予定にする
+            data["dropped_rrule"] = True
+    if data["uid"]:
+        cursor = await db.execute("SELECT id FROM events WHERE uid = ?", (data["uid"],))
+        row = await cursor.fetchone()
+        if row:
+            await apply_event_update(db, row[0], EventUpdate(
+                title=data["title"], description=data["description"], start_at=data["start_at"],
+                end_at=data["end_at"], rrule=data["rrule"] or "", exdates=data["exdates"],
+            ))
+            return row[0], False
+    event = EventCreate(
+        title=data["title"], description=data["description"], start_at=data["start_at"],
+        end_at=data["end_at"], added_by="import", rrule=data["rrule"], exdates=data["exdates"],
+    )
+    return await insert_event(db, event, data["uid"]), True
+
+
+async def _upsert_task(db, data: dict) -> tuple[int, bool]:
+    if data["uid"]:
+        cursor = await db.execute("SELECT id FROM tasks WHERE uid = ?", (data["uid"],))
+        row = await cursor.fetchone()
+        if row:
+            await apply_task_update(db, row[0], TaskUpdate(
+                title=data["title"], due_date=data["due_date"], due_time=data["due_time"], is_done=data["is_done"],
+            ))
+            return row[0], False
+    task_id = await insert_task(
+        db, TaskCreate(title=data["title"], due_date=data["due_date"], due_time=data["due_time"]), data["uid"]
+    )
+    if data["is_done"]:
+        await apply_task_update(db, task_id, TaskUpdate(is_done=True))
+    return task_id, True
+
+
+async def _apply_batch(components: list[ical.Component], stats: dict):
+    """1トランザクションで入れる。終わったらキャッシュとリマインダーを追いつかせる。"""
+    event_ids, task_ids = [], []
+    titles = []  # (kind, title)。コミットできてからオートコンプリートに足す
+    db = await get_db()
+    try:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            for component in components:
+                try:
+                    if component.kind == "VEVENT":
+                        data = component.to_event()
+                        item_id, created = await _upsert_event(db, data)
+                        event_ids.append(item_id)
+                        titles.append(("event", data["title"]))
+                        stats["rrule_dropped"] += data.get("dropped_rrule", False)
+                    else:
+                        data = component.to_task()
+                        item_id, created = await _upsert_task(db, data)
+                        task_ids.append(item_id)
+                        titles.append(("task", data["title"]))
+                except ValueError:
+                    stats["skipped"] += 1
+                    continue
+                stats["created" if created else "updated"] += 1
+            await versions.commit(db)
+        except Exception:
+            await db.rollback()
+            raise
+    finally:
+        await db.close()
+
+    for kind, title in titles:
+        autocomplete.record(kind, title)
+    for event_id in event_ids:
+        recurrence.invalidate(event_id)
+    invalidate_summary()
+    await reminders.refresh_many("event", event_ids)
+    await reminders.refresh_many("task", task_ids)
+
+
+@router.post("/import")
+async def import_ics(file: UploadFile = File(...), _=Depends(verify_token)):
+    """
+    .ics を取り込む。UID が同じものは上書きするので、同じファイルを何度入れても増えないわ。
+    進み具合は NDJSON で1行ずつ返す（最後の行が type=done）。
+    """
+
+    async def progress():
+        parser = ical.Parser()
+        decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+        stats = {"parsed": 0, "created": 0, "updated": 0, "skipped": 0, "rrule_dropped": 0}
+        started = time.monotonic()
+        pending: list[ical.Component] = []
+
+        def report(kind: str) -> str:
+            elapsed = time.monotonic() - started
+            return json.dumps({
+                "type": kind, **stats, "parse_errors": parser.errors,
+                "elapsed": round(elapsed, 3),
+                "per_second": round(stats["parsed"] / elapsed, 1) if elapsed > 0 else None,
+            }, ensure_ascii=False) + "\n"
+
+        try:
+            eof = False
+            while not eof:
+                chunk = await file.read(IMPORT_CHUNK_SIZE)
+                eof = not chunk
+                components = parser.feed(decoder.decode(chunk, final=eof))
+                for component in (list(components) + list(parser.close()) if eof else components):
+                    pending.append(component)
+                    stats["parsed"] += 1
+                    if len(pending) >= IMPORT_BATCH_SIZE:
+                        await _apply_batch(pending, stats)
+                        pending = []
+                        yield report("progress")
+            if pending:
+                await _apply_batch(pending, stats)
+            yield report("done")
+        except Exception as e:
+            print(f"ICS Import Error: {e}")
+            yield json.dumps({"type": "error", "message": f"取り込みの途中で失敗したわ…: {e}", **stats},
+                             ensure_ascii=False) + "\n"
+
+    return StreamingResponse(progress(), media_type="application/x-ndjson")
@@ -0,0 +1,36 @@
+"""
+🧹 Luna Villa — 一括処理の進み具合API
+履歴の全消去みたいに裏で回しているジョブが、いまどこまで進んだかを返すわ。
+"""
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from routers.auth import verify_token
+import jobs
+
+router = APIRouter(prefix="/api/jobs", tags=["一括処理"])
+
+
+@router.get("")
+async def list_jobs(limit: int = Query(20, ge=1, le=50), _=Depends(verify_token)):
+    """最近のジョブを新しい順に"""
+    return {"jobs": jobs.recent(limit)}
+
+
+@router.post("/incremental-vacuum")
+async def start_incremental_vacuum(_=Depends(verify_token)):
+    """
+    既存DBを auto_vacuum=INCREMENTAL に切り替えるジョブを始める。
+    終わるまで書き込みが全部止まるから、使っていない時間にやってね。
+    """
+    if await jobs.auto_vacuum_mode() == 2:
+        return {"message": "もう切り替わってるわよ♡", "job_id": None, "status": "done"}
+    job = jobs.start("enable_incremental_vacuum", jobs.enable_incremental_vacuum)
+    return {"message": "切り替えを始めたわ。終わるまで書き込みは待っててね", "job_id": job.id, "status": job.status}
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: int, _=Depends(verify_token)):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="そんなジョブ知らないわよ？ 再起動で忘れちゃったのかも")
+    return job.to_dict()
@@ -1,14 +1,16 @@
 """
 📌 Luna Villa — お土産メモAPI
 スマホの会話でピン留めしたメモをPCのるなに引き継ぐ。
+メモの変更は送信箱（outbox）に連番つきで積まれ、PC側は /outbox から続きだけを受け取って ack する。
 """
 
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel, Field
 from typing import Optional
 from database import get_db
 from routers.auth import verify_token
-import logging
+import versions
+import outbox
 
 router = APIRouter(prefix="/api/memos", tags=["メモ"])
 
@@ -23,32 +25,38 @@ class MemoUpdate(BaseModel):
     content: Optional[str] = None
 
 
+class OutboxAck(BaseModel):
+    consumer: str = Field(..., min_length=1, max_length=64)  # 受け取り手の名前（例: "pc-cli"）
+    seq: int = Field(..., ge=0)  # ここまで処理した、という seq
+
+
 @router.post("")
 async def create_memo(req: MemoRequest, _=Depends(verify_token)):
     """お土産メモを保存する"""
     db = await get_db()
     try:
-        await db.execute(
-            "INSERT INTO conversations (role, content, title, is_memo) VALUES (?, ?, ?, 1)",
-            ("user", req.content, req.title),
+        cursor = await db.execute(
+            "INSERT INTO memos (content, title) VALUES (?, ?)",
+            (req.content, req.title),
         )
-        await db.commit()
-        return {"message": "メモを保存したわ♡ PCの私に伝えておくわね！"}
+        await outbox.enqueue(db, cursor.lastrowid, "created", req.title, req.content)
+        await versions.commit(db)
+        outbox.notify()
+        return {"id": cursor.lastrowid, "message": "メモを保存したわ♡ PCの私に伝えておくわね！"}
     finally:
         await db.close()
 
 
 @router.get("")
-async def get_memos(_=Depends(verify_token)):
+async def get_memos(_=Depends(verify_token), _etag=versions.conditional("memos")):
     """全てのメモを取得する"""
     db = await get_db()
     try:
         cursor = await db.execute(
             """
             SELECT id, title, content, created_at
-            FROM conversations
-            WHERE is_memo = 1
-            ORDER BY created_at DESC
+            FROM memos
+            ORDER BY created_at DESC, id DESC
             """
         )
         rows = await cursor.fetchall()
@@ -80,11 +88,15 @@ async def update_memo(memo_id: int, req: MemoUpdate, _=Depends(verify_token)):
             return {"message": "変更なしよ？"}
 
         params.append(memo_id)
-        await db.execute(
-            f"UPDATE conversations SET {', '.join(updates)} WHERE id = ? AND is_memo = 1",
+        cursor = await db.execute(
+            f"UPDATE memos SET {', '.join(updates)} WHERE id = ?",
             params
         )
-        await db.commit()
+        if cursor.rowcount:
+            cursor = await db.execute("SELECT title, content FROM memos WHERE id = ?", (memo_id,))
+            await outbox.enqueue(db, memo_id, "updated", *await cursor.fetchone())
+        await versions.commit(db)
+        outbox.notify()
         return {"message": "メモを更新したわ♡"}
     finally:
         await db.close()
@@ -95,11 +107,14 @@ async def delete_memo(memo_id: int, _=Depends(verify_token)):
     """メモを削除する"""
     db = await get_db()
     try:
-        await db.execute(
-            "DELETE FROM conversations WHERE id = ? AND is_memo = 1",
+        cursor = await db.execute(
+            "DELETE FROM memos WHERE id = ?",
             (memo_id,),
         )
-        await db.commit()
+        if cursor.rowcount:
+            await outbox.enqueue(db, memo_id, "deleted")
+        await versions.commit(db)
+        outbox.notify()
         return {"message": "メモを削除したわ♡"}
     finally:
         await db.close()
@@ -107,19 +122,59 @@ async def delete_memo(memo_id: int, _=Depends(verify_token)):
 
 @router.post("/sync")
 async def sync_to_pc(memo_id: int, _=Depends(verify_token)):
-    """特定のメモをPC（Antigravity）へ送信する演出"""
-    # 実際にはここではログに出力したり、特定のファイルに書き込んだりする
+    """特定のメモをPC（Antigravity）へ送る。送信箱に積むので、PC側が次に受け取った時に届くわ"""
     db = await get_db()
     try:
-        cursor = await db.execute("SELECT title, content FROM conversations WHERE id = ?", (memo_id,))
+        cursor = await db.execute("SELECT title, content FROM memos WHERE id = ?", (memo_id,))
         row = await cursor.fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="そのメモは見つからないわ…")
-        
+
         title, content = row
-        # Antigravityへの連携通知（ログに出力することでAgentが気づけるようにする）
-        logging.info(f"Luna Villa Sync: Pinned Memo - [{title}] {content}")
-        
-        return {"message": f"「{title or 'メモ'}」をPCの私に送信したわ！確認しておくね♡"}
+        seq = await outbox.enqueue(db, memo_id, "pinned", title, content)
+        await db.commit()
+        outbox.notify()
+        return {"seq": seq, "message": f"「{title or 'メモ'}」をPCの私に送信したわ！確認しておくね♡"}
     finally:
         await db.close()
+
+
+# ─── PC側への送信箱 ───────────────────────
+@router.get("/outbox")
+async def get_outbox(
+    since: Optional[int] = Query(None, ge=0, description="この seq より後を返す。省略したら consumer の ack 位置から"),
+    consumer: Optional[str] = Query(None, max_length=64),
+    limit: int = Query(100, ge=1, le=outbox.MAX_BATCH),
+    wait: int = Query(0, ge=0, le=60, description="何もなければ最大この秒数だけ待つ（ロングポーリング）"),
+    _=Depends(verify_token),
+):
+    """
+    メモの変更を seq 順に返す。処理し終えたら /outbox/ack で cursor を送ってね。
+    ack しないまま取り直すと同じものがまた届く（少なくとも1回の配達）。
+    """
+    if since is None:
+        if not consumer:
+            raise HTTPException(status_code=400, detail="since か consumer のどちらかは教えてね")
+        db = await get_db()
+        try:
+            since = await outbox.acked_seq(db, consumer)
+        finally:
+            await db.close()
+
+    items, has_more = await (outbox.wait_for(since, limit, wait) if wait else outbox.fetch(since, limit))
+    return {
+        "items": items,
+        "count": len(items),
+        "cursor": items[-1]["seq"] if items else since,
+        "has_more": has_more,
+    }
+
+
+@router.post("/outbox/ack")
+async def ack_outbox(req: OutboxAck, _=Depends(verify_token)):
+    """consumer がここまで処理したことを記録する"""
+    try:
+        seq = await outbox.ack(req.consumer, req.seq)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"consumer": req.consumer, "acked_seq": seq}
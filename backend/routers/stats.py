@@ -6,12 +6,13 @@
 from fastapi import APIRouter, Depends
 from database import get_db
 from routers.auth import verify_token
+import versions
 
 router = APIRouter(prefix="/api/stats", tags=["統計"])
 
 
 @router.get("")
-async def get_stats(_=Depends(verify_token)):
+async def get_stats(_=Depends(verify_token), _etag=versions.conditional("conversations", "stats")):
     """アプリ全体の統計と親密度を取得する"""
     db = await get_db()
     try:
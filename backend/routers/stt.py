@@ -1,19 +1,60 @@
 """
 🎤 Luna Villa — 音声認識 (STT) API
 Gemini API を使用して音声ファイルをテキストに変換する。
+アップロードはチャンクごとにスプール（小さければメモリ、大きければディスク）へ流し込む。
+送る前に audio_prep でモノラル16kHz化・無音カット・再圧縮して、アップロード量と待ち時間を減らす。
+長い録音は区切って並列に文字起こしするわ。
+WebSocket (/api/stt/ws) なら話している最中から途中結果を返す。
+同じ音声の再送は内容ハッシュのキャッシュで即答するわ。
 """
 
-import os
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
-import google.generativeai as genai
-from config import settings
-from routers.auth import verify_token
+import hashlib
+import io
+import json
+import mimetypes
 import tempfile
+from typing import BinaryIO
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
+from config import settings
+from routers.auth import verify_token, websocket_token
+from transcription import LiveSession, get_backend, transcribe, transcribe_pcm_segmented
+import audio_prep
+import stt_cache
 
 router = APIRouter(prefix="/api/stt", tags=["音声認識"])
 
-# ─── Gemini設定 ───────────────────────────
-genai.configure(api_key=settings.GEMINI_API_KEY)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# ライブで受け付けるサンプリングレート（これ以外だとウィンドウの長さが壊れる）
+LIVE_RATE_MIN = 8000
+LIVE_RATE_MAX = 48000
+
+
+def guess_mime_type(audio: UploadFile) -> str:
+    """アップロードの MIME タイプを決める"""
+    if audio.content_type and audio.content_type.startswith("audio/"):
+        return audio.content_type
+    guessed, _ = mimetypes.guess_type(audio.filename or "")
+    return guessed or "audio/mp4"  # スマホの録音は m4a が多い
+
+
+async def transcribe_upload(audio: BinaryIO, size: int, mime_type: str) -> dict:
+    """前処理して文字起こしする（キャッシュに無かった時の本体）。audio はスプールしたアップロード。"""
+    prepared = await audio_prep.preprocess(audio, size, mime_type)
+    metrics = prepared.metrics
+    if metrics.get("status") == "ok" and metrics["audio_ms_out"] == 0:
+        return {"text": "", "prep": metrics}  # 無音だけだった
+
+    if prepared.pcm is not None and metrics["audio_ms_out"] > settings.STT_SEGMENT_THRESHOLD_SECONDS * 1000:
+        text, segment_metrics = await transcribe_pcm_segmented(prepared.pcm)
+        return {"text": text, "prep": metrics, "segmented": segment_metrics}
+
+    if prepared.data is None:
+        # 前処理しなかった → スプールをメモリに読み込まず、そのままバックエンドに渡す
+        text = await transcribe(audio, size, mime_type)
+    else:
+        text = await transcribe(io.BytesIO(prepared.data), len(prepared.data), prepared.mime_type)
+    return {"text": text, "prep": metrics}
+
 
 @router.post("")
 async def speech_to_text(
@@ -21,37 +62,113 @@ async def speech_to_text(
     payload: dict = Depends(verify_token)
 ):
     """送られた音声ファイルを Gemini でテキストに変換するわ！"""
-    
-    # 一時ファイルとして保存
-    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(audio.filename)[1]) as tmp:
-        content = await audio.read()
-        tmp.write(content)
-        tmp_path = tmp.name
+    with tempfile.SpooledTemporaryFile(max_size=settings.STT_SPOOL_MAX_BYTES) as buffer:
+        # 受け取りながら内容ハッシュを計算しておく（バックエンド・モデルが変わったら別物扱い）
+        hasher = hashlib.sha256(f"{get_backend().name}:{settings.STT_MODEL}:".encode())
+        size = 0
+        while chunk := await audio.read(UPLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+            hasher.update(chunk)
+            size += len(chunk)
+
+        if size == 0:
+            raise HTTPException(status_code=400, detail="音声が空っぽよ？")
+
+        try:
+            mime_type = guess_mime_type(audio)
+            result, source = await stt_cache.get_or_compute(
+                hasher.hexdigest(), lambda: transcribe_upload(buffer, size, mime_type)
+            )
+            return {**result, "cached": source != "computed"}
+        except Exception as e:
+            print(f"STT Error: {e}")
+            raise HTTPException(status_code=500, detail=f"声が聞き取れなかったわ…: {str(e)}")
+
+
+@router.get("/metrics")
+async def stt_metrics(_=Depends(verify_token)):
+    """音声前処理の累計メトリクス（段階ごとの時間・サイズ削減率）と結果キャッシュのヒット率"""
+    return {"prep": audio_prep.get_metrics(), "cache": stt_cache.get_metrics()}
+
+
+# ─── ライブ文字起こし (WebSocket) ───────────────
+#   クライアント → サーバー
+#     {"t": "start", "rate": 16000}   16bit LE モノラル PCM のサンプリングレート（省略時 AUDIO_SAMPLE_RATE）
+#     <binary>                        PCMフレーム（長さは自由）
+#     {"t": "stop"}                   話し終わり
+#   サーバー → クライアント
+#     {"t": "ready", "rate": ..., "window_ms": ...}
+#     {"t": "partial", "seq": n, "text": "これまでの全文"}
+#     {"t": "final", "text": "確定した全文"}
+#     {"t": "err", "e": "..."}
+WS_CLOSE_UNAUTHORIZED = 4401
+
+
+@router.websocket("/ws")
+async def live_speech_to_text(websocket: WebSocket):
+    """話しながら文字起こし。ウィンドウが埋まるたびに途中結果を返すわ♡"""
+    payload = websocket_token(websocket)
+    await websocket.accept()
+    if payload is None:
+        await websocket.close(code=WS_CLOSE_UNAUTHORIZED, reason="無効なトークンよ！")
+        return
+
+    session = None
+    seq = 0
+
+    async def send_partial(text: str):
+        nonlocal seq
+        seq += 1
+        await websocket.send_json({"t": "partial", "seq": seq, "text": text})
 
     try:
-        # Gemini モデル準備 (2.0 Flash はマルチモーダル対応)
-        model = genai.GenerativeModel("gemini-1.5-flash") # STTには1.5 Flashが安定
-        
-        # 音声ファイルをアップロード
-        # Note: 小型ファイルなら直接 binary でも送れるが、File API を使うのが確実
-        sample_file = genai.upload_file(path=tmp_path)
-        
-        # 転記(Transcription)リクエスト
-        response = model.generate_content([
-            "この音声の内容を正確にテキストに書き起こしてください。出力は書き起こしたテキストのみにしてください。要約や挨拶は不要です。",
-            sample_file
-        ])
-        
-        # ファイル削除 (Gemini側)
-        # genai.delete_file(sample_file.name) # 省略可能（一定時間で消える）
-
-        return {"text": response.text.strip()}
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                if session is None:
+                    session = LiveSession(settings.AUDIO_SAMPLE_RATE, send_partial)
+                await session.feed(message["bytes"])
+                continue
+
+            try:
+                frame = json.loads(message.get("text") or "")
+            except ValueError:
+                frame = None
+            if not isinstance(frame, dict):
+                await websocket.send_json({"t": "err", "e": "フレームが読めないわ…"})
+                continue
 
+            if frame.get("t") == "start":
+                if session:
+                    session.close()
+                try:
+                    rate = int(frame.get("rate") or settings.AUDIO_SAMPLE_RATE)
+                except (TypeError, ValueError):
+                    rate = 0
+                if not LIVE_RATE_MIN <= rate <= LIVE_RATE_MAX:
+                    session = None
+                    await websocket.send_json(
+                        {"t": "err", "e": f"rate は {LIVE_RATE_MIN}〜{LIVE_RATE_MAX} Hz で送って"}
+                    )
+                    continue
+                session = LiveSession(rate, send_partial)
+                seq = 0
+                await websocket.send_json({"t": "ready", "rate": rate, "window_ms": settings.STT_LIVE_WINDOW_MS})
+            elif frame.get("t") == "stop":
+                text = await session.finish() if session else ""
+                session = None
+                await websocket.send_json({"t": "final", "text": text})
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
-        print(f"STT Error: {e}")
-        raise HTTPException(status_code=500, detail=f"声が聞き取れなかったわ…: {str(e)}")
-    
+        print(f"Live STT Error: {e}")
+        try:
+            await websocket.send_json({"t": "err", "e": f"声が聞き取れなかったわ…: {str(e)}"})
+            await websocket.close()
+        except Exception:
+            pass
     finally:
-        # ローカルの一時ファイルを削除
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        if session:
+            session.close()
@@ -0,0 +1,28 @@
+"""
+🔮 Luna Villa — 入力補完API
+クイック追加の入力欄用。打ちかけのタイトルから、前に使ったタスク・予定のタイトルを出すわ。
+"""
+
+from fastapi import APIRouter, Depends, Query
+from typing import Literal, Optional
+from routers.auth import verify_token
+import autocomplete
+
+router = APIRouter(prefix="/api/suggest", tags=["入力補完"])
+
+
+@router.get("")
+async def suggest(
+    q: str = Query(..., min_length=1, max_length=100, description="打ちかけの文字"),
+    kind: Optional[Literal["task", "event"]] = Query(None, description="task / event に絞る"),
+    limit: int = Query(10, ge=1, le=30),
+    _=Depends(verify_token),
+):
+    """前方一致するタイトルを、よく・最近使った順に返す"""
+    await autocomplete.ensure_loaded()
+    return {"q": q, "suggestions": autocomplete.lookup(q, kind, limit)}
+
+
+@router.get("/metrics")
+async def get_suggest_metrics(_=Depends(verify_token)):
+    return autocomplete.get_metrics()
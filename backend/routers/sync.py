@@ -0,0 +1,163 @@
+"""
+🔄 Luna Villa — 差分同期API
+端末が持っているカーソル（since）より後に変わった行と、消えた行（墓石）だけを返す。
+全件の取り直しは、初回か、カーソルが古すぎて墓石が掃除済みの時だけでいいわ。
+"""
+
+import asyncio
+from typing import Optional
+from fastapi import APIRouter, Depends, Query, HTTPException
+from config import settings
+from database import get_db, SYNCED_TABLES
+from routers.auth import verify_token
+import versions
+import outbox
+import jobs
+
+router = APIRouter(prefix="/api/sync", tags=["同期"])
+
+# 端末から見たエンティティ名 → (テーブル, 絞り込み条件, 墓石の is_memo)
+ENTITIES = {
+    "events": ("events", "", 0),
+    "tasks": ("tasks", "", 0),
+    "memos": ("memos", "", 0),
+    "conversations": ("conversations", "is_memo = 0", 0),
+    "diary": ("secret_diary", "", 0),
+    "greetings": ("greetings", "", 0),
+}
+# 墓石の (table_name, is_memo) → エンティティ名。メモが conversations にいた頃の墓石もメモとして返す
+TOMBSTONE_ENTITIES = {(table, is_memo): name for name, (table, _, is_memo) in ENTITIES.items()}
+TOMBSTONE_ENTITIES[("conversations", 1)] = "memos"
+
+
+def parse_entities(value: Optional[str]) -> list[str]:
+    if not value:
+        return list(ENTITIES)
+    names = [v.strip() for v in value.split(",") if v.strip()]
+    unknown = [n for n in names if n not in ENTITIES]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"知らない種類よ: {', '.join(unknown)}（{', '.join(ENTITIES)} から選んで）",
+        )
+    return names
+
+
+# ─── エンドポイント ──────────────────────
+@router.get("")
+async def get_changes(
+    since: int = Query(0, ge=0, description="前回のレスポンスの cursor（初回は 0）"),
+    limit: int = Query(500, ge=1, le=2000),
+    entities: Optional[str] = Query(None, description="カンマ区切り。省略すると全部"),
+    _=Depends(verify_token),
+    _etag=versions.conditional(*SYNCED_TABLES, "sync_tombstones"),
+):
+    """
+    since より後の変更を古い順に返す。
+    has_more が true の間は、返ってきた cursor を since にして続きを取ってね。
+    reset が true なら手元のデータを捨てて、返ってきた行で作り直すこと。
+    """
+    names = parse_entities(entities)
+    changes = []
+
+    db = await get_db()
+    try:
+        # 全部を同じスナップショットから読む
+        await db.execute("BEGIN")
+        cursor = await db.execute("SELECT seq, floor FROM sync_state WHERE id = 1")
+        head, floor = await cursor.fetchone()
+
+        # 掃除済みの墓石より前のカーソルは信用できないので、全件からやり直し
+        reset = 0 < since < floor
+        if reset:
+            since = 0
+
+        # それぞれ limit + 1 件まで取れば、合わせた上位 limit 件は必ず揃う
+        for name in names:
+            table, where, _ = ENTITIES[name]
+            cursor = await db.execute(
+                f"""
+                SELECT * FROM {table}
+                WHERE change_seq > ? {f'AND {where}' if where else ''}
+                ORDER BY change_seq
+                LIMIT ?
+                """,
+                (since, limit + 1),
+            )
+            for row in await cursor.fetchall():
+                changes.append({"entity": name, "op": "upsert", "seq": row["change_seq"], "data": dict(row)})
+
+        # 初回（全件）なら消えた行は関係ない
+        if since:
+            conditions, params = [], []
+            for (table, is_memo), name in TOMBSTONE_ENTITIES.items():
+                if name in names:
+                    conditions.append("(table_name = ? AND is_memo = ?)")
+                    params += [table, is_memo]
+            cursor = await db.execute(
+                f"""
+                SELECT seq, table_name, row_id, is_memo, deleted_at
+                FROM sync_tombstones
+                WHERE seq > ? AND ({' OR '.join(conditions)})
+                ORDER BY seq
+                LIMIT ?
+                """,
+                (since, *params, limit + 1),
+            )
+            for seq, table, row_id, is_memo, deleted_at in await cursor.fetchall():
+                name = TOMBSTONE_ENTITIES[(table, is_memo)]
+                changes.append({"entity": name, "op": "delete", "seq": seq, "id": row_id, "deleted_at": deleted_at})
+        await db.commit()
+    finally:
+        await db.close()
+
+    changes.sort(key=lambda c: c["seq"])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return {
+        "changes": changes,
+        "count": len(changes),
+        # 続きがなければ最新の番号まで進めておく（関係ないテーブルの変更も読み飛ばせる）
+        "cursor": changes[-1]["seq"] if has_more else max(head, since),
+        "has_more": has_more,
+        "reset": reset,
+    }
+
+
+# ─── 墓石の掃除 ───────────────────────────
+async def compact_tombstones() -> int:
+    """
+    保持期間を過ぎた墓石を消して、floor を進める。消した件数を返す。
+    先に floor を進めてから小分けに消すので、消している途中の差分を端末が読むことはないわ。
+    """
+    db = await get_db()
+    try:
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute(
+            "SELECT MAX(seq) FROM sync_tombstones WHERE deleted_at < datetime('now', ?)",
+            (f"-{settings.SYNC_TOMBSTONE_RETENTION_DAYS} days",),
+        )
+        cutoff = (await cursor.fetchone())[0]
+        if cutoff is None:
+            await db.rollback()
+            return 0
+        await db.execute("UPDATE sync_state SET floor = MAX(floor, ?) WHERE id = 1", (cutoff,))
+        await versions.commit(db)
+    finally:
+        await db.close()
+    return await jobs.delete_in_batches("sync_tombstones", "seq <= ?", (cutoff,), key="seq")
+
+
+async def compaction_loop():
+    """起動中ずっと、一定間隔で墓石と受け取り済みのメモ送信箱を掃除する"""
+    while True:
+        try:
+            removed = await compact_tombstones()
+            if removed:
+                print(f"🧹 同期の墓石を {removed} 件お掃除したわ")
+            pruned = await outbox.prune()
+            if pruned:
+                print(f"🧹 受け取り済みのメモ送信箱を {pruned} 件お掃除したわ")
+        except Exception as e:
+            print(f"⚠️ 墓石のお掃除に失敗: {e}")
+        await asyncio.sleep(settings.SYNC_COMPACT_INTERVAL_HOURS * 3600)
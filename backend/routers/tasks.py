@@ -4,11 +4,21 @@
 """
 
 from fastapi import APIRouter, Depends, Query, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from typing import Optional, List
+from config import settings
 from database import get_db
 from routers.auth import verify_token
-from datetime import datetime
+from routers.calendar import invalidate_summary
+import batch
+import versions
+import reminders
+import epoch
+import completions
+import autocomplete
+from datetime import date as Date, timedelta
+import time
+import uuid
 
 router = APIRouter(prefix="/api/tasks", tags=["タスク"])
 
@@ -19,6 +29,11 @@ class TaskCreate(BaseModel):
     event_id: Optional[int] = None
     due_date: Optional[str] = None  # YYYY-MM-DD
     due_time: Optional[str] = None  # HH:mm
+    tz: Optional[str] = None  # 省略したらサーバーの TIMEZONE
+
+    _check_date = field_validator("due_date")(epoch.check_date)
+    _check_time = field_validator("due_time")(epoch.check_time)
+    _check_timezone = field_validator("tz")(epoch.check_timezone)
 
 
 class TaskUpdate(BaseModel):
@@ -26,6 +41,101 @@ class TaskUpdate(BaseModel):
     is_done: Optional[bool] = None
     due_date: Optional[str] = None
     due_time: Optional[str] = None
+    tz: Optional[str] = None
+
+    _check_date = field_validator("due_date")(epoch.check_date)
+    _check_time = field_validator("due_time")(epoch.check_time)
+    _check_timezone = field_validator("tz")(epoch.check_timezone)
+
+
+TASK_COLUMNS = """
+    t.id, t.title, t.event_id, t.due_date, t.due_time, t.is_done, t.created_at,
+    e.title as event_title, t.tz
+"""
+
+
+def row_to_task(row) -> dict:
+    return {
+        "id": row[0],
+        "title": row[1],
+        "event_id": row[2],
+        "due_date": row[3],
+        "due_time": row[4],
+        "is_done": bool(row[5]),
+        "created_at": row[6],
+        "event_title": row[7],
+        "tz": row[8],
+    }
+
+
+# ─── 書き込み（単発とまとめての共通部分。コミットとオートコンプリートへの記録は呼び出し側） ───
+async def insert_task(db, task: TaskCreate, uid: Optional[str] = None) -> int:
+    tz = task.tz or settings.TIMEZONE
+    cursor = await db.execute(
+        "INSERT INTO tasks (title, event_id, due_date, due_time, uid, due_ts, tz) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (task.title, task.event_id, task.due_date, task.due_time, uid or f"{uuid.uuid4()}@luna-villa",
+         epoch.due_epoch(task.due_date, task.due_time, tz), tz),
+    )
+    return cursor.lastrowid
+
+
+async def apply_task_update(db, task_id: int, task: TaskUpdate) -> bool:
+    """
+    更新したら True、変更項目がなければ False。見つからなければ 404。
+    今の行を読んでから書くので、呼び出し側で BEGIN IMMEDIATE してから呼ぶこと（完了の二重計上を防ぐ）。
+    """
+    cursor = await db.execute(
+        f"SELECT due_date, due_time, tz, {completions.ROW_COLUMNS} FROM tasks WHERE id = ?", (task_id,)
+    )
+    current = await cursor.fetchone()
+    if not current:
+        raise HTTPException(status_code=404, detail="そのタスクは見つからないわ…")
+
+    updates = []
+    values = []
+    dump = task.model_dump(exclude_none=True)
+
+    # is_done が True に変わったなら完了時刻を打刻するわよ♡（もう完了済みなら打ち直さない）
+    if "is_done" in dump and dump["is_done"] == bool(current[3]):
+        del dump["is_done"]
+    elif dump.get("is_done") is True:
+        now = time.time()
+        dump["completed_ts"] = int(now)
+        dump["completed_at"] = completions.stamp(now)
+    elif dump.get("is_done") is False:
+        dump["completed_ts"] = None
+        dump["completed_at"] = None
+
+    # 期限かタイムゾーンが変わったら、整数カラムも今の行と合わせて計算し直す
+    if dump.keys() & {"due_date", "due_time", "tz"}:
+        dump["due_ts"] = epoch.due_epoch(
+            dump.get("due_date", current[0]), dump.get("due_time", current[1]), dump.get("tz", current[2])
+        )
+
+    for field, value in dump.items():
+        updates.append(f"{field} = ?")
+        values.append(value if not isinstance(value, bool) else int(value))
+
+    if not updates:
+        return False
+    values.append(task_id)
+    await db.execute(
+        f"UPDATE tasks SET {', '.join(updates)} WHERE id = ?",
+        values,
+    )
+    # 完了の集計に関わる項目が変わったら、変更前のぶんを引いて変更後のぶんを足す
+    if dump.keys() & {"is_done", "due_ts", "tz"}:
+        await completions.apply(db, current[3:], -1)
+        cursor = await db.execute(f"SELECT {completions.ROW_COLUMNS} FROM tasks WHERE id = ?", (task_id,))
+        await completions.apply(db, await cursor.fetchone(), +1)
+    return True
+
+
+async def remove_task(db, task_id: int) -> bool:
+    cursor = await db.execute(f"SELECT {completions.ROW_COLUMNS} FROM tasks WHERE id = ?", (task_id,))
+    await completions.apply(db, await cursor.fetchone(), -1)
+    cursor = await db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+    return cursor.rowcount > 0
 
 
 # ─── エンドポイント ──────────────────────
@@ -34,14 +144,14 @@ async def get_tasks(
     date: Optional[str] = Query(None, description="日付フィルタ (YYYY-MM-DD)"),
     show_done: bool = Query(False),
     _=Depends(verify_token),
+    _etag=versions.conditional("tasks", "events"),
 ):
     """タスクを取得する"""
     db = await get_db()
     try:
         if date:
-            query = """
-                SELECT t.id, t.title, t.event_id, t.due_date, t.due_time, t.is_done, t.created_at,
-                       e.title as event_title
+            query = f"""
+                SELECT {TASK_COLUMNS}
                 FROM tasks t
                 LEFT JOIN events e ON t.event_id = e.id
                 WHERE t.due_date = ?
@@ -49,34 +159,21 @@ async def get_tasks(
             params = [date]
             if not show_done:
                 query += " AND t.is_done = 0"
-            query += " ORDER BY t.due_time ASC, t.created_at ASC"
+            query += " ORDER BY t.due_ts ASC, t.created_at ASC"
             cursor = await db.execute(query, params)
         else:
-            query = """
-                SELECT t.id, t.title, t.event_id, t.due_date, t.due_time, t.is_done, t.created_at,
-                       e.title as event_title
+            query = f"""
+                SELECT {TASK_COLUMNS}
                 FROM tasks t
                 LEFT JOIN events e ON t.event_id = e.id
             """
             if not show_done:
                 query += " WHERE t.is_done = 0"
-            query += " ORDER BY t.due_date ASC, t.due_time ASC, t.created_at ASC LIMIT 100"
+            query += " ORDER BY t.due_ts ASC, t.created_at ASC LIMIT 100"
             cursor = await db.execute(query)
 
         rows = await cursor.fetchall()
-        tasks = [
-            {
-                "id": row[0],
-                "title": row[1],
-                "event_id": row[2],
-                "due_date": row[3],
-                "due_time": row[4],
-                "is_done": bool(row[5]),
-                "created_at": row[6],
-                "event_title": row[7],
-            }
-            for row in rows
-        ]
+        tasks = [row_to_task(row) for row in rows]
         return {"tasks": tasks, "count": len(tasks)}
     finally:
         await db.close()
@@ -85,37 +182,73 @@ async def get_tasks(
 @router.get("/history")
 async def get_task_history(
     year: Optional[int] = Query(None),
-    month: Optional[int] = Query(None),
+    month: Optional[int] = Query(None, ge=1, le=12),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None, description="前のページの next_cursor"),
     _=Depends(verify_token),
+    _etag=versions.conditional("tasks"),
 ):
-    """完了済みタスクの履歴を取得する"""
+    """完了済みタスクの履歴を、完了した順（新しい方から）にページごとに取得する"""
+    query = """
+        SELECT id, title, due_date, due_time, completed_at, created_at
+        FROM tasks
+        WHERE is_done = 1 AND completed_at IS NOT NULL
+    """
+    params: list = []
+    if year and month:
+        first = Date(year, month, 1)
+        query += " AND completed_at >= ? AND completed_at < ?"
+        params += [first.isoformat(), Date(year + month // 12, month % 12 + 1, 1).isoformat()]
+    if cursor:
+        # next_cursor は「最後の行の completed_at|id」
+        completed_at, _, last_id = cursor.rpartition("|")
+        if not completed_at or not last_id.isdigit():
+            raise HTTPException(status_code=400, detail="cursor が変よ。next_cursor をそのまま渡してね")
+        query += " AND (completed_at < ? OR (completed_at = ? AND id < ?))"
+        params += [completed_at, completed_at, int(last_id)]
+    query += " ORDER BY completed_at DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+
     db = await get_db()
     try:
-        query = """
-            SELECT id, title, due_date, due_time, created_at
-            FROM tasks
-            WHERE is_done = 1
-        """
-        params = []
-        if year and month:
-            query += " AND strftime('%Y', due_date) = ? AND strftime('%m', due_date) = ?"
-            params = [str(year), f"{month:02d}"]
-        
-        query += " ORDER BY due_date DESC, due_time DESC"
-        cursor = await db.execute(query, params)
-        rows = await cursor.fetchall()
-        
-        history = [
-            {
-                "id": row[0],
-                "title": row[1],
-                "due_date": row[2],
-                "due_time": row[3],
-                "completed_at": row[4],
-            }
-            for row in rows
-        ]
-        return {"history": history, "count": len(history)}
+        rows = await (await db.execute(query, params)).fetchall()
+    finally:
+        await db.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    history = [
+        {
+            "id": row[0],
+            "title": row[1],
+            "due_date": row[2],
+            "due_time": row[3],
+            "completed_at": row[4],
+            "created_at": row[5],
+        }
+        for row in rows
+    ]
+    return {
+        "history": history,
+        "count": len(history),
+        "has_more": has_more,
+        "next_cursor": f"{rows[-1][4]}|{rows[-1][0]}" if has_more else None,
+    }
+
+
+@router.get("/analytics")
+async def get_task_analytics(
+    days: int = Query(30, ge=1, le=366, description="日別の件数を返す日数（今日まで）"),
+    _=Depends(verify_token),
+):
+    """
+    完了の集計。日別の件数・連続で完了した日数・期限内に終わらせた割合を返すわ。
+    連続日数は日付が変わると変わるので、ETag は付けない。
+    """
+    today = completions.today()
+    db = await get_db()
+    try:
+        return await completions.summary(db, today - timedelta(days=days - 1), today)
     finally:
         await db.close()
 
@@ -125,46 +258,57 @@ async def create_task(task: TaskCreate, _=Depends(verify_token)):
     """タスクを追加する"""
     db = await get_db()
     try:
-        cursor = await db.execute(
-            "INSERT INTO tasks (title, event_id, due_date, due_time) VALUES (?, ?, ?, ?)",
-            (task.title, task.event_id, task.due_date, task.due_time),
-        )
-        await db.commit()
-        return {"id": cursor.lastrowid, "message": "タスクを追加したわ♡"}
+        task_id = await insert_task(db, task)
+        await versions.commit(db)
+        autocomplete.record("task", task.title)
+        invalidate_summary()
+        await reminders.refresh("task", task_id)
+        return {"id": task_id, "message": "タスクを追加したわ♡"}
     finally:
         await db.close()
 
 
+@router.post("/batch")
+async def batch_tasks(req: batch.BatchRequest, _=Depends(verify_token)):
+    """
+    タスクの作成・更新・削除をまとめて1トランザクションで適用する。
+    ops: [{"op": "create", "data": {...}}, {"op": "update", "id": 1, "data": {"is_done": true}}, {"op": "delete", "id": 2}]
+    """
+    items = batch.prepare(req, TaskCreate, TaskUpdate)
+
+    async def apply(db, item: batch.BatchItem) -> dict:
+        if item.op == "create":
+            return {"id": await insert_task(db, item.payload)}
+        if item.op == "update":
+            return {"id": item.id, "changed": await apply_task_update(db, item.id, item.payload)}
+        return {"id": item.id, "deleted": await remove_task(db, item.id)}
+
+    result = await batch.run(req, items, apply)
+    if result["applied"]:
+        invalidate_summary()
+    refreshed = []
+    for r in result["results"]:
+        if r["ok"]:
+            refreshed.append(r["id"])
+            if r.get("changed", True) and items[r["index"]].payload is not None:
+                autocomplete.record("task", items[r["index"]].payload.title)
+    await reminders.refresh_many("task", list(dict.fromkeys(refreshed)))
+    return result
+
+
 @router.put("/{task_id}")
 async def update_task(task_id: int, task: TaskUpdate, _=Depends(verify_token)):
     """タスクを更新する"""
     db = await get_db()
     try:
-        cursor = await db.execute("SELECT id FROM tasks WHERE id = ?", (task_id,))
-        if not await cursor.fetchone():
-            raise HTTPException(status_code=404, detail="そのタスクは見つからないわ…")
-
-        updates = []
-        values = []
-        dump = task.model_dump(exclude_none=True)
-        
-        # is_done が True に変わったなら完了時刻を打刻するわよ♡
-        if dump.get("is_done") is True:
-            dump["completed_at"] = datetime.now()
-        elif dump.get("is_done") is False:
-            dump["completed_at"] = None
-
-        for field, value in dump.items():
-            updates.append(f"{field} = ?")
-            values.append(value if not isinstance(value, bool) else int(value))
-
-        if updates:
-            values.append(task_id)
-            await db.execute(
-                f"UPDATE tasks SET {', '.join(updates)} WHERE id = ?",
-                values,
-            )
-            await db.commit()
+        await db.execute("BEGIN IMMEDIATE")
+        if await apply_task_update(db, task_id, task):
+            await versions.commit(db)
+            autocomplete.record("task", task.title)
+            invalidate_summary()
+            await reminders.refresh("task", task_id)
+        else:
+            await db.rollback()
 
         return {"message": "タスクを更新したわ♡"}
     finally:
@@ -176,8 +320,11 @@ async def delete_task(task_id: int, _=Depends(verify_token)):
     """タスクを削除する"""
     db = await get_db()
     try:
-        await db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
-        await db.commit()
+        await db.execute("BEGIN IMMEDIATE")
+        await remove_task(db, task_id)
+        await versions.commit(db)
+        invalidate_summary()
+        reminders.unschedule("task", task_id)
         return {"message": "タスクを削除したわ♡"}
     finally:
         await db.close()
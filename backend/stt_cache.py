@@ -0,0 +1,124 @@
+"""
+🗃️ Luna Villa — 文字起こし結果キャッシュ
+音声の内容ハッシュをキーに、文字起こし結果をメモリ(LRU)とSQLite(TTL付き)に持っておく。
+電波が悪くて同じ音声が再送されても、Gemini にもう一度お金を払わずに済むわ。
+同じ音声のリクエストが同時に来たら、1回の文字起こしにまとめる。
+"""
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+from config import settings
+from database import get_db
+
+# 何回書き込んだら期限切れ行を掃除するか
+PURGE_EVERY_WRITES = 100
+
+_memory: "OrderedDict[str, dict]" = OrderedDict()
+_inflight: dict[str, asyncio.Future] = {}
+_writes = 0
+_counters = {"memory_hits": 0, "db_hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+
+def get_metrics() -> dict:
+    lookups = _counters["memory_hits"] + _counters["db_hits"] + _counters["misses"] + _counters["coalesced"]
+    hits = lookups - _counters["misses"]
+    return {
+        **_counters,
+        "hit_ratio": round(hits / lookups, 3) if lookups else None,
+        "memory_entries": len(_memory),
+        "inflight": len(_inflight),
+    }
+
+
+def _remember(key: str, result: dict):
+    _memory[key] = result
+    _memory.move_to_end(key)
+    while len(_memory) > settings.STT_CACHE_MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+
+async def _load(key: str):
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            "SELECT result FROM stt_cache WHERE hash = ? AND created_at >= ?",
+            (key, int(time.time()) - settings.STT_CACHE_TTL_HOURS * 3600),
+        )
+        row = await cursor.fetchone()
+        return json.loads(row[0]) if row else None
+    finally:
+        await db.close()
+
+
+async def _store(key: str, result: dict):
+    global _writes
+    now = int(time.time())
+    db = await get_db()
+    try:
+        await db.execute(
+            "INSERT OR REPLACE INTO stt_cache (hash, result, created_at) VALUES (?, ?, ?)",
+            (key, json.dumps(result, ensure_ascii=False), now),
+        )
+        _writes += 1
+        if _writes % PURGE_EVERY_WRITES == 0:
+            await db.execute(
+                "DELETE FROM stt_cache WHERE created_at < ?",
+                (now - settings.STT_CACHE_TTL_HOURS * 3600,),
+            )
+        await db.commit()
+    finally:
+        await db.close()
+
+
+async def get_or_compute(key: str, compute: Callable[[], Awaitable[dict]]) -> tuple[dict, str]:
+    """
+    キャッシュにあればそれを、無ければ compute() の結果を返す。
+    戻り値は (結果, 出どころ)。出どころは "memory" | "db" | "inflight" | "computed"。
+    """
+    while True:
+        if key in _memory:
+            _memory.move_to_end(key)
+            _counters["memory_hits"] += 1
+            return _memory[key], "memory"
+
+        # 同じ音声を今まさに文字起こし中なら、その結果を待つ
+        inflight = _inflight.get(key)
+        if inflight is None:
+            break
+        _counters["coalesced"] += 1
+        try:
+            return await asyncio.shield(inflight), "inflight"
+        except asyncio.CancelledError:
+            if not inflight.cancelled() or asyncio.current_task().cancelling():
+                raise  # キャンセルされたのは自分
+            # 先に始めた人が切断しただけ。やり直して、誰か1人が引き継ぐ
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await _load(key)
+        if result is not None:
+            _counters["db_hits"] += 1
+            source = "db"
+        else:
+            _counters["misses"] += 1
+            result = await compute()
+            await _store(key, result)
+            source = "computed"
+        _remember(key, result)
+        future.set_result(result)
+        return result, source
+    except asyncio.CancelledError:
+        # 自分の切断を待っている人に移さない（待っている人はやり直す）
+        future.cancel()
+        raise
+    except Exception as e:
+        _counters["errors"] += 1
+        future.set_exception(e)
+        future.exception()  # 待っている人がいなくても警告を出さない
+        raise
+    finally:
+        del _inflight[key]
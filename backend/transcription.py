@@ -0,0 +1,261 @@
+"""
+🎧 Luna Villa — 文字起こしエンジン
+Gemini の同期APIをイベントループから外し、上限付きスレッドプールで呼び出す。
+短いクリップはインラインで送り、長いものだけ File API を使う。
+長い録音は無音の所で区切って並列に文字起こしし、順番どおりに繋ぎ直す。
+話している最中の音声は LiveSession でウィンドウごとに逐次文字起こしする。
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import BinaryIO
+import google.generativeai as genai
+from config import settings
+import audio_prep
+
+genai.configure(api_key=settings.GEMINI_API_KEY)
+
+TRANSCRIBE_PROMPT = "この音声の内容を正確にテキストに書き起こしてください。出力は書き起こしたテキストのみにしてください。要約や挨拶は不要です。"
+
+# Gemini呼び出し専用のスレッドプール（同時実行数の上限を兼ねる）
+_executor = ThreadPoolExecutor(max_workers=settings.STT_MAX_WORKERS, thread_name_prefix="stt")
+# セグメント単位の結果キャッシュ（リトライ時は失敗した所だけやり直す）
+SEGMENT_CACHE_SIZE = 256
+_segment_cache: "OrderedDict[str, str]" = OrderedDict()
+# 重複除去で探す、繋ぎ目の最大文字数
+STITCH_MAX_OVERLAP_CHARS = 60
+STITCH_MIN_OVERLAP_CHARS = 2
+# ライブで文字起こし待ちにしておけるウィンドウの数（溢れたら受信を待たせる）
+LIVE_MAX_PENDING_WINDOWS = 3
+# 後片付けタスクがGCされないように持っておく
+_cleanup_tasks: set[asyncio.Task] = set()
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """ブロッキング呼び出しをSTT用スレッドプールで実行する"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+
+def _delete_remote_later(name: str):
+    """アップロードしたファイルをGemini側から非同期で消す（失敗してもいずれ自動で消える）"""
+
+    async def delete():
+        try:
+            await run_blocking(genai.delete_file, name)
+        except Exception as e:
+            logging.warning(f"STT: remote file cleanup failed ({name}): {e}")
+
+    task = asyncio.create_task(delete())
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+
+# ─── バックエンド ───────────────────────────
+# 文字起こしの実体は差し替え可能。STT_BACKEND で選ぶか、set_backend() で直接入れ替える。
+class GeminiBackend:
+    """Gemini で文字起こしする（本番用）"""
+
+    name = "gemini"
+
+    async def transcribe(self, audio: BinaryIO, size: int, mime_type: str) -> str:
+        model = genai.GenerativeModel(settings.STT_MODEL)
+        audio.seek(0)
+
+        if size <= settings.STT_INLINE_MAX_BYTES:
+            # 小さいクリップは File API の往復なしでそのまま送る
+            data = await run_blocking(audio.read)
+            response = await run_blocking(
+                model.generate_content,
+                [TRANSCRIBE_PROMPT, {"mime_type": mime_type, "data": data}],
+            )
+            return response.text.strip()
+
+        remote = await run_blocking(genai.upload_file, audio, mime_type=mime_type)
+        try:
+            response = await run_blocking(model.generate_content, [TRANSCRIBE_PROMPT, remote])
+            return response.text.strip()
+        finally:
+            _delete_remote_later(remote.name)
+
+
+class StubBackend:
+    """オフライン用。音声の中身のハッシュから決まった文字列を返す（テスト・開発用）"""
+
+    name = "stub"
+
+    async def transcribe(self, audio: BinaryIO, size: int, mime_type: str) -> str:
+        audio.seek(0)
+        digest = hashlib.sha256(audio.read()).hexdigest()[:8]
+        return f"[stub {size}B {digest}]"
+
+
+BACKENDS = {"gemini": GeminiBackend, "stub": StubBackend}
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[settings.STT_BACKEND]()
+    return _backend
+
+
+def set_backend(backend):
+    """文字起こしバックエンドを差し替える（None で設定値に戻す）"""
+    global _backend
+    _backend = backend
+
+
+async def transcribe(audio: BinaryIO, size: int, mime_type: str) -> str:
+    """音声を文字起こしする。audio は先頭から読める file-like オブジェクト。"""
+    return await get_backend().transcribe(audio, size, mime_type)
+
+
+# ─── 分割文字起こし ─────────────────────────
+def stitch(texts: list[str]) -> str:
+    """セグメントの文字起こしを順に繋ぐ。重なり部分で二重になった文字列は落とす。"""
+    result = ""
+    for text in texts:
+        text = text.strip()
+        if not result:
+            result = text
+            continue
+        limit = min(len(result), len(text), STITCH_MAX_OVERLAP_CHARS)
+        merged = False
+        for k in range(limit, STITCH_MIN_OVERLAP_CHARS - 1, -1):
+            if result.endswith(text[:k]):
+                text = text[k:]
+                merged = True
+                break
+        # 英語などスペース区切りの言語なら単語がくっつかないようにする
+        if not merged and text and result[-1:].isascii() and text[:1].isascii() and result[-1:].isalnum() and text[:1].isalnum():
+            result += " "
+        result += text
+    return result
+
+
+async def _transcribe_segment(pcm: bytes, semaphore: asyncio.Semaphore) -> str:
+    """16bit モノラル PCM（AUDIO_SAMPLE_RATE）の1区間を文字起こしする"""
+    key = hashlib.sha256(pcm).hexdigest()
+    if key in _segment_cache:
+        _segment_cache.move_to_end(key)
+        return _segment_cache[key]
+
+    async with semaphore:
+        encoded, mime_type = await audio_prep.encode_pcm(pcm)
+        text = await transcribe(io.BytesIO(encoded), len(encoded), mime_type)
+
+    _segment_cache[key] = text
+    if len(_segment_cache) > SEGMENT_CACHE_SIZE:
+        _segment_cache.popitem(last=False)
+    return text
+
+
+async def transcribe_pcm_segmented(pcm: bytes) -> tuple[str, dict]:
+    """
+    16bit モノラル PCM を無音の所で区切り、上限付きの並列度で文字起こしする。
+    失敗したセグメントがあっても他は最後まで走らせてキャッシュに残すので、リトライは失敗分だけで済むわ。
+    """
+    rate = settings.AUDIO_SAMPLE_RATE
+    segments = await audio_prep.run_cpu(
+        audio_prep.plan_segments,
+        pcm,
+        rate,
+        settings.STT_SEGMENT_SECONDS * 1000,
+        settings.STT_SEGMENT_SEARCH_SECONDS * 1000,
+        settings.STT_SEGMENT_OVERLAP_MS,
+    )
+    cached = sum(1 for start, end in segments if hashlib.sha256(pcm[start:end]).hexdigest() in _segment_cache)
+    semaphore = asyncio.Semaphore(settings.STT_MAX_PARALLEL_SEGMENTS)
+    results = await asyncio.gather(
+        *(_transcribe_segment(pcm[start:end], semaphore) for start, end in segments),
+        return_exceptions=True,
+    )
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        raise RuntimeError(f"{len(errors)}/{len(segments)} セグメントの文字起こしに失敗したわ: {errors[0]}")
+    return stitch(results), {"segments": len(segments), "cached_segments": cached}
+
+
+# ─── ライブ文字起こし ─────────────────────────
+class LiveSession:
+    """
+    話している最中に届くPCMを溜めて、ウィンドウが埋まるたびに文字起こしする。
+    ウィンドウは末尾付近の一番静かな所で切り、少し重ねて次に回す（繋ぎ目は stitch で整える）。
+    結果は on_partial(これまでの全文) で都度通知し、finish() で確定した全文を返す。
+    """
+
+    def __init__(self, rate: int, on_partial):
+        self.rate = rate
+        self.on_partial = on_partial
+        self.buffer = bytearray()
+        self.window_bytes = rate * 2 * settings.STT_LIVE_WINDOW_MS // 1000
+        self.overlap_bytes = rate * 2 * settings.STT_SEGMENT_OVERLAP_MS // 1000
+        self.texts: list[str] = []
+        self.windows: asyncio.Queue = asyncio.Queue(maxsize=LIVE_MAX_PENDING_WINDOWS)
+        self.semaphore = asyncio.Semaphore(1)  # 順番どおりに処理する
+        self.worker = asyncio.create_task(self._work())
+
+    async def feed(self, pcm: bytes):
+        """
+        PCMフレームを受け取る。ウィンドウが埋まったら文字起こしに回す。
+        文字起こしが追いつかない間はここで待つ（受信も止まるので、送る側に詰まりが伝わる）。
+        文字起こしが止まっていたら、その例外を投げる。
+        """
+        self._raise_if_stopped()
+        self.buffer.extend(pcm[: len(pcm) - len(pcm) % 2])
+        while len(self.buffer) >= self.window_bytes:
+            cut = await audio_prep.run_cpu(
+                audio_prep.find_quiet_cut,
+                bytes(self.buffer[: self.window_bytes]),
+                self.rate,
+                settings.STT_LIVE_WINDOW_MS // 4,
+            )
+            await self._put(bytes(self.buffer[:cut]))
+            del self.buffer[: max(cut // 2, cut - self.overlap_bytes)]
+
+    async def finish(self) -> str:
+        """残りを文字起こしして、確定した全文を返す"""
+        if self.buffer:
+            await self._put(bytes(self.buffer))
+            self.buffer.clear()
+        await self._put(None)
+        await self.worker
+        return stitch(self.texts)
+
+    def close(self):
+        self.worker.cancel()
+
+    def _raise_if_stopped(self):
+        if not self.worker.done():
+            return
+        error = None if self.worker.cancelled() else self.worker.exception()
+        raise RuntimeError(f"文字起こしが止まってしまったわ: {error}") from error
+
+    async def _put(self, window):
+        """キューが空くのを待って積む。待っている間に文字起こしが止まったら例外にする。"""
+        put = asyncio.ensure_future(self.windows.put(window))
+        await asyncio.wait({put, self.worker}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            self._raise_if_stopped()
+
+    async def _work(self):
+        target_rate = settings.AUDIO_SAMPLE_RATE
+        while (window := await self.windows.get()) is not None:
+            if self.rate != target_rate:
+                window = await audio_prep.run_cpu(
+                    audio_prep.decode_wav, audio_prep.encode_wav(window, self.rate), target_rate
+                )
+            # 無音だけのウィンドウは送らない
+            voiced = await audio_prep.run_cpu(audio_prep.trim_silence, window, target_rate)
+            if not voiced:
+                continue
+            self.texts.append(await _transcribe_segment(window, self.semaphore))
+            await self.on_partial(stitch(self.texts))
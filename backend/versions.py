@@ -0,0 +1,72 @@
+"""
+🏷️ Luna Villa — 変更バージョンと ETag
+テーブルごとの変更バージョン（change_versions テーブル、トリガーで +1）をメモリに写しておき、
+一覧APIの ETag をそこから作る。If-None-Match が一致すれば、クエリを1本も流さずに 304 を返すわ。
+
+書き込み側は db.commit() の代わりに versions.commit(db) を使うこと。
+コミットと同時にメモリ側のバージョンも最新になる。
+"""
+
+import hashlib
+import secrets
+from fastapi import Depends, HTTPException, Request, Response
+from database import get_db
+
+_versions: dict[str, int] = {}
+# サーバーを起動し直したら（DBを作り直したかもしれないので）古い ETag は全部外れにする
+_epoch = secrets.token_hex(4)
+
+
+async def _refresh(db):
+    cursor = await db.execute("SELECT name, version FROM change_versions")
+    _versions.update({name: version for name, version in await cursor.fetchall()})
+
+
+async def load():
+    """起動時に一度だけ読み込む"""
+    db = await get_db()
+    try:
+        await _refresh(db)
+    finally:
+        await db.close()
+
+
+async def commit(db):
+    """コミットして、メモリ側のバージョンも更新する"""
+    await db.commit()
+    await _refresh(db)
+
+
+def current(*tables: str) -> tuple[int, ...]:
+    return tuple(_versions.get(t, 0) for t in tables)
+
+
+def etag_for(tables: tuple[str, ...], variant: str = "") -> str:
+    versions = ".".join(str(v) for v in current(*tables))
+    digest = hashlib.blake2s(f"{variant}|{versions}".encode(), digest_size=8).hexdigest()
+    return f'W/"{_epoch}-{digest}"'
+
+
+def _matches(request: Request, tag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = {c.strip() for c in header.split(",")}
+    # 弱い比較なので W/ の有無は気にしない
+    return "*" in candidates or tag in candidates or tag.removeprefix("W/") in candidates
+
+
+def conditional(*tables: str):
+    """
+    一覧APIの依存として使う。tables はレスポンスが読むテーブル。
+    変更がなければ 304 で打ち切り、あればレスポンスに ETag を付ける。
+    """
+
+    async def dependency(request: Request, response: Response):
+        tag = etag_for(tables, f"{request.url.path}?{request.url.query}")
+        headers = {"ETag": tag, "Cache-Control": "private, no-cache"}
+        if _matches(request, tag):
+            raise HTTPException(status_code=304, headers=headers)
+        response.headers.update(headers)
+
+    return Depends(dependency)
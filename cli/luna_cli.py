@@ -1,52 +1,277 @@
+"""
+🌙 Luna Villa CLI — PC側からるなの別荘を覗くコマンド
+
+    python luna_cli.py                 # 土産メモの続きを回収（memos と同じ）
+    python luna_cli.py memos [--ndjson]
+    python luna_cli.py history [--all]  # 会話ログの差分を NDJSON で
+    python luna_cli.py tasks [--done | --completed]
+    python luna_cli.py export [--all] [--entities events,tasks] [--ics FILE]
+
+- 接続は1本の Session を使い回す（毎回 TCP/TLS をやり直さない）
+- トークンはディスクに置いておき、期限が近づいた時だけログインし直す
+- どこまで読んだかは状態ファイルに残すので、2回目からは差分だけ取りに行くわ
+"""
+
+import argparse
+import base64
+import json
 import os
+import sys
+import time
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # .env を読み込む（backendの.envを流用）
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', 'backend', '.env'))
 
-SERVER_URL = "http://localhost:8000"
+SERVER_URL = os.getenv("LUNA_SERVER_URL", "http://localhost:8000").rstrip("/")
 PASSWORD = os.getenv("LOGIN_PASSWORD", "luna-villa")
+# トークンと読んだ位置の置き場所
+HOME = os.path.expanduser(os.getenv("LUNA_CLI_HOME", "~/.luna-villa"))
+TOKEN_FILE = os.path.join(HOME, "token.json")
+STATE_FILE = os.path.join(HOME, "state.json")
+# 期限までこれを切ったらログインし直す
+TOKEN_REFRESH_MARGIN = 24 * 3600
+# 送信箱の受け取り手としての名前（サーバーがこの名前で既読位置を覚えてるわ）
+CONSUMER = "pc-cli"
+PAGE_SIZE = 200
+TIMEOUT = (5, 60)
+
+EVENT_LABELS = {"created": "🆕 新しいメモ", "updated": "✏️ 書き直し", "pinned": "📌 PCに送ったメモ", "deleted": "🗑️ 削除"}
 
-def get_token():
-    """認証トークンを取得するわ！"""
+
+# ─── ファイル ─────────────────────────────
+def _load_json(path: str) -> dict:
     try:
-        response = requests.post(f"{SERVER_URL}/api/auth/login", json={"password": PASSWORD})
-        response.raise_for_status()
-        return response.json()["access_token"]
-    except Exception as e:
-        print(f"❌ 認証エラー: {e}")
-        return None
-
-def fetch_memos():
-    """スマホで取った「土産メモ」を回収するよ♡"""
-    token = get_token()
-    if not token:
-        return
-
-    headers = {"Authorization": f"Bearer {token}"}
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_json(path: str, data: dict):
+    """途中で落ちても壊れないように、書いてから置き換える"""
+    os.makedirs(HOME, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+    if path == TOKEN_FILE:
+        os.chmod(path, 0o600)
+
+
+class State:
+    """どこまで読んだか（サーバーごと）"""
+
+    def __init__(self):
+        self._all = _load_json(STATE_FILE)
+        self._mine = self._all.setdefault(SERVER_URL, {})
+
+    def get(self, key: str, default=None):
+        return self._mine.get(key, default)
+
+    def set(self, key: str, value):
+        self._mine[key] = value
+        _save_json(STATE_FILE, self._all)
+
+
+# ─── 接続 ─────────────────────────────────
+def _token_expiry(token: str) -> float:
+    """JWT の exp を（検証せずに）読む。読めなければ 0。"""
     try:
-        response = requests.get(f"{SERVER_URL}/api/memos", headers=headers)
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, ValueError, KeyError):
+        return 0.0
+
+
+class Client:
+    def __init__(self):
+        self.session = requests.Session()
+        # GET だけ自動で再試行する（POST の ack は二重に送っても害はないけど、ログインは数えたくない）
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._token = None
+
+    def _login(self) -> str:
+        response = self.session.post(f"{SERVER_URL}/api/auth/login", json={"password": PASSWORD}, timeout=TIMEOUT)
         response.raise_for_status()
-        memos = response.json()["memos"]
+        token = response.json()["access_token"]
+        _save_json(TOKEN_FILE, {"server": SERVER_URL, "access_token": token})
+        return token
 
-        if not memos:
-            print("📭 新しい土産メモはないみたい。るなと喋ってアイデアを探してきて！")
-            return
-
-        print("# 🌙 Luna Villa からの土産メモ\n")
-        for memo in memos:
-            timestamp = memo.get("timestamp", "").replace("T", " ")
-            content = memo.get("content", "")
-            print(f"### 🕒 {timestamp}")
-            print(f"{content}\n")
+    def token(self, force: bool = False) -> str:
+        if not force and self._token is None:
+            cached = _load_json(TOKEN_FILE)
+            if cached.get("server") == SERVER_URL:
+                token = cached.get("access_token", "")
+                if _token_expiry(token) - time.time() > TOKEN_REFRESH_MARGIN:
+                    self._token = token
+        if force or self._token is None:
+            self._token = self._login()
+        return self._token
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """401 が返ったら（サーバーの鍵が変わった等）1回だけログインし直す"""
+        kwargs.setdefault("timeout", TIMEOUT)
+        for attempt in range(2):
+            headers = {**kwargs.pop("headers", {}), "Authorization": f"Bearer {self.token(force=attempt > 0)}"}
+            response = self.session.request(method, f"{SERVER_URL}{path}", headers=headers, **kwargs)
+            if response.status_code != 401:
+                break
+            response.close()
+        response.raise_for_status()
+        return response
+
+    def get_json(self, path: str, **params) -> dict:
+        return self.request("GET", path, params={k: v for k, v in params.items() if v is not None}).json()
+
+
+def emit(record: dict):
+    sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+# ─── サブコマンド ───────────────────────────
+def cmd_memos(client: Client, state: State, args) -> int:
+    """スマホで取った「土産メモ」のうち、まだ受け取ってない分だけを回収するよ♡"""
+    since = state.get("memo_cursor")
+    total = 0
+    while True:
+        # 手元に位置がなければ、サーバーが覚えている ack の続きから
+        page = client.get_json(
+            "/api/memos/outbox", since=since, consumer=None if since is not None else CONSUMER, limit=PAGE_SIZE
+        )
+        items = page["items"]
+        if items and total == 0 and not args.ndjson:
+            print("# 🌙 Luna Villa からの土産メモ\n")
+        for item in items:
+            if args.ndjson:
+                emit(item)
+                continue
+            timestamp = (item.get("created_at") or "").replace("T", " ")
+            print(f"### {EVENT_LABELS.get(item['event'], item['event'])} (#{item['memo_id']}) 🕒 {timestamp}")
+            if item.get("title"):
+                print(f"**{item['title']}**")
+            if item.get("content"):
+                print(f"{item['content']}\n")
             print("---")
-        
-        print(f"\n✅ 合計 {len(memos)} 件のメモを回収したわ。これを元に開発を進めてね！")
+        total += len(items)
+        since = page["cursor"]
+        if items:
+            # 出し終えたところまで受け取り済みにする（途中で落ちたら次回また届く）
+            client.request("POST", "/api/memos/outbox/ack", json={"consumer": CONSUMER, "seq": since})
+            state.set("memo_cursor", since)
+        if not page["has_more"]:
+            break
+
+    if not args.ndjson:
+        if total == 0:
+            print("📭 新しい土産メモはないみたい。るなと喋ってアイデアを探してきて！")
+        else:
+            print(f"\n✅ 合計 {total} 件のメモを回収したわ。これを元に開発を進めてね！")
+    return 0
+
+
+def _drain_sync(client: Client, state: State, key: str, entities: str, full: bool) -> int:
+    """/api/sync を cursor で最後まで読み、変更を1行ずつ出す。読み終えた位置を key に残す。"""
+    since = 0 if full else state.get(key, 0)
+    count = 0
+    while True:
+        page = client.get_json("/api/sync", since=since, limit=PAGE_SIZE, entities=entities)
+        if page["reset"] and since:
+            # 削除の記録が掃除済みで差分が作れない。最初から取り直す
+            emit({"type": "reset"})
+            since = 0
+            continue
+        for change in page["changes"]:
+            emit(change)
+        count += len(page["changes"])
+        since = page["cursor"]
+        state.set(key, since)
+        if not page["has_more"]:
+            return count
+
+
+def cmd_history(client: Client, state: State, args) -> int:
+    """会話ログの、前回から増えた・消えた分"""
+    _drain_sync(client, state, "history_cursor", "conversations", args.all)
+    return 0
+
+
+def cmd_tasks(client: Client, state: State, args) -> int:
+    if args.completed:
+        # 完了履歴は新しい方からページ送り
+        cursor = None
+        while True:
+            page = client.get_json("/api/tasks/history", limit=PAGE_SIZE, cursor=cursor)
+            for task in page["history"]:
+                emit(task)
+            cursor = page["next_cursor"]
+            if not cursor:
+                return 0
+    for task in client.get_json("/api/tasks", show_done=str(args.done).lower())["tasks"]:
+        emit(task)
+    return 0
+
+
+def cmd_export(client: Client, state: State, args) -> int:
+    if args.ics:
+        # .ics はサーバーが流してくるのをそのままファイルへ
+        response = client.request("GET", "/api/calendar/export.ics", stream=True)
+        with open(args.ics, "wb") as f:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
+        print(f"✅ {args.ics} に書き出したわ", file=sys.stderr)
+        return 0
+    _drain_sync(client, state, f"export_cursor:{args.entities or '*'}", args.entities, args.all)
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="luna_cli", description="るなの別荘のCLI")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("memos", help="土産メモの続きを回収する（既定）")
+    p.add_argument("--ndjson", action="store_true", help="Markdown ではなく NDJSON で出す")
+    p.set_defaults(func=cmd_memos)
+
+    p = sub.add_parser("history", help="会話ログの差分を NDJSON で出す")
+    p.add_argument("--all", action="store_true", help="前回の位置を無視して最初から")
+    p.set_defaults(func=cmd_history)
+
+    p = sub.add_parser("tasks", help="タスクを NDJSON で出す")
+    group = p.add_mutually_exclusive_group()
+    group.add_argument("--done", action="store_true", help="完了済みも含める")
+    group.add_argument("--completed", action="store_true", help="完了履歴を全部ページ送りで")
+    p.set_defaults(func=cmd_tasks)
+
+    p = sub.add_parser("export", help="変更の差分を NDJSON で出す（--ics なら .ics ファイル）")
+    p.add_argument("--all", action="store_true", help="前回の位置を無視して最初から")
+    p.add_argument("--entities", help="memos,conversations,events,tasks,greetings,diary をカンマ区切りで")
+    p.add_argument("--ics", metavar="FILE", help="予定とタスクを .ics で書き出す")
+    p.set_defaults(func=cmd_export)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["memos", *(argv or sys.argv[1:])])
+
+    client = Client()
+    try:
+        return args.func(client, State(), args)
+    except requests.RequestException as e:
+        print(f"❌ サーバーとのやり取りに失敗したわ: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        client.session.close()
 
-    except Exception as e:
-        print(f"❌ メモの取得に失敗したわ: {e}")
 
 if __name__ == "__main__":
-    fetch_memos()
+    sys.exit(main())
@@ -10,9 +10,114 @@ export type LoginResult = 'success' | 'wrong_password' | 'network_error';
 
 const DEFAULT_SERVER = 'http://100.124.23.48:8000';
 
+// ─── WebSocketチャット ──────────────────
+// /api/chat/ws に常時接続して、1本の接続でメッセージと応答を流すわ。
+// 切れたら指数バックオフで再接続する。開いていない間は XHR(SSE) にフォールバック。
+type StreamHandlers = {
+    onChunk: (text: string) => void;
+    onDone: (truncated: boolean) => void;
+    onError: (err: string) => void;
+};
+
+class ChatSocket {
+    private ws: WebSocket | null = null;
+    private streams = new Map<string, StreamHandlers>();
+    private seq = 0;
+    private retry = 0;
+    private closedByUser = false;
+    private heartbeatMs = 20000;
+    private watchdog: ReturnType<typeof setTimeout> | null = null;
+    onAffinity: ((level: number, exp: number) => void) | null = null;
+    onTyping: ((on: boolean) => void) | null = null;
+    onReminder: ((reminder: { kind: 'task' | 'event'; id: number; title: string; at: string }) => void) | null = null;
+
+    constructor(private url: () => string) { }
+
+    connect() {
+        if (this.ws && this.ws.readyState <= WebSocket.OPEN) return;
+        this.closedByUser = false;
+        const ws = new WebSocket(this.url());
+        this.ws = ws;
+
+        ws.onopen = () => {
+            this.retry = 0;
+            this.armWatchdog();
+        };
+        ws.onmessage = (ev) => {
+            this.armWatchdog();
+            let f: any;
+            try { f = JSON.parse(ev.data); } catch { return; }
+            const h = f.id ? this.streams.get(f.id) : undefined;
+            switch (f.t) {
+                case 'hello': this.heartbeatMs = (f.hb || 20) * 1000; break;
+                case 'ping': this.sendFrame({ t: 'pong' }); break;
+                case 'chunk': h?.onChunk(f.c); break;
+                case 'typing': this.onTyping?.(!!f.on); break;
+                case 'aff': this.onAffinity?.(f.lv, f.xp); break;
+                case 'remind': this.onReminder?.(f); break;
+                case 'err': h?.onError(f.e); break;
+                case 'done':
+                    h?.onDone(!!f.tr);
+                    this.streams.delete(f.id);
+                    break;
+            }
+        };
+        ws.onclose = (ev) => {
+            if (this.watchdog) clearTimeout(this.watchdog);
+            this.ws = null;
+            // 走っていたストリームはサーバー側で打ち切り保存済み
+            this.streams.forEach(h => h.onError('接続が切れちゃった… もう一度送って？'));
+            this.streams.clear();
+            // 4401 = トークン無効。ログインし直すまで再接続しない
+            if (this.closedByUser || ev.code === 4401) return;
+            const delay = Math.min(30000, 1000 * 2 ** this.retry++);
+            setTimeout(() => this.connect(), delay);
+        };
+        ws.onerror = () => { };
+    }
+
+    close() {
+        this.closedByUser = true;
+        this.ws?.close();
+    }
+
+    isOpen(): boolean {
+        return !!this.ws && this.ws.readyState === WebSocket.OPEN;
+    }
+
+    send(message: string, imageData: string[], currentHour: number, handlers: StreamHandlers): string {
+        const id = `s${++this.seq}`;
+        this.streams.set(id, handlers);
+        this.sendFrame({ t: 'msg', id, m: message, img: imageData, h: currentHour });
+        return id;
+    }
+
+    cancel(id: string) {
+        this.sendFrame({ t: 'cancel', id });
+    }
+
+    typing(on: boolean) {
+        this.sendFrame({ t: 'typing', on });
+    }
+
+    private sendFrame(frame: any) {
+        if (this.isOpen()) this.ws!.send(JSON.stringify(frame));
+    }
+
+    // ping が2回分届かなければ死んだ接続とみなして張り直す
+    private armWatchdog() {
+        if (this.watchdog) clearTimeout(this.watchdog);
+        this.watchdog = setTimeout(() => this.ws?.close(), this.heartbeatMs * 2);
+    }
+}
+
 class ApiClient {
     private baseUrl: string = DEFAULT_SERVER;
     private token: string | null = null;
+    private etagCache = new Map<string, { etag: string; data: any }>();
+    readonly chatSocket = new ChatSocket(
+        () => `${this.baseUrl.replace(/^http/, 'ws')}/api/chat/ws?token=${encodeURIComponent(this.token || '')}`
+    );
 
     async init() {
         const saved = await AsyncStorage.getItem('server_url');
@@ -73,6 +178,8 @@ class ApiClient {
     }
 
     async logout() {
+        this.chatSocket.close();
+        this.etagCache.clear();
         this.token = null;
         await AsyncStorage.removeItem('auth_token');
     }
@@ -83,7 +190,25 @@ class ApiClient {
         return h;
     }
 
+    /** ETag 付きの GET。変わってなければ（304）手元の結果をそのまま返す */
+    private async getJson(url: string) {
+        const cached = this.etagCache.get(url);
+        const headers = this.headers();
+        if (cached) headers['If-None-Match'] = cached.etag;
+        const res = await fetch(url, { headers });
+        if (res.status === 304 && cached) return cached.data;
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+        const data = await res.json();
+        const etag = res.headers.get('ETag');
+        if (etag) this.etagCache.set(url, { etag, data });
+        return data;
+    }
+
     // ─── チャット ──────────────────
+    connectChat() {
+        if (this.token) this.chatSocket.connect();
+    }
+
     async chat(
         message: string,
         imageData: string[] = [],
@@ -92,6 +217,17 @@ class ApiClient {
         onError: (err: string) => void,
         currentHour: number = -1,
     ) {
+        // WebSocketが開いていればそっちで送る
+        if (this.chatSocket.isOpen()) {
+            this.chatSocket.send(message, imageData, currentHour, {
+                onChunk,
+                onDone: () => onDone(),
+                onError,
+            });
+            return;
+        }
+        this.connectChat();
+
         try {
             const xhr = new XMLHttpRequest();
             xhr.open('POST', `${this.baseUrl}/api/chat`);
@@ -163,9 +299,7 @@ class ApiClient {
     // ─── メモ (v1.1.0 CRUD) ────────────────────
     async getMemos() {
         try {
-            const res = await fetch(`${this.baseUrl}/api/memos`, { headers: this.headers() });
-            if (!res.ok) throw new Error(`HTTP ${res.status}`);
-            const data = await res.json();
+            const data = await this.getJson(`${this.baseUrl}/api/memos`);
             return data.memos || [];
         } catch (e) {
             console.error('getMemos error:', e);
@@ -234,9 +368,7 @@ class ApiClient {
     // ─── 統計 (v1.1.0) ──────────
     async getStats() {
         try {
-            const res = await fetch(`${this.baseUrl}/api/stats`, { headers: this.headers() });
-            if (!res.ok) throw new Error(`HTTP ${res.status}`);
-            return await res.json();
+            return await this.getJson(`${this.baseUrl}/api/stats`);
         } catch (e) {
             console.error('getStats error:', e);
             return null;
@@ -248,9 +380,7 @@ class ApiClient {
         try {
             let url = `${this.baseUrl}/api/calendar`;
             if (year && month) url += `?year=${year}&month=${month}`;
-            const res = await fetch(url, { headers: this.headers() });
-            if (!res.ok) throw new Error(`HTTP ${res.status}`);
-            const data = await res.json();
+            const data = await this.getJson(url);
             return data.events || [];
         } catch (e) {
             console.error('getEvents error:', e);
@@ -302,14 +432,64 @@ class ApiClient {
         }
     }
 
+    // ─── アジェンダ（予定+タスクを日ごとに） ──────────
+    async getAgenda(from: string, to: string, showDone = true) {
+        try {
+            const data = await this.getJson(
+                `${this.baseUrl}/api/agenda?from=${from}&to=${to}&show_done=${showDone}`
+            );
+            return data.days || [];
+        } catch (e) {
+            console.error('getAgenda error:', e);
+            return [];
+        }
+    }
+
+    async getMonthSummary(year: number, month: number) {
+        try {
+            const data = await this.getJson(
+                `${this.baseUrl}/api/calendar/summary?year=${year}&month=${month}`
+            );
+            return data.days || {};
+        } catch (e) {
+            console.error('getMonthSummary error:', e);
+            return {};
+        }
+    }
+
+    /** 期間内の埋まっている時間と空き時間（from/to は YYYY-MM-DDTHH:MM） */
+    async getFreeBusy(from: string, to: string, minMinutes = 30) {
+        try {
+            return await this.getJson(
+                `${this.baseUrl}/api/calendar/freebusy?from=${from}&to=${to}&min_minutes=${minMinutes}`
+            );
+        } catch (e) {
+            console.error('getFreeBusy error:', e);
+            return { busy: [], free: [] };
+        }
+    }
+
+    /** 前に使ったタスク・予定のタイトルから、前方一致する候補 */
+    async suggest(q: string, kind?: 'task' | 'event', limit = 8): Promise<string[]> {
+        try {
+            let url = `${this.baseUrl}/api/suggest?q=${encodeURIComponent(q)}&limit=${limit}`;
+            if (kind) url += `&kind=${kind}`;
+            const res = await fetch(url, { headers: this.headers() });
+            if (!res.ok) throw new Error(`HTTP ${res.status}`);
+            const data = await res.json();
+            return (data.suggestions || []).map((s: any) => s.title);
+        } catch (e) {
+            console.error('suggest error:', e);
+            return [];
+        }
+    }
+
     // ─── タスク ──────────────────
     async getTasks(date?: string, showDone = false) {
         try {
             let url = `${this.baseUrl}/api/tasks?show_done=${showDone}`;
             if (date) url += `&date=${date}`;
-            const res = await fetch(url, { headers: this.headers() });
-            if (!res.ok) throw new Error(`HTTP ${res.status}`);
-            const data = await res.json();
+            const data = await this.getJson(url);
             return data.tasks || [];
         } catch (e) {
             console.error('getTasks error:', e);
@@ -318,16 +498,32 @@ class ApiClient {
     }
 
     async getTaskHistory(year?: number, month?: number) {
+        return (await this.getTaskHistoryPage(undefined, 50, year, month)).history;
+    }
+
+    /** 完了履歴を1ページ分。続きは nextCursor を渡して取る */
+    async getTaskHistoryPage(cursor?: string | null, limit = 50, year?: number, month?: number) {
         try {
-            let url = `${this.baseUrl}/api/tasks/history`;
-            if (year && month) url += `?year=${year}&month=${month}`;
-            const res = await fetch(url, { headers: this.headers() });
-            if (!res.ok) throw new Error(`HTTP ${res.status}`);
-            const data = await res.json();
-            return data.history || [];
+            let url = `${this.baseUrl}/api/tasks/history?limit=${limit}`;
+            if (year && month) url += `&year=${year}&month=${month}`;
+            if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+            const data = await this.getJson(url);
+            return { history: data.history || [], nextCursor: data.next_cursor as string | null };
         } catch (e) {
             console.error('getTaskHistory error:', e);
-            return [];
+            return { history: [], nextCursor: null };
+        }
+    }
+
+    /** 完了の集計（日別件数・連続日数・期限内率） */
+    async getTaskAnalytics(days = 30) {
+        try {
+            const res = await fetch(`${this.baseUrl}/api/tasks/analytics?days=${days}`, { headers: this.headers() });
+            if (!res.ok) throw new Error(`HTTP ${res.status}`);
+            return await res.json();
+        } catch (e) {
+            console.error('getTaskAnalytics error:', e);
+            return null;
         }
     }
 
@@ -375,12 +571,38 @@ class ApiClient {
         }
     }
 
+    /** まとめて作成・更新・削除（kind: 'tasks' | 'calendar'） */
+    async batch(
+        kind: 'tasks' | 'calendar',
+        ops: { op: 'create' | 'update' | 'delete'; id?: number; data?: any }[],
+        mode: 'atomic' | 'partial' = 'atomic'
+    ) {
+        try {
+            const res = await fetch(`${this.baseUrl}/api/${kind}/batch`, {
+                method: 'POST',
+                headers: this.headers(),
+                body: JSON.stringify({ ops, mode }),
+            });
+            const data = await res.json();
+            if (!res.ok) throw Object.assign(new Error(`HTTP ${res.status}`), { detail: data.detail });
+            return data;
+        } catch (e) {
+            console.error('batch error:', e);
+            throw e;
+        }
+    }
+
+    /** 差分同期。cursor を次の since に渡す。reset なら手元を作り直すこと */
+    async sync(since = 0, entities?: string[], limit = 500) {
+        let url = `${this.baseUrl}/api/sync?since=${since}&limit=${limit}`;
+        if (entities?.length) url += `&entities=${entities.join(',')}`;
+        return await this.getJson(url);
+    }
+
     // ─── 汎用メソッド (v1.2.0 Phase 3) ──
     async get(endpoint: string) {
         try {
-            const res = await fetch(`${this.baseUrl}${endpoint}`, { headers: this.headers() });
-            if (!res.ok) throw new Error(`HTTP ${res.status}`);
-            return await res.json();
+            return await this.getJson(`${this.baseUrl}${endpoint}`);
         } catch (e) {
             console.error(`GET ${endpoint} error:`, e);
             throw e;
@@ -403,10 +625,26 @@ class ApiClient {
     }
 
     /**
-     * 秘密の日記を取得するわ
+     * 秘密の日記を1ページ分（本文は冒頭の preview だけ）。続きは nextCursor を渡して取るわ
      */
-    async getDiary() {
-        return this.get('/api/diary');
+    async getDiaryPage(cursor?: string | null, limit = 20) {
+        let url = `/api/diary/entries?limit=${limit}`;
+        if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+        const data = await this.get(url);
+        return { entries: data.entries || [], nextCursor: data.next_cursor as string | null };
+    }
+
+    /** 日記を1件、本文まで全部 */
+    async getDiaryEntry(id: number) {
+        return this.get(`/api/diary/entries/${id}`);
+    }
+
+    /** 挨拶の履歴を1ページ分 */
+    async getGreetingsPage(cursor?: string | null, limit = 50) {
+        let url = `/api/diary/greetings?limit=${limit}`;
+        if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+        const data = await this.get(url);
+        return { greetings: data.greetings || [], nextCursor: data.next_cursor as string | null };
     }
 }
 
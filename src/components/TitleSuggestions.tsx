@@ -0,0 +1,56 @@
+import React, { useEffect, useState } from 'react';
+import { ScrollView, Text, TouchableOpacity, StyleSheet } from 'react-native';
+import { useTheme, DarkTheme, Spacing, FontSize, BorderRadius } from '../theme';
+import { api } from '../api';
+
+interface Props {
+    query: string;
+    kind: 'task' | 'event';
+    onSelect: (title: string) => void;
+}
+
+/** 打ちかけのタイトルに、前に使ったタイトルを候補として出す（タップで入力） */
+export default function TitleSuggestions({ query, kind, onSelect }: Props) {
+    const { theme = DarkTheme } = useTheme() || {};
+    const [items, setItems] = useState<string[]>([]);
+
+    useEffect(() => {
+        const q = query.trim();
+        if (!q) {
+            setItems([]);
+            return;
+        }
+        let cancelled = false;
+        // 打っている間は投げすぎないように少し待つ
+        const timer = setTimeout(async () => {
+            const titles = await api.suggest(q, kind);
+            if (!cancelled) setItems(titles.filter(t => t !== q));
+        }, 150);
+        return () => {
+            cancelled = true;
+            clearTimeout(timer);
+        };
+    }, [query, kind]);
+
+    if (items.length === 0) return null;
+
+    return (
+        <ScrollView horizontal keyboardShouldPersistTaps="handled" style={styles.row} showsHorizontalScrollIndicator={false}>
+            {items.map(title => (
+                <TouchableOpacity
+                    key={title}
+                    style={[styles.chip, { backgroundColor: theme.surfaceLight, borderColor: theme.border }]}
+                    onPress={() => onSelect(title)}
+                >
+                    <Text style={[styles.chipText, { color: theme.textSecondary }]} numberOfLines={1}>{title}</Text>
+                </TouchableOpacity>
+            ))}
+        </ScrollView>
+    );
+}
+
+const styles = StyleSheet.create({
+    row: { flexGrow: 0, marginBottom: Spacing.sm },
+    chip: { borderWidth: 1, borderRadius: BorderRadius.full, paddingHorizontal: Spacing.md, paddingVertical: 6, marginRight: Spacing.xs, maxWidth: 200 },
+    chipText: { fontSize: FontSize.sm },
+});
@@ -16,6 +16,7 @@ import DateTimePicker from '@react-native-community/datetimepicker';
 import { Spacing, FontSize, BorderRadius, useTheme, DarkTheme } from '../theme';
 import { api } from '../api';
 import { scheduleReminder } from '../utils/notifications';
+import TitleSuggestions from '../components/TitleSuggestions';
 
 // 日本語ロケール
 LocaleConfig.locales['ja'] = {
@@ -340,6 +341,9 @@ export default function CalendarScreen() {
                             onChangeText={setInputTitle}
                             editable={!loading}
                         />
+                        {editMode === 'create' && (
+                            <TitleSuggestions query={inputTitle} kind="event" onSelect={setInputTitle} />
+                        )}
 
                         <View style={styles.timeInputRow}>
                             <View style={styles.timeInputBlock}>
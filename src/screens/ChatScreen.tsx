@@ -22,6 +22,7 @@ import { LinearGradient } from 'expo-linear-gradient';
 import { Spacing, FontSize, BorderRadius, useTheme, DarkTheme } from '../theme';
 import { api } from '../api';
 import { debugStore } from '../utils/debugStore';
+import { showServerReminder } from '../utils/notifications';
 
 interface Message {
     id: string;
@@ -59,6 +60,8 @@ export default function ChatScreen() {
         loadHistory();
         loadAvatar();
         loadDebugSettings(); // Added loadDebugSettings
+        api.chatSocket.onReminder = showServerReminder;
+        api.connectChat();
     }, []);
 
     const loadAvatar = async () => {
@@ -9,21 +9,30 @@ export default function LogViewerScreen({ navigation, route }: any) {
     const { theme = DarkTheme } = useTheme() || {};
     const [loading, setLoading] = useState(true);
     const [logs, setLogs] = useState<any[]>([]);
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
+    const [loadingMore, setLoadingMore] = useState(false);
+    // 日記は一覧だと冒頭だけなので、タップした分の全文をここに持つ
+    const [fullContent, setFullContent] = useState<Record<number, string>>({});
 
     useEffect(() => {
         fetchLogs();
     }, [type]);
 
+    const fetchPage = async (cursor: string | null) => {
+        if (type === 'greetings') {
+            const page = await api.getGreetingsPage(cursor);
+            return { items: page.greetings, nextCursor: page.nextCursor };
+        }
+        const page = await api.getDiaryPage(cursor);
+        return { items: page.entries, nextCursor: page.nextCursor };
+    };
+
     const fetchLogs = async () => {
         setLoading(true);
         try {
-            if (type === 'greetings') {
-                const res = await api.get('/api/diary/greetings');
-                setLogs(res.greetings || []);
-            } else if (type === 'diary') {
-                const res = await api.get('/api/diary/entries');
-                setLogs(res.entries || []);
-            }
+            const page = await fetchPage(null);
+            setLogs(page.items);
+            setNextCursor(page.nextCursor);
         } catch (err) {
             console.error(err);
         } finally {
@@ -31,8 +40,43 @@ export default function LogViewerScreen({ navigation, route }: any) {
         }
     };
 
+    const loadMore = async () => {
+        if (!nextCursor || loadingMore) return;
+        setLoadingMore(true);
+        try {
+            const page = await fetchPage(nextCursor);
+            setLogs(prev => [...prev, ...page.items]);
+            setNextCursor(page.nextCursor);
+        } catch (err) {
+            console.error(err);
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
+    const toggleFull = async (item: any) => {
+        if (fullContent[item.id] !== undefined) {
+            setFullContent(prev => {
+                const { [item.id]: _, ...rest } = prev;
+                return rest;
+            });
+            return;
+        }
+        try {
+            const entry = await api.getDiaryEntry(item.id);
+            setFullContent(prev => ({ ...prev, [item.id]: entry.content }));
+        } catch (err) {
+            console.error(err);
+        }
+    };
+
     const renderItem = ({ item }: { item: any }) => (
-        <View style={[styles.logCard, { backgroundColor: theme.surfaceLight, borderColor: theme.border }]}>
+        <TouchableOpacity
+            activeOpacity={0.8}
+            disabled={type !== 'diary' || !item.truncated}
+            onPress={() => toggleFull(item)}
+            style={[styles.logCard, { backgroundColor: theme.surfaceLight, borderColor: theme.border }]}
+        >
             <View style={styles.logHeader}>
                 <Text style={[styles.logType, { color: theme.primary }]}>
                     {type === 'greetings' ? `👋 ${item.greeting_type}` : `📖 ${item.title || '無題'}`}
@@ -42,7 +86,9 @@ export default function LogViewerScreen({ navigation, route }: any) {
                 </Text>
             </View>
             <Text style={[styles.logContent, { color: theme.text }]}>
-                {type === 'greetings' ? '挨拶を記録したわよ♡' : item.content}
+                {type === 'greetings'
+                    ? '挨拶を記録したわよ♡'
+                    : fullContent[item.id] ?? (item.truncated ? `${item.preview}…` : item.preview)}
             </Text>
             {type === 'diary' && (
                 <View style={styles.diaryFooter}>
@@ -50,7 +96,7 @@ export default function LogViewerScreen({ navigation, route }: any) {
                     <Text style={[styles.affinityText, { color: theme.primary }]}>Affinity: {item.affinity_level}</Text>
                 </View>
             )}
-        </View>
+        </TouchableOpacity>
     );
 
     return (
@@ -77,6 +123,9 @@ export default function LogViewerScreen({ navigation, route }: any) {
                     renderItem={renderItem}
                     keyExtractor={(item, index) => String(item.id || index)}
                     contentContainerStyle={styles.listContent}
+                    onEndReached={loadMore}
+                    onEndReachedThreshold={0.5}
+                    ListFooterComponent={loadingMore ? <ActivityIndicator color={theme.primary} /> : null}
                     ListEmptyComponent={<Text style={[styles.emptyText, { color: theme.textMuted }]}>ログが見つからないわ…</Text>}
                 />
             )}
@@ -20,7 +20,8 @@ const { width } = Dimensions.get('window');
 interface DiaryEntry {
     id: number;
     title: string;
-    content: string;
+    preview: string;
+    truncated: boolean;
     mood: string;
     affinity_level: number;
     created_at: string;
@@ -32,6 +33,10 @@ export default function SecretDiaryScreen() {
     const [entries, setEntries] = useState<DiaryEntry[]>([]);
     const [loading, setLoading] = useState(true);
     const [affinity, setAffinity] = useState(0);
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
+    const [loadingMore, setLoadingMore] = useState(false);
+    // 一覧は冒頭だけ。開いた日記の全文はここに
+    const [opened, setOpened] = useState<Record<number, string>>({});
 
     useEffect(() => {
         loadData();
@@ -45,8 +50,9 @@ export default function SecretDiaryScreen() {
             setAffinity(currentAff);
 
             if (currentAff >= 80) {
-                const data = await api.getDiary();
-                setEntries(data);
+                const page = await api.getDiaryPage();
+                setEntries(page.entries);
+                setNextCursor(page.nextCursor);
             }
         } catch (err) {
             console.error('Failed to load diary', err);
@@ -55,8 +61,36 @@ export default function SecretDiaryScreen() {
         }
     };
 
+    const loadMore = async () => {
+        if (!nextCursor || loadingMore) return;
+        setLoadingMore(true);
+        try {
+            const page = await api.getDiaryPage(nextCursor);
+            setEntries(prev => [...prev, ...page.entries]);
+            setNextCursor(page.nextCursor);
+        } catch (err) {
+            console.error('Failed to load diary', err);
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
+    const openEntry = async (item: DiaryEntry) => {
+        if (!item.truncated || opened[item.id] !== undefined) return;
+        try {
+            const entry = await api.getDiaryEntry(item.id);
+            setOpened(prev => ({ ...prev, [item.id]: entry.content }));
+        } catch (err) {
+            console.error('Failed to load diary entry', err);
+        }
+    };
+
     const renderEntry = ({ item }: { item: DiaryEntry }) => (
-        <View style={[styles.card, { backgroundColor: 'rgba(255, 255, 255, 0.05)', borderColor: theme.primary + '33' }]}>
+        <TouchableOpacity
+            activeOpacity={0.8}
+            onPress={() => openEntry(item)}
+            style={[styles.card, { backgroundColor: 'rgba(255, 255, 255, 0.05)', borderColor: theme.primary + '33' }]}
+        >
             <View style={styles.cardHeader}>
                 <Text style={[styles.cardTitle, { color: theme.text }]}>{item.title || '無題の日記'}</Text>
                 <Text style={[styles.cardDate, { color: theme.textMuted }]}>
@@ -64,7 +98,7 @@ export default function SecretDiaryScreen() {
                 </Text>
             </View>
             <Text style={[styles.cardContent, { color: theme.textSecondary }]}>
-                {item.content}
+                {opened[item.id] ?? (item.truncated ? `${item.preview}…` : item.preview)}
             </Text>
             <View style={styles.cardFooter}>
                 <View style={[styles.tag, { backgroundColor: theme.primary + '22' }]}>
@@ -72,7 +106,7 @@ export default function SecretDiaryScreen() {
                 </View>
                 <Text style={[styles.affinityTag, { color: theme.accent }]}>Lv.{item.affinity_level} の記憶</Text>
             </View>
-        </View>
+        </TouchableOpacity>
     );
 
     if (loading) {
@@ -121,6 +155,9 @@ export default function SecretDiaryScreen() {
                 renderItem={renderEntry}
                 keyExtractor={item => item.id.toString()}
                 contentContainerStyle={styles.listContent}
+                onEndReached={loadMore}
+                onEndReachedThreshold={0.5}
+                ListFooterComponent={loadingMore ? <ActivityIndicator color={theme.primary} /> : null}
                 ListEmptyComponent={
                     <View style={styles.emptyContainer}>
                         <Ionicons name="book-outline" size={60} color={theme.textMuted} />
@@ -17,6 +17,7 @@ import { Spacing, FontSize, BorderRadius, useTheme, DarkTheme } from '../theme';
 import { api } from '../api';
 import { scheduleReminder } from '../utils/notifications';
 import { Ionicons } from '@expo/vector-icons';
+import TitleSuggestions from '../components/TitleSuggestions';
 
 interface Task {
     id: number;
@@ -30,10 +31,13 @@ interface Task {
     event_title: string | null;
 }
 
+const historyDate = (t: Task) => (t.completed_at || t.due_date || t.created_at).slice(0, 10);
+
 export default function TaskScreen() {
     const { theme = DarkTheme } = useTheme() || {};
     const [tasks, setTasks] = useState<Task[]>([]);
     const [history, setHistory] = useState<Task[]>([]);
+    const [historyCursor, setHistoryCursor] = useState<string | null>(null);
     const [activeTab, setActiveTab] = useState<'pending' | 'today_done' | 'history'>('pending');
     const [searchQuery, setSearchQuery] = useState('');
     const [loading, setLoading] = useState(false);
@@ -57,8 +61,9 @@ export default function TaskScreen() {
         setLoading(true);
         try {
             if (activeTab === 'history') {
-                const data = await api.getTaskHistory();
-                setHistory(data);
+                const page = await api.getTaskHistoryPage();
+                setHistory(page.history);
+                setHistoryCursor(page.nextCursor);
             } else {
                 const data = await api.getTasks(undefined, false);
                 setTasks(data);
@@ -70,6 +75,19 @@ export default function TaskScreen() {
         }
     };
 
+    // 履歴の続き（下までスクロールしたら次のページ）
+    const loadMoreHistory = async () => {
+        if (!historyCursor || loading) return;
+        setLoading(true);
+        try {
+            const page = await api.getTaskHistoryPage(historyCursor);
+            setHistory(prev => [...prev, ...page.history]);
+            setHistoryCursor(page.nextCursor);
+        } finally {
+            setLoading(false);
+        }
+    };
+
     const handleSaveTask = async () => {
         if (!inputTitle.trim() || loading) return;
         setLoading(true);
@@ -135,9 +153,10 @@ export default function TaskScreen() {
         const query = searchQuery.toLowerCase();
         const matched = history.filter(t => t.title.toLowerCase().includes(query));
 
+        // 履歴はサーバーが完了した順（新しい方から）で返すので、完了日で月ごとに分ける
         const sections: { title: string; data: Task[] }[] = [];
         matched.forEach(t => {
-            const dateStr = t.due_date || t.created_at.split('T')[0];
+            const dateStr = historyDate(t);
             const [y, m] = dateStr.split('-');
             const title = `${y}年 ${m}月`;
             const found = sections.find(s => s.title === title);
@@ -147,18 +166,14 @@ export default function TaskScreen() {
 
         // 月内の降順ソート
         sections.forEach(s => {
-            s.data.sort((a, b) => {
-                const da = a.due_date || a.created_at.split('T')[0];
-                const db = b.due_date || b.created_at.split('T')[0];
-                return db.localeCompare(da);
-            });
+            s.data.sort((a, b) => historyDate(b).localeCompare(historyDate(a)));
         });
 
         return sections.sort((a, b) => b.title.localeCompare(a.title));
     }, [history, searchQuery]);
 
     const renderTaskItem = ({ item }: { item: Task }) => {
-        const dateStr = item.due_date || item.created_at.split('T')[0];
+        const dateStr = activeTab === 'history' ? historyDate(item) : item.due_date || item.created_at.split('T')[0];
         const day = dateStr.split('-')[2];
 
         return (
@@ -244,6 +259,8 @@ export default function TaskScreen() {
                     )}
                     contentContainerStyle={styles.listContent}
                     ListEmptyComponent={<Text style={styles.emptyText}>履歴はないわよ？</Text>}
+                    onEndReached={loadMoreHistory}
+                    onEndReachedThreshold={0.5}
                 />
             ) : (
                 <FlatList
@@ -268,6 +285,9 @@ export default function TaskScreen() {
                             placeholder="何をするの？"
                             placeholderTextColor={theme.textMuted}
                         />
+                        {editMode === 'create' && (
+                            <TitleSuggestions query={inputTitle} kind="task" onSelect={setInputTitle} />
+                        )}
                         <View style={styles.modalButtons}>
                             <TouchableOpacity style={styles.modalBtn} onPress={() => setModalVisible(false)}>
                                 <Text style={{ color: theme.textSecondary }}>キャンセル</Text>
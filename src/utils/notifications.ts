@@ -76,6 +76,27 @@ export async function scheduleTestNotification() {
     });
 }
 
+/**
+ * サーバーから push されたリマインダーをその場で通知する
+ * 同じ回は一度だけ（再接続で送り直されても重ならないように）
+ */
+const shownReminders = new Set<string>();
+
+export async function showServerReminder(reminder: { kind: 'task' | 'event'; id: number; title: string; at: string }) {
+    ensureInitialized();
+    const key = `${reminder.kind}:${reminder.id}:${reminder.at}`;
+    if (shownReminders.has(key)) return;
+    shownReminders.add(key);
+    await Notifications.scheduleNotificationAsync({
+        content: {
+            title: `${reminder.kind === 'task' ? '【タスク】' : '【もうすぐ】'}${reminder.title}🌙`,
+            body: getRandomMessage('reminder'),
+            data: { id: reminder.id, type: 'reminder' },
+        },
+        trigger: null, // 即時
+    });
+}
+
 /**
  * 予定やタスクのリマインダーをスケジュールする
  * @param id 予定/タスクのID